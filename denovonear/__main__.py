@@ -10,6 +10,7 @@ from denovonear.ensembl_requester import EnsemblRequest
 from denovonear.load_mutation_rates import load_mutation_rates
 from denovonear.load_de_novos import load_de_novos
 from denovonear.cluster_test import cluster_de_novos
+from denovonear.null_cache import NullCache
 
 from denovonear.load_gene import (construct_gene_object,
     count_de_novos_per_transcript, minimise_transcripts)
@@ -21,15 +22,20 @@ def clustering(ensembl, mut_dict, output, args):
     
     de_novos = load_de_novos(args.input)
     
+    null_cache = None
+    if args.null_cache is not None:
+        null_cache = NullCache(args.null_cache)
+    
     output.write("gene_id\tmutation_category\tevents_n\tdist\tprobability\n")
     
-    iterations = 1000000
     for symbol in sorted(de_novos):
         
         if len(de_novos[symbol]["missense"] + de_novos[symbol]["nonsense"]) < 2:
             continue
         
-        probs = cluster_de_novos(symbol, de_novos[symbol], iterations, ensembl, mut_dict)
+        probs = cluster_de_novos(symbol, de_novos[symbol], args.max_iterations,
+            ensembl, mut_dict, args.threads, args.target_rse, args.seed,
+            null_cache)
         
         if probs is None:
             continue
@@ -95,7 +101,7 @@ def get_mutation_rates(transcripts, mut_dict, ensembl):
     
     Args:
         transcripts: list of transcript IDs for a gene
-        mut_dict: dictionary of local sequence context mutation rates
+        mut_dict: MutationRates object, with local sequence context rates
         ensembl: EnsemblRequest object, to retrieve information from Ensembl.
     
     Returns:
@@ -119,11 +125,12 @@ def get_mutation_rates(transcripts, mut_dict, ensembl):
         if tx.get_chrom() == "MT":
             continue
         
-        sites = SiteRates(tx, mut_dict, masked_sites=combined)
+        # we only need the summed rates, so don't build rates for each site
+        sites = SiteRates(tx, mut_dict, masked_sites=combined, categories=[])
         combined = tx + combined
         
         for cq in ['missense', 'nonsense', 'splice_lof', 'splice_region', 'synonymous']:
-            rates[cq] += sites[cq].get_summed_rate()
+            rates[cq] += sites.get_summed_rate(cq)
     
     if combined is None:
         raise ValueError('no tx found')
@@ -185,6 +192,23 @@ def get_options():
     cluster.add_argument("--in", dest="input", required=True, help="Path to "
         "file listing known mutations in genes. See example file in data folder "
         "for format.")
+    cluster.add_argument("--threads", type=int, default=1, help="Number of "
+        "threads to split the simulations for each gene across (default 1).")
+    cluster.add_argument("--target-rse", type=float, help="Relative standard "
+        "error wanted for each p-value. Simulations for a gene stop once this "
+        "is reached (default stops after 1000 simulations as clustered as "
+        "observed, roughly 0.03).")
+    cluster.add_argument("--max-iterations-per-test", "--max-iterations",
+        dest="max_iterations", type=int, default=1000000, help="Maximum number "
+        "of simulations for each test, including any importance sampling draws "
+        "for very clustered genes (default 1000000). Each consequence type in "
+        "each transcript is a separate test, so a gene can run a few times "
+        "this many simulations.")
+    cluster.add_argument("--seed", type=int, help="Seed for the simulations, "
+        "so results can be repeated exactly, regardless of the thread count.")
+    cluster.add_argument("--null-cache", help="Path to a database of simulated "
+        "null distributions, to reuse simulations from earlier runs, e.g. for "
+        "a new cohort. Created if it does not exist.")
     
     cluster.set_defaults(func=clustering)
     
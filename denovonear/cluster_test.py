@@ -1,5 +1,6 @@
 
 from math import log, isnan
+import zlib
 
 from scipy.stats import chi2
 
@@ -51,16 +52,26 @@ def combine_p_values(probs):
     
     return fixed_probs
 
-def cluster_de_novos(symbol, de_novos, iterations=1000000, ensembl=None, mut_dict=None):
+def cluster_de_novos(symbol, de_novos, iterations=1000000, ensembl=None,
+        mut_dict=None, threads=1, target_rse=None, seed=None, null_cache=None):
     """ analysis proximity cluster of de novos in a single gene
     
     Args:
         symbol: HGNC symbol for a gene
         de_novos: dictionary of de novo positions for the HGNC gene,
         indexed by functional type
-        iterations: number of simulations to run
+        iterations: maximum number of simulations to run per p-value. The
+            gene has a p-value for each consequence type in each transcript,
+            so can run several times this many simulations.
         ensembl: EnsemblRequest object, for obtaing info from ensembl
-        mut_dict: dictionary of mutation rates, indexed by trinuclotide sequence
+        mut_dict: MutationRates object, with rates by trinucleotide sequence
+        threads: number of threads to split the simulations across
+        target_rse: relative standard error at which to stop simulating for
+            each p-value, or None to use the default stopping rule.
+        seed: integer seed, so the simulations can be repeated, or None. Each
+            transcript and consequence type draws from a separate stream.
+        null_cache: NullCache object, to reuse simulated null distributions
+            from earlier runs, or None.
     
     Returns:
         a dictionary containing P values, and distances for missense, nonsense,
@@ -93,10 +104,20 @@ def cluster_de_novos(symbol, de_novos, iterations=1000000, ensembl=None, mut_dic
         missense_events = get_de_novos_in_transcript(transcript, missense)
         nonsense_events = get_de_novos_in_transcript(transcript, nonsense)
         
-        rates = SiteRates(transcript, mut_dict)
+        rates = SiteRates(transcript, mut_dict,
+            categories=['missense', 'loss_of_function'])
         
-        (miss_dist, miss_prob) = get_p_value(transcript, rates, iterations, "missense", missense_events)
-        (nons_dist, nons_prob) = get_p_value(transcript, rates, iterations, "lof", nonsense_events)
+        # give every gene and transcript its own random number streams, so
+        # seeded p-values are independent, whichever genes are analysed
+        name = '{}:{}'.format(symbol, transcript.get_name()).encode('utf8')
+        stream = zlib.crc32(name) * 2
+        
+        (miss_dist, miss_prob) = get_p_value(transcript, rates, iterations,
+            "missense", missense_events, threads, target_rse, seed, stream,
+            null_cache)
+        (nons_dist, nons_prob) = get_p_value(transcript, rates, iterations,
+            "lof", nonsense_events, threads, target_rse, seed, stream + 1,
+            null_cache)
         
         dists["miss_dist"].append(miss_dist)
         dists["nons_dist"].append(nons_dist)
@@ -7,6 +7,7 @@ import sqlite3
 import sys
 import time
 import random
+import threading
 import zlib
 from datetime import datetime
 
@@ -43,7 +44,9 @@ class EnsemblCache(object):
             except sqlite3.OperationalError:
                 time.sleep(random.uniform(1, 5))
         
-        self.conn = sqlite3.connect(path)
+        # allow one connection to be shared by threads, guarded by a lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
     
     def set_ensembl_api_version(self, version):
@@ -67,11 +70,11 @@ class EnsemblCache(object):
         
         key = self.get_key_from_url(url)
         
-        with self.conn as conn:
+        with self.lock, self.conn as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM ensembl WHERE key=? AND genome_build=?",
                 (key, self.genome_build))
-        row = cursor.fetchone()
+            row = cursor.fetchone()
         
         # if the data has been cached, check that it is not out of date, and
         # the data was generated from the same Ensembl API version
@@ -124,7 +127,7 @@ class EnsemblCache(object):
         cmd = "INSERT OR REPLACE INTO ensembl " \
             "(key, genome_build, cache_date, api_version, data) VALUES (?,?,?,?,?)"
         try:
-            with self.conn as cursor:
+            with self.lock, self.conn as cursor:
                 cursor.execute(cmd, t)
         except sqlite3.OperationalError:
             # if we hit a sqlite locking error, wait a random time so conflicting
@@ -19,7 +19,7 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from denovonear.site_specific_rates import get_mutated_aa
+from denovonear.site_specific_rates import get_codon_change
 
 class Consequences(object):
     """ class to identify HGVS-like codes for variants
@@ -183,7 +183,7 @@ class Consequences(object):
         # change the codon number from being 0-based to 1-based
         codon["codon_number"] += 1
         
-        mutated_aa = get_mutated_aa(self.transcript, alt, codon["codon_seq"],
-            codon["intra_codon"])
+        mutated_aa, _ = get_codon_change(codon["codon_seq"], codon["intra_codon"],
+            alt)
         
         return "{}{}{}".format(codon["initial_aa"], codon["codon_number"], mutated_aa)
@@ -3,6 +3,8 @@
 
 from pkg_resources import resource_filename
 
+from denovonear.site_specific_rates import MutationRates
+
 def load_mutation_rates(path=None):
     """ load sequence context-based mutation rates
     
@@ -12,7 +14,9 @@ def load_mutation_rates(path=None):
             (Broad Institute).
     
     Returns:
-        list of [initial, changed, rate] lists e.g. [['AGA', 'ATA', '5e-8']]
+        MutationRates object, holding the rates from [initial, changed, rate]
+        rows e.g. [['AGA', 'ATA', '5e-8']]. This can be shared between the
+        SiteRates for every transcript.
     """
     
     if path is None:
@@ -27,4 +31,4 @@ def load_mutation_rates(path=None):
             line = [ x.encode('utf8') for x in line.strip().split() ]
             rates.append(line)
     
-    return rates
+    return MutationRates(rates)
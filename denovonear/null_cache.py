@@ -0,0 +1,249 @@
+""" caches simulated null distributions of mean distances between de novos, so
+reanalysing the same genes (e.g. for a new cohort) can reuse earlier
+simulations, rather than simulating from scratch.
+"""
+
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy
+
+class NullDistribution(object):
+    """ compact summary of simulated geometric mean distances
+    
+    The smallest simulated values are kept exactly, since significant de novos
+    fall in the lower tail, where the counts need to be exact. The rest are
+    summarised by the values at geometrically spaced ranks, so the count
+    interpolated for a value above the tail is within about 1% of the true
+    count. Small runs are kept in full.
+    """
+    
+    TAIL = 10000
+    RANK_STEP = 1.01
+    
+    def __init__(self, total, tail, ranks, values):
+        """ set up the summary
+        
+        Args:
+            total: number of simulations summarised.
+            tail: sorted numpy array of the smallest simulated values, or of all
+                the values if there are at most TAIL simulations.
+            ranks: numpy array of ranks (counts of values at or below) beyond
+                the tail.
+            values: numpy array of simulated values at those ranks.
+        """
+        
+        self.total = total
+        self.tail = tail
+        self.ranks = ranks
+        self.values = values
+    
+    @classmethod
+    def from_simulations(cls, values):
+        """ summarise an array of simulated values
+        """
+        
+        values = numpy.sort(numpy.asarray(values, dtype=numpy.float64))
+        ranks, points = cls._body(len(values), lambda x: values[x - 1])
+        
+        return cls(len(values), values[:cls.TAIL].copy(), ranks, points)
+    
+    @classmethod
+    def _body(cls, total, get_value):
+        """ get values at geometrically spaced ranks beyond the tail
+        
+        Args:
+            total: number of simulated values
+            get_value: function giving the value at a rank (1-based)
+        """
+        
+        if total <= cls.TAIL:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+        
+        steps = numpy.log(total / cls.TAIL) / numpy.log(cls.RANK_STEP)
+        ranks = cls.TAIL * cls.RANK_STEP ** numpy.arange(int(steps) + 1)
+        ranks = numpy.unique(numpy.append(ranks.astype(numpy.int64), total))
+        
+        return ranks, numpy.array([ get_value(x) for x in ranks ], dtype=numpy.float64)
+    
+    def count(self, observed):
+        """ count simulated values at or below an observed value
+        
+        Returns:
+            the count, which is exact within the tail, otherwise interpolated
+        """
+        
+        return int(self.counts([observed])[0])
+    
+    def counts(self, observed):
+        """ count simulated values at or below each of an array of values
+        """
+        
+        observed = numpy.asarray(observed, dtype=numpy.float64)
+        counts = numpy.searchsorted(self.tail, observed, side='right')
+        if self.total <= self.TAIL:
+            return counts
+        
+        # ranks beyond the tail need interpolating, starting at the tail
+        xp = numpy.append(self.tail[-1], self.values)
+        fp = numpy.append(len(self.tail), self.ranks)
+        body = numpy.round(numpy.interp(observed, xp, fp)).astype(numpy.int64)
+        
+        return numpy.where(observed < self.tail[-1], counts, body)
+    
+    def __add__(self, other):
+        """ combine summaries of two independent sets of simulations
+        """
+        
+        total = self.total + other.total
+        tail = numpy.sort(numpy.concatenate([self.tail, other.tail]))
+        
+        # the smallest values of both sets include the smallest of the union
+        if total <= self.TAIL:
+            return NullDistribution.from_simulations(tail)
+        
+        # find the values at the new ranks by inverting the summed counts,
+        # which are known at every value stored in either summary
+        xs = numpy.unique(numpy.concatenate([tail, self.values, other.values]))
+        counts = self.counts(xs) + other.counts(xs)
+        
+        def get_value(rank):
+            return xs[min(numpy.searchsorted(counts, rank), len(xs) - 1)]
+        
+        ranks, values = self._body(total, get_value)
+        
+        return NullDistribution(total, tail[:self.TAIL], ranks, values)
+    
+    def to_blob(self):
+        """ pack the summary into compressed bytes
+        """
+        
+        header = numpy.array([self.total, len(self.tail), len(self.ranks)],
+            dtype=numpy.int64)
+        data = header.tobytes() + self.tail.tobytes() + \
+            self.ranks.astype(numpy.int64).tobytes() + self.values.tobytes()
+        
+        return zlib.compress(data)
+    
+    @classmethod
+    def from_blob(cls, blob):
+        """ unpack a summary from compressed bytes made by to_blob()
+        """
+        
+        data = zlib.decompress(blob)
+        total, tail_len, body_len = numpy.frombuffer(data[:24], dtype=numpy.int64)
+        
+        offset = 24
+        tail = numpy.frombuffer(data, numpy.float64, tail_len, offset)
+        offset += tail.nbytes
+        ranks = numpy.frombuffer(data, numpy.int64, body_len, offset)
+        offset += ranks.nbytes
+        values = numpy.frombuffer(data, numpy.float64, body_len, offset)
+        
+        return cls(int(total), tail, ranks, values)
+
+class NullCache(object):
+    """ store simulated null distributions in a sqlite database
+    
+    Distributions are keyed by a hash of the per-site rates and the number of
+    de novos. The sites are set by the transcript, consequence type and rates
+    table, so any change to those gives a new key.
+    """
+    
+    def __init__(self, path):
+        """ open (or create) the cache database
+        
+        Args:
+            path: path to the sqlite database file
+        """
+        
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        
+        self._create_table(path)
+        
+        # allow one connection to be shared by threads, guarded by a lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+    
+    def _create_table(self, path, attempt=0):
+        """ make the table for the distributions, if it doesn't exist yet
+        """
+        
+        try:
+            with sqlite3.connect(path) as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS nulls " \
+                    "(key text PRIMARY KEY, transcript text, consequence text, " \
+                    "de_novos_count integer, iterations integer, data blob)")
+        except sqlite3.OperationalError:
+            # another instance may hold a lock on a new database, so wait a
+            # random time and retry, until we run out of attempts
+            if attempt >= 5:
+                raise
+            time.sleep(random.uniform(1, 5))
+            self._create_table(path, attempt + 1)
+    
+    def get_key(self, weights, de_novos_count):
+        """ get the key for the null distribution of a set of sites
+        
+        Args:
+            weights: WeightedChoice object, with the sites to sample from
+            de_novos_count: number of de novos per simulation
+        """
+        
+        arrays = weights.to_arrays()
+        digest = hashlib.sha1(b'1')
+        digest.update(arrays['pos'].astype('<i4').tobytes())
+        digest.update(arrays['prob'].astype('<f8').tobytes())
+        digest.update(str(de_novos_count).encode('utf8'))
+        
+        return digest.hexdigest()
+    
+    def get(self, key):
+        """ get the cached NullDistribution for a key, or None if absent
+        """
+        
+        with self.lock, self.conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT data FROM nulls WHERE key=?", (key, ))
+            row = cursor.fetchone()
+        
+        if row is None:
+            return None
+        
+        return NullDistribution.from_blob(row[0])
+    
+    def put(self, key, null, transcript=None, consequence=None,
+            de_novos_count=None, attempt=0):
+        """ store a NullDistribution for a key
+        
+        Args:
+            key: key from get_key()
+            null: NullDistribution to store
+            transcript: name of the transcript, to help inspect the cache
+            consequence: consequence type, to help inspect the cache
+            de_novos_count: number of de novos per simulation
+        """
+        
+        cmd = "INSERT OR REPLACE INTO nulls (key, transcript, consequence, " \
+            "de_novos_count, iterations, data) VALUES (?,?,?,?,?,?)"
+        values = (key, transcript, consequence, de_novos_count, null.total,
+            null.to_blob())
+        try:
+            with self.lock, self.conn as conn:
+                conn.execute(cmd, values)
+        except sqlite3.OperationalError:
+            # if we hit a sqlite locking error, wait a random time so conflicting
+            # instances are less likely to reconflict, then retry. Give up
+            # after a few attempts, rather than losing the simulations quietly.
+            if attempt >= 5:
+                raise
+            time.sleep(random.uniform(1, 10))
+            self.put(key, null, transcript, consequence, de_novos_count,
+                attempt + 1)
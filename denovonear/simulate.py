@@ -3,9 +3,137 @@ distances apart within the gene, and compare that to simulated de novo events
 within the same gene.
 """
 
-from denovonear.weights import geomean, get_distances, analyse_de_novos
+import math
 
-def get_p_value(transcript, rates, iterations, consequence, de_novos):
+import numpy
+
+from denovonear.weights import geomean, get_distances, analyse_de_novos_many, \
+    simulate_distribution, can_enumerate
+from denovonear.null_cache import NullDistribution
+from denovonear.simulation_result import SimulationResult
+
+def two_de_novo_p_value(weights, distance):
+    """ exact probability of two de novos falling within a distance of each other
+    
+    For two de novos, the test statistic is the distance between two
+    independent draws from the sites, so the null distribution of the distance
+    is the autocorrelation of the per-position rates across the CDS. We get
+    that via a FFT, rather than simulating.
+    
+    Args:
+        weights: WeightedChoice object, with rates for each CDS site.
+        distance: observed distance between the two de novos.
+    
+    Returns:
+        probability of two de novos being at most the observed distance apart,
+        or None if the sites have no weight to sample from.
+    """
+    
+    sites = weights.to_arrays()
+    positions, rates = sites['pos'], sites['prob']
+    if len(positions) == 0:
+        return None
+    
+    # sum the rates for every alternate allele at each CDS position
+    rates = numpy.bincount(positions - positions.min(), weights=rates)
+    total = rates.sum()
+    if total <= 0:
+        return None
+    rates /= total
+    
+    # zero pad the rates to avoid circular overlaps, then get the probability
+    # of each distance from the autocorrelation of the rates
+    length = len(rates)
+    size = 1 << (2 * length - 1).bit_length()
+    transformed = numpy.fft.rfft(rates, size)
+    autocorr = numpy.fft.irfft(transformed * numpy.conj(transformed), size)[:length]
+    autocorr = numpy.clip(autocorr, 0, None)
+    
+    # distances above zero occur from sites in either order
+    distance = int(distance)
+    prob = autocorr[0] + 2 * autocorr[1:distance + 1].sum()
+    
+    return min(float(prob), 1.0)
+
+def get_exceedances(target_rse):
+    """ find the Besag-Clifford stopping count for a target precision
+    
+    After h simulations at or below the observed value, the relative standard
+    error of the estimated p-value is about sqrt((1 - p) / h), which is at most
+    1 / sqrt(h).
+    
+    Args:
+        target_rse: relative standard error wanted for each p-value e.g. 0.1
+    
+    Returns:
+        number of exceedances at which to stop simulating
+    """
+    
+    if target_rse <= 0:
+        raise ValueError("target relative standard error must be positive")
+    
+    return int(math.ceil(1.0 / target_rse ** 2))
+
+def cached_p_value(cache, weights, iterations, de_novos_count, observed,
+        exceedances=1000, threads=1, seed=None, stream=0, transcript=None,
+        consequence=None):
+    """ estimate a clustering probability from a cached null distribution
+    
+    We only simulate if the cache lacks a null distribution for the sites, or
+    if it has too few simulations at or below the observed value for the
+    required precision. Extra simulations are merged into the cached
+    distribution, so later lookups benefit too.
+    
+    Args:
+        cache: NullCache object
+        weights: WeightedChoice object, with the sites to sample from
+        iterations: maximum number of simulations needed
+        de_novos_count: number of de novos per simulation
+        observed: geometric mean distance for the observed de novos
+        exceedances: number of simulations at or below the observed value
+            which gives enough precision.
+        threads: number of threads to split the simulations across
+        seed: integer seed for new simulations, or None
+        stream: number of an independent random number stream for the seed
+        transcript: name of the transcript, stored to help inspect the cache
+        consequence: consequence type, stored to help inspect the cache
+    
+    Returns:
+        probability of a mean distance <= observed, or None if no simulations
+        were as clustered as observed, so another method is needed. The cache
+        only keeps the sorted values, not the order they were simulated in, so
+        we can't tell when the Besag-Clifford rule would have stopped. The
+        estimate always counts the observed set too, i.e. (1 + count) /
+        (1 + total), as for runs which use all their iterations.
+    """
+    
+    key = cache.get_key(weights, de_novos_count)
+    null = cache.get(key)
+    
+    updated = False
+    while null is None or (null.count(observed) < exceedances and
+            null.total < iterations):
+        # double the simulations each round, in batches of limited size
+        done = 0 if null is None else null.total
+        extra = min(iterations - done, max(done, 10000), 1000000)
+        simulated = simulate_distribution(weights, extra, de_novos_count,
+            threads, as_array=True, seed=seed, stream=stream, start=done)
+        simulated = NullDistribution.from_simulations(simulated)
+        null = simulated if null is None else null + simulated
+        updated = True
+    
+    if updated:
+        cache.put(key, null, transcript, consequence, de_novos_count)
+    
+    count = null.count(observed)
+    if count == 0:
+        return None
+    
+    return SimulationResult(count, null.total, observed, de_novos_count,
+        stopping='max_iterations').p_value
+
+def get_p_value(transcript, rates, iterations, consequence, de_novos, threads=1,
+        target_rse=None, seed=None, stream=0, cache=None):
     """ find the probability of getting de novos with a mean conservation
     
     The probability is the number of simulations where the mean conservation
@@ -15,12 +143,19 @@ def get_p_value(transcript, rates, iterations, consequence, de_novos):
         transcript: Transcript object for the current gene.
         rates: SiteRates object, which contains WeightedChoice entries for
             different consequence categories.
-        iterations: number of simulations to perform
+        iterations: maximum number of simulations to perform
         consequence: string to indicate the consequence type e.g. "missense, or
             "lof", "synonymous" etc. The full list is "missense", "nonsense",
             "synonymous", "lof", "loss_of_function", "splice_lof",
             "splice_region".
         de_novos: list of de novos within a gene
+        threads: number of threads to split the simulations across
+        target_rse: relative standard error at which to stop simulating. If
+            None, this stops after 1000 simulations as clustered as observed.
+        seed: integer seed, so the simulations can be repeated, or None.
+        stream: number of an independent random number stream for the seed.
+        cache: NullCache object, to reuse simulated null distributions from
+            earlier runs, or None to always simulate.
     
     Returns:
         tuple of mean proximity for the observed de novos and probability of
@@ -28,22 +163,83 @@ def get_p_value(transcript, rates, iterations, consequence, de_novos):
         null distribution.
     """
     
-    if len(de_novos) < 2:
-        return (float('nan'), float('nan'))
+    return get_p_values(transcript, rates, iterations, consequence, [de_novos],
+        threads, target_rse, seed, stream, cache)[0]
+
+def get_p_values(transcript, rates, iterations, consequence, de_novo_sets,
+        threads=1, target_rse=None, seed=None, stream=0, cache=None):
+    """ find clustering probabilities for several sets of de novos in a gene
+    
+    This is get_p_value() for several sets of de novos at once, e.g. the de
+    novos in different phenotype subsets of a cohort. Sets with the same number
+    of de novos share one stream of simulations, so the simulations are only
+    run once per de novo count. Each set gets the same result as from
+    get_p_value().
+    
+    Args:
+        transcript: Transcript object for the current gene.
+        rates: SiteRates object, which contains WeightedChoice entries for
+            different consequence categories.
+        iterations: maximum number of simulations to perform
+        consequence: string to indicate the consequence type e.g. "missense"
+        de_novo_sets: list of lists of de novos within a gene
+        threads: number of threads to split the simulations across
+        target_rse: relative standard error at which to stop simulating.
+        seed: integer seed, so the simulations can be repeated, or None.
+        stream: number of an independent random number stream for the seed.
+        cache: NullCache object, to reuse simulated null distributions from
+            earlier runs, or None to always simulate.
+    
+    Returns:
+        list of (mean proximity, probability) tuples, one per de novo set.
+    """
+    
+    results = [ (float('nan'), float('nan')) ] * len(de_novo_sets)
+    if all( len(x) < 2 for x in de_novo_sets ):
+        return results
     
     rename = {"lof": "loss_of_function"}
     if consequence in rename:
         consequence = rename[consequence]
     
-    weights = rates[consequence]
-    
-    cds_positions = [ transcript.chrom_pos_to_cds(x)['pos'] for x in de_novos ]
-    distances = get_distances(cds_positions)
-    observed = geomean(distances)
+    # the simulations only need positions, so merge alternates at each site
+    weights = rates.collapsed(consequence)
+    exceedances = 1000 if target_rse is None else get_exceedances(target_rse)
     
-    # call a cython wrapped C++ library to handle the simulations
-    sim_prob = analyse_de_novos(weights, iterations, len(de_novos), observed)
+    # group the sets needing simulations by the number of de novos
+    pending = {}
+    for i, de_novos in enumerate(de_novo_sets):
+        if len(de_novos) < 2:
+            continue
+        
+        cds_positions = [ transcript.chrom_pos_to_cds(x)['pos'] for x in de_novos ]
+        distances = get_distances(cds_positions)
+        observed = geomean(distances)
+        
+        # two de novos have an exact null distribution, otherwise use a cached
+        # null distribution if possible
+        sim_prob = None
+        if len(de_novos) == 2:
+            sim_prob = two_de_novo_p_value(weights, distances[0])
+        
+        if sim_prob is None and cache is not None and \
+                not can_enumerate(weights, iterations, len(de_novos)):
+            sim_prob = cached_p_value(cache, weights, iterations, len(de_novos),
+                observed, exceedances, threads, seed, stream,
+                transcript.get_name(), consequence)
+        
+        if sim_prob is None:
+            pending.setdefault(len(de_novos), []).append((i, observed))
+        
+        results[i] = ("{0:0.1f}".format(observed), sim_prob)
     
-    observed = "{0:0.1f}".format(observed)
+    # call a cython wrapped C++ library to handle the simulations, with one
+    # run for all the sets with the same number of de novos
+    for count, sets in pending.items():
+        indices, observed = zip(*sets)
+        probs = analyse_de_novos_many(weights, iterations, count, list(observed),
+            threads, exceedances=exceedances, seed=seed, stream=stream)
+        for i, prob in zip(indices, probs):
+            results[i] = (results[i][0], prob)
     
-    return (observed, sim_prob)
+    return results
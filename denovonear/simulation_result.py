@@ -0,0 +1,207 @@
+""" record of the simulations behind a clustering p-value, so that partial runs
+can be stored, and merged with other runs for the same de novos.
+"""
+
+from __future__ import division
+
+import math
+
+class SimulationResult(object):
+    """ counts from analysing how clustered a set of de novos is
+    
+    Simulation results for the same de novos can be summed (a + b), e.g. to
+    combine short jobs run on different machines, or to top up a borderline
+    gene with more simulations. Only runs which used all their iterations can
+    be summed, since runs stopped by the Besag-Clifford rule would bias the
+    merged count. Runs must share a seed, and runs from the same stream must
+    cover different simulations, i.e. start where the other run ended (see
+    next_start). Merged runs keep the simulations covered in each stream, so
+    this is checked however the runs are combined.
+    """
+    
+    def __init__(self, count, iterations, observed, de_novos_count,
+            method='simulation', stopping='max_iterations', seed=None,
+            stream=0, start=0, p_value=None, std_error=None, ranges=None,
+            streams=None):
+        """ set up the record
+        
+        Args:
+            count: number of simulations at or below the observed value.
+            iterations: number of simulations (or importance sampling draws).
+            observed: geometric mean distance for the observed de novos.
+            de_novos_count: number of de novos per simulation.
+            method: "simulation", "enumeration" or "importance_sampling".
+            stopping: why the run stopped, "besag_clifford", "max_iterations",
+                "exhaustive", or "merged" for summed results.
+            seed: integer seed for the simulations, or None if unseeded.
+            stream: number of the random number stream for the seed, or None
+                for merged runs from different streams.
+            start: number of the first simulation within the stream.
+            p_value: probability for methods other than simulation, where it
+                can't be found from the counts.
+            std_error: standard error for methods other than simulation.
+            ranges: list of [first, last) simulation numbers within the stream
+                covered by merged runs, used instead of start.
+            streams: dictionary of ranges covered in each stream, for merged
+                runs from several streams, used instead of stream and ranges.
+        """
+        
+        self.count = count
+        self.iterations = iterations
+        self.observed = observed
+        self.de_novos_count = de_novos_count
+        self.method = method
+        self.stopping = stopping
+        self.seed = seed
+        if streams is None:
+            if ranges is None:
+                ranges = [[start, start + iterations]]
+            streams = {} if stream is None else {stream: ranges}
+        self.streams = dict( (k, [ list(x) for x in v ]) for k, v in streams.items() )
+        self._p_value = p_value
+        self._std_error = std_error
+    
+    @property
+    def p_value(self):
+        """ probability of de novos clustering at least as tightly as observed
+        """
+        if self.method != 'simulation':
+            return self._p_value
+        
+        # Besag-Clifford stopping estimates the probability as the exceedance
+        # count over the simulations run. Otherwise count the observed set too.
+        if self.stopping == 'besag_clifford':
+            return self.count / self.iterations
+        
+        return (1 + self.count) / (1 + self.iterations)
+    
+    @property
+    def std_error(self):
+        """ standard error of the p-value
+        """
+        if self.method != 'simulation':
+            return self._std_error
+        
+        p_value = self.p_value
+        return math.sqrt(p_value * (1 - p_value) / max(self.iterations, 1))
+    
+    @property
+    def stream(self):
+        """ number of the random number stream, or None if the run merged
+        simulations from several streams
+        """
+        if len(self.streams) != 1:
+            return None
+        return list(self.streams)[0]
+    
+    @property
+    def ranges(self):
+        """ list of [first, last) simulation numbers covered within the stream,
+        or an empty list if the run used several streams
+        """
+        if self.stream is None:
+            return []
+        return self.streams[self.stream]
+    
+    @property
+    def start(self):
+        """ number of the first simulation within the stream
+        """
+        if len(self.ranges) == 0:
+            return None
+        return self.ranges[0][0]
+    
+    @property
+    def next_start(self):
+        """ number of the simulation after the last one in this run, from which
+        to continue the stream when topping up the simulations
+        """
+        if len(self.ranges) == 0:
+            return None
+        return self.ranges[-1][1]
+    
+    def __add__(self, other):
+        """ merge the counts from two simulation runs for the same de novos
+        """
+        
+        if self.method != 'simulation' or other.method != 'simulation':
+            raise ValueError("only simulation results can be merged")
+        
+        for result in [self, other]:
+            if result.stopping not in ['max_iterations', 'merged']:
+                raise ValueError("can't merge results which stopped early "
+                    "({})".format(result.stopping))
+        
+        if self.observed != other.observed or \
+                self.de_novos_count != other.de_novos_count:
+            raise ValueError("can't merge results for different de novos")
+        
+        if self.seed != other.seed:
+            raise ValueError("can't merge results from different seeds")
+        
+        # unseeded runs draw fresh entropy, so never share simulations, and
+        # can't be topped up
+        streams = {}
+        if self.seed is not None:
+            for stream in set(self.streams) | set(other.streams):
+                joined = self.streams.get(stream, []) + other.streams.get(stream, [])
+                streams[stream] = self._join(joined)
+        
+        return SimulationResult(self.count + other.count,
+            self.iterations + other.iterations, self.observed,
+            self.de_novos_count, stopping='merged', seed=self.seed,
+            streams=streams)
+    
+    @staticmethod
+    def _join(ranges):
+        """ join ranges of simulations from one stream, which must not overlap
+        """
+        
+        joined = []
+        for first, last in sorted(ranges):
+            if len(joined) > 0 and first < joined[-1][1]:
+                raise ValueError("results share simulations from the same stream")
+            if len(joined) > 0 and first == joined[-1][1]:
+                joined[-1][1] = last
+            else:
+                joined.append([first, last])
+        
+        return joined
+    
+    def __eq__(self, other):
+        return isinstance(other, SimulationResult) and \
+            self.to_dict() == other.to_dict()
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return 'SimulationResult(p_value={}, method={}, stopping={}, ' \
+            'count={}, iterations={})'.format(self.p_value, self.method,
+            self.stopping, self.count, self.iterations)
+    
+    def to_dict(self):
+        """ convert the record to a dictionary, e.g. to store as JSON
+        """
+        return {'count': self.count, 'iterations': self.iterations,
+            'observed': self.observed, 'de_novos_count': self.de_novos_count,
+            'method': self.method, 'stopping': self.stopping,
+            'seed': self.seed, 'streams': sorted(self.streams.items()),
+            'p_value': self.p_value, 'std_error': self.std_error}
+    
+    @classmethod
+    def from_dict(cls, data):
+        """ construct a record from a dictionary made by to_dict()
+        """
+        
+        data = dict(data)
+        if 'streams' in data:
+            # JSON has no integer keys, so the streams are stored as pairs
+            data['streams'] = dict( (k, v) for k, v in data['streams'] )
+        
+        if data.get('method', 'simulation') == 'simulation':
+            # simulation probabilities come from the counts
+            data.pop('p_value', None)
+            data.pop('std_error', None)
+        
+        return cls(**data)
@@ -4,39 +4,121 @@
 from libcpp.vector cimport vector
 from libcpp.string cimport string
 from libcpp cimport bool
+from libcpp.memory cimport shared_ptr
 from cython.operator cimport dereference as deref
 
 from denovonear.weights cimport Chooser, WeightedChoice
 from denovonear.transcript cimport Tx, Transcript, Region
 
+cdef extern from "mutation_rates.h":
+    cdef cppclass _MutationRates "MutationRates":
+        _MutationRates(vector[vector[string]]) except +
+        int get_kmer_length()
+        double get_rate(string, string)
+
 cdef extern from "site_rates.h":
     cdef cppclass SitesChecks:
-        SitesChecks(Tx, vector[vector[string]], bool) except +
-        SitesChecks(Tx, vector[vector[string]], bool, Tx) except +
+        SitesChecks(Tx, _MutationRates &, bool, vector[string]) except + nogil
+        SitesChecks(Tx, _MutationRates &, bool, Tx, vector[string]) except + nogil
         
         void initialise_choices()
-        Chooser * __getitem__(string) except +
+        void clear()
+        shared_ptr[Chooser] __getitem__(string) except +
+        Chooser collapsed(string) except +
+        double get_summed_rate(string)
         
         void check_position(int)
         string check_consequence(string, string, int)
     
     cdef Region _get_gene_range(Tx)
     cdef string _get_mutated_aa(Tx, string, string, int) except +
+    
+    cdef struct CodonChange:
+        char mutated_aa
+        int consequence
+    cdef CodonChange _get_codon_change(string, int, string) except +
+
+CODON_CONSEQUENCES = ['synonymous', 'missense', 'nonsense']
+CATEGORIES = ['missense', 'nonsense', 'synonymous', 'splice_lof',
+    'splice_region', 'loss_of_function']
+
+cdef class MutationRates:
+    ''' table of sequence context mutation rates, parsed once and shared
+    
+    The rates are held in a dense array indexed by the encoded sequence
+    context and alternate base, so the table only needs parsing once, however
+    many transcripts we construct SiteRates for.
+    '''
+    cdef _MutationRates *thisptr  # hold a C++ instance which we're wrapping
+    def __cinit__(self, vector[vector[string]] rates):
+        self.thisptr = new _MutationRates(rates)
+    
+    def __dealloc__(self):
+        del self.thisptr
+    
+    @property
+    def kmer_length(self):
+        return self.thisptr.get_kmer_length()
+    
+    def get_rate(self, seq, alt):
+        ''' get the rate for mutating the middle base of a sequence context
+        
+        Args:
+            seq: sequence context, centered on the mutated base e.g. 'AGA'
+            alt: alternate base for the middle position e.g. 'T'
+        
+        Returns:
+            mutation rate, or zero if the sequence isn't in the table
+        '''
+        return self.thisptr.get_rate(seq.encode('utf8'), alt.encode('utf8'))
 
 cdef class SiteRates:
     cdef SitesChecks *_checks  # hold a C++ instance which we're wrapping
-    def __cinit__(self, Transcript transcript, vector[vector[string]] rates,
-            Transcript masked_sites=None, cds_coords=True):
+    cdef MutationRates _rates  # keep the rates table alive as long as we use it
+    def __cinit__(self, Transcript transcript, rates,
+            Transcript masked_sites=None, cds_coords=True, categories=None):
+        ''' find the site-specific mutation rates for a transcript
+        
+        Args:
+            transcript: Transcript object, with genomic sequence
+            rates: MutationRates object, or list of [initial, changed, rate]
+            masked_sites: Transcript object for sites to skip, or None
+            cds_coords: whether to give sites in CDS coordinates, rather than
+                genomic coordinates.
+            categories: consequence categories to build site rates for, or
+                None for all categories. Other categories are built if they
+                are requested later. Summed rates are available for every
+                category, so use [] if only the summed rates are needed.
+        '''
         
         if transcript is None:
             raise ValueError('no transcript supplied')
         
-        if masked_sites is None:
-            self._checks = new SitesChecks(deref(transcript.thisptr), rates,
-                cds_coords)
-        else:
-            self._checks = new SitesChecks(deref(transcript.thisptr), rates,
-                cds_coords, deref(masked_sites.thisptr))
+        # allow lists of [initial, changed, rate] rows, but it is quicker to
+        # share one MutationRates object between transcripts
+        if not isinstance(rates, MutationRates):
+            rates = MutationRates(rates)
+        self._rates = rates
+        
+        cdef _MutationRates * mut = self._rates.thisptr
+        cdef Tx * tx = transcript.thisptr
+        cdef Tx * mask = NULL
+        if masked_sites is not None:
+            mask = masked_sites.thisptr
+        cdef bool use_cds = cds_coords
+        if categories is None:
+            categories = CATEGORIES
+        cdef vector[string] wanted = [ x.encode('utf8') for x in categories ]
+        
+        # walk the transcript without the GIL, so that rates for multiple
+        # transcripts can be constructed on separate threads at once
+        with nogil:
+            if mask == NULL:
+                self._checks = new SitesChecks(deref(tx), deref(mut), use_cds,
+                    wanted)
+            else:
+                self._checks = new SitesChecks(deref(tx), deref(mut), use_cds,
+                    deref(mask), wanted)
     
     def __dealloc__(self):
         del self._checks
@@ -53,18 +135,55 @@ cdef class SiteRates:
             A WeightedChoice object for the CDS, where each position is paired
             with its mutation rate. We can then randomly sample sites from the
             CDS WeightedChoice object according to the probability of each site
-            being mutated to the specific consequence type.
+            being mutated to the specific consequence type. This shares the
+            sites with the SiteRates object rather than copying them. The sites
+            are copied first if either side later changes them.
         '''
         
-        cdef Chooser * chooser = self._checks.__getitem__(category.encode('utf8'))
+        cdef WeightedChoice choices = WeightedChoice()
+        choices._share(self._checks.__getitem__(category.encode('utf8')))
+        
+        return choices
+    
+    def collapsed(self, category):
+        ''' get position-level mutation rates for a consequence type
+        
+        The rates for all alternates at the same CDS position and offset are
+        summed into one site. This is the sampler the clustering simulations
+        use, since they only need positions. Use rates[category] for ref and
+        alt alleles.
+        
+        Args:
+            category: string to indicate the consequence type, as for
+                __getitem__().
+        
+        Returns:
+            A WeightedChoice object with one site per CDS position and offset.
+        '''
         
         choices = WeightedChoice()
-        choices.thisptr.append(deref(chooser))
+        choices.thisptr.append(self._checks.collapsed(category.encode('utf8')))
         
         return choices
     
+    def get_summed_rate(self, category):
+        ''' get the summed mutation rate for a consequence type
+        
+        This is the same as rates[category].get_summed_rate(), but doesn't need
+        the sites for the category to be built.
+        
+        Args:
+            category: string to indicate the consequence type, as for
+                __getitem__().
+        
+        Returns:
+            summed mutation rate across all sites for the consequence type
+        '''
+        
+        return self._checks.get_summed_rate(category.encode('utf8'))
+    
     def clear(self):
-        self._checks.initialise_choices()
+        self._checks.clear()
     
     def check_position(self, bp):
         self._checks.check_position(bp)
@@ -84,3 +203,20 @@ def get_mutated_aa(Transcript tx,  base, codon, intra_codon):
     codon = codon.encode('utf8')
     
     return _get_mutated_aa(deref(tx.thisptr), base, codon, intra_codon).decode('utf8')
+
+def get_codon_change(codon, intra_codon, alt):
+    """ find the outcome of a base change within a codon, from a precomputed table
+    
+    Args:
+        codon: DNA sequence of a single codon e.g. 'AAA'
+        intra_codon: position within the codon to be altered (0-based)
+        alt: alternate base to introduce e.g. 'C'
+    
+    Returns:
+        tuple of the amino acid for the mutated codon, and whether the change is
+        "synonymous", "missense" or "nonsense" e.g. ('N', 'missense')
+    """
+    
+    change = _get_codon_change(codon.encode('utf8'), intra_codon, alt.encode('utf8'))
+    
+    return chr(change.mutated_aa), CODON_CONSEQUENCES[change.consequence]
@@ -20,16 +20,38 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from libcpp.string cimport string
+from libcpp cimport bool
+from libcpp.memory cimport shared_ptr
+from libcpp.vector cimport vector
+from libc.stdint cimport uint64_t
+
+cdef extern from "counter_rng.h":
+    cdef cppclass CounterRng:
+        CounterRng() except +
+        CounterRng(uint64_t, uint64_t) except +
 
 cdef extern from "weighted_choice.h":
     cdef cppclass Chooser:
         Chooser() except +
-        void add_choice(int, double, string, string, int)
+        Chooser(Chooser &) except +
+        void add_choice(int, double, string, string, int) except +
+        void add_choices(int, const int *, const double *, const char *, const char *, const int *) except +
+        void copy_sites(int *, double *, char *, char *, int *)
         AlleleChoice choice()
+        int choice_pos()
+        void choice_many(int, uint64_t, int *, char *, char *, int *) nogil
+        void seed(uint64_t, uint64_t)
+        uint64_t next_seed()
+        void prepare()
+        void prepare_logs()
+        const vector[double] & distance_logs() nogil
         double get_summed_rate()
         int len()
         AlleleChoice iter(int)
         void append(Chooser)
+        Chooser collapsed()
+        void use_alias(bool)
+        bool uses_alias()
     
     cdef struct AlleleChoice:
         int pos
@@ -40,4 +62,10 @@ cdef extern from "weighted_choice.h":
 
 cdef class WeightedChoice:
     cdef int pos
+    cdef int _busy  # count of simulations currently running without the GIL
+    cdef shared_ptr[Chooser] _shared  # owns the Chooser, which may be shared
     cdef Chooser *thisptr # hold a C++ instance which we're wrapping
+    cdef void _share(self, shared_ptr[Chooser] chooser)
+    cdef void _make_unique(self) except *
+    cdef Chooser * _acquire(self, int de_novos_count=*)
+    cdef void _release(self)
@@ -20,17 +20,52 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 from libcpp.vector cimport vector
+from libcpp.string cimport string
 from libcpp cimport bool
+from libcpp.memory cimport shared_ptr, make_shared
 from cython.operator cimport dereference as deref
 
+import numpy
+
+from denovonear.simulation_result import SimulationResult
+
+def _allele_codes(alleles, length):
+    ''' convert a sequence of single base alleles to an array of ASCII codes
+    '''
+    alleles = numpy.asarray(alleles)
+    if len(alleles) != length:
+        raise ValueError("allele array length differs from positions")
+    if length > 0 and numpy.char.str_len(alleles).max() > 1:
+        raise TypeError("requires single base alleles")
+    
+    if alleles.dtype == numpy.dtype('U1'):
+        # avoid a slow string conversion, non-ASCII characters become 'N'
+        codes = alleles.view(numpy.uint32)
+        return numpy.where(codes < 128, codes, 0).astype(numpy.uint8)
+    
+    return numpy.ascontiguousarray(alleles.astype('S1').view(numpy.uint8))
+
 cdef class WeightedChoice:
-    def __cinit__(self):
-        self.thisptr = new Chooser()
+    def __cinit__(self, alias=True, seed=None, stream=0):
+        ''' construct a weighted random sampler
+        
+        Args:
+            alias: whether to draw sites from a Walker/Vose alias table, which
+                costs O(1) per draw. Otherwise sites are drawn by a binary
+                search of the cumulative probabilities. Both sample from the
+                same distribution.
+            seed: integer seed for the draws from choice(), choice_with_alleles()
+                and choice_many(), so they can be repeated. Fresh entropy is
+                used if this is None.
+            stream: number of an independent random number stream for the seed.
+        '''
+        self._shared = make_shared[Chooser]()
+        self.thisptr = self._shared.get()
+        self.thisptr.use_alias(alias)
+        if seed is not None:
+            self.thisptr.seed(seed, stream)
         self.pos = 0
-    
-    def __dealloc__(self):
-        if self.thisptr is not NULL:
-            del self.thisptr
+        self._busy = 0
     
     def __len__(self):
         return self.thisptr.len()
@@ -49,6 +84,35 @@ cdef class WeightedChoice:
         return {"pos": iter.pos, "ref": iter.ref.decode('utf8'),
             "alt": iter.alt.decode('utf8'), 'prob': iter.prob, "offset": iter.offset}
     
+    def to_arrays(self):
+        """ export the sites as numpy arrays, the inverse of from_arrays()
+        
+        Returns:
+            dictionary of arrays with one entry per site, for "pos" (int32),
+            "prob" (float64), "ref" and "alt" (single byte strings, where
+            unknown alleles are b'N') and "offset" (int32).
+        """
+        
+        length = len(self)
+        arrays = {'pos': numpy.empty(length, dtype=numpy.intc),
+            'prob': numpy.empty(length, dtype=numpy.double),
+            'ref': numpy.empty(length, dtype='S1'),
+            'alt': numpy.empty(length, dtype='S1'),
+            'offset': numpy.empty(length, dtype=numpy.intc)}
+        if length == 0:
+            return arrays
+        
+        cdef int[::1] sites = arrays['pos']
+        cdef double[::1] weights = arrays['prob']
+        cdef unsigned char[::1] refs = arrays['ref'].view(numpy.uint8)
+        cdef unsigned char[::1] alts = arrays['alt'].view(numpy.uint8)
+        cdef int[::1] offsets = arrays['offset']
+        
+        self.thisptr.copy_sites(&sites[0], &weights[0], <char *>&refs[0],
+            <char *>&alts[0], &offsets[0])
+        
+        return arrays
+    
     def append(self, WeightedChoice other):
         ''' combines the sites from two WeightedChoice objects
     
@@ -58,17 +122,96 @@ cdef class WeightedChoice:
         Args:
             other: WeightedChoice object
         '''
-    
+        
+        self._check_unlocked()
+        self._make_unique()
         self.thisptr.append(deref(other.thisptr))
     
+    def collapse(self):
+        ''' sum the rates for alternates sharing a position and offset
+        
+        Returns:
+            new WeightedChoice object with one site per position and offset,
+            where the alt allele is 'N'. This is all the clustering simulations
+            need, and is about a third the size for missense sites.
+        '''
+        
+        merged = WeightedChoice(self.alias)
+        merged.thisptr.append(self.thisptr.collapsed())
+        
+        return merged
+    
+    @classmethod
+    def from_arrays(cls, positions, probs, refs=None, alts=None, offsets=None,
+            alias=True):
+        """ construct a sampler from arrays of sites in a single pass
+        
+        This is much quicker than calling add_choice() for every site, since
+        space is reserved once, and the cumulative rates are built together.
+        
+        Args:
+            positions: array of site positions, as anything numpy can convert
+                to 32-bit integers.
+            probs: array of site mutation rates.
+            refs: array of single base reference alleles (str or bytes), or
+                None to use 'N' for every site.
+            alts: array of single base alternate alleles, or None.
+            offsets: array of offsets from the CDS position, or None for zero.
+            alias: whether to draw sites from an alias table.
+        
+        Returns:
+            new WeightedChoice object
+        """
+        
+        cdef const int[::1] sites = numpy.ascontiguousarray(positions, dtype=numpy.intc)
+        cdef const double[::1] weights = numpy.ascontiguousarray(probs, dtype=numpy.double)
+        cdef const unsigned char[::1] ref_codes
+        cdef const unsigned char[::1] alt_codes
+        cdef const int[::1] site_offsets
+        cdef const char * ref_ptr = NULL
+        cdef const char * alt_ptr = NULL
+        cdef const int * offset_ptr = NULL
+        
+        length = len(sites)
+        if len(weights) != length:
+            raise ValueError("probs array length differs from positions")
+        
+        if refs is not None:
+            ref_codes = _allele_codes(refs, length)
+        if alts is not None:
+            alt_codes = _allele_codes(alts, length)
+        if offsets is not None:
+            site_offsets = numpy.ascontiguousarray(offsets, dtype=numpy.intc)
+            if len(site_offsets) != length:
+                raise ValueError("offsets array length differs from positions")
+        
+        choices = cls(alias)
+        if length == 0:
+            return choices
+        
+        if refs is not None:
+            ref_ptr = <const char *>&ref_codes[0]
+        if alts is not None:
+            alt_ptr = <const char *>&alt_codes[0]
+        if offsets is not None:
+            offset_ptr = &site_offsets[0]
+        
+        (<WeightedChoice>choices).thisptr.add_choices(length, &sites[0],
+            &weights[0], ref_ptr, alt_ptr, offset_ptr)
+        
+        return choices
+    
     def add_choice(self, site, prob, ref='N', alt='N', offset=0):
         """ add another possible choice for selection
         
         Args:
             site: a CDS position of the selected base.
             prob: probability of selecting this base.
-            ref: string for reference allele
+            ref: string for reference allele. Alleles other than A, C, G or T
+                are stored as N.
             alt: string for alternate allele
+            offset: bases the site is offset from the CDS position, between
+                -128 and 127.
         """
         
         ref = ref.encode('utf8')
@@ -77,6 +220,8 @@ cdef class WeightedChoice:
         if len(ref) > 1 or len(alt) > 1:
             raise TypeError("requires single base alleles: {}, {}".format(ref, alt))
         
+        self._check_unlocked()
+        self._make_unique()
         self.thisptr.add_choice(site, prob, ref, alt, offset)
     
     def choice(self):
@@ -86,7 +231,69 @@ cdef class WeightedChoice:
             the name of the randomly selected element (e.g. position)
         """
         
-        return self.choice_with_alleles()["pos"]
+        return self.thisptr.choice_pos()
+    
+    def choice_many(self, n, with_alleles=False, seed=None):
+        """ chooses many random elements at once
+        
+        Args:
+            n: number of elements to choose
+            with_alleles: whether to return the alleles and offsets as well as
+                the positions.
+            seed: integer seed for the draws, so they can be repeated. If this
+                is None, the seed is drawn from the object's own generator.
+        
+        Returns:
+            numpy array of chosen positions, or if with_alleles is True, a
+            structured array with "pos", "ref", "alt" and "offset" fields.
+        """
+        
+        if n < 0:
+            raise ValueError("can't choose a negative number of elements")
+        if seed is None:
+            seed = self.thisptr.next_seed()
+        
+        cdef int count = n
+        cdef uint64_t rng_seed = seed
+        cdef int[::1] sites = numpy.empty(count, dtype=numpy.intc)
+        cdef unsigned char[::1] refs
+        cdef unsigned char[::1] alts
+        cdef int[::1] offsets
+        cdef char * ref_ptr = NULL
+        cdef char * alt_ptr = NULL
+        cdef int * offset_ptr = NULL
+        cdef Chooser * chooser
+        
+        if with_alleles:
+            refs = numpy.empty(count, dtype=numpy.uint8)
+            alts = numpy.empty(count, dtype=numpy.uint8)
+            offsets = numpy.empty(count, dtype=numpy.intc)
+        
+        if count > 0:
+            if with_alleles:
+                ref_ptr = <char *>&refs[0]
+                alt_ptr = <char *>&alts[0]
+                offset_ptr = &offsets[0]
+            
+            chooser = self._acquire()
+            try:
+                with nogil:
+                    chooser.choice_many(count, rng_seed, &sites[0], ref_ptr,
+                        alt_ptr, offset_ptr)
+            finally:
+                self._release()
+        
+        if not with_alleles:
+            return numpy.asarray(sites)
+        
+        chosen = numpy.empty(count, dtype=[('pos', numpy.intc), ('ref', 'S1'),
+            ('alt', 'S1'), ('offset', numpy.intc)])
+        chosen['pos'] = sites
+        chosen['ref'] = numpy.asarray(refs).view('S1')
+        chosen['alt'] = numpy.asarray(alts).view('S1')
+        chosen['offset'] = offsets
+        
+        return chosen
     
     def choice_with_alleles(self):
         """ chooses a random element, but include alleles in output
@@ -101,18 +308,97 @@ cdef class WeightedChoice:
         return {"pos": choice.pos, "ref": choice.ref.decode('utf8'),
             "alt": choice.alt.decode('utf8'), "offset": choice.offset}
     
+    def _check_unlocked(self):
+        ''' make sure the sites are not changed while simulations use them
+        '''
+        if self._busy > 0:
+            raise RuntimeError("can't modify WeightedChoice during a simulation")
+    
+    cdef void _share(self, shared_ptr[Chooser] chooser):
+        ''' view a Chooser held elsewhere (e.g. by SiteRates), without copying
+        '''
+        self._shared = chooser
+        self.thisptr = self._shared.get()
+    
+    cdef void _make_unique(self) except *:
+        ''' copy the sites before changing them, if they are shared
+        '''
+        if self._shared.use_count() > 1:
+            self._shared = make_shared[Chooser](deref(self.thisptr))
+            self.thisptr = self._shared.get()
+    
+    cdef Chooser * _acquire(self, int de_novos_count=0):
+        ''' prepare the sampler for use by simulations which release the GIL
+        
+        This builds any lazily constructed sampler state while the GIL is
+        still held, so concurrent simulations only read from the Chooser.
+        Simulations of many de novos also need the table of distance logs,
+        which is kept until the sites change. Every call must be paired with
+        a call to _release().
+        '''
+        self.thisptr.prepare()
+        if de_novos_count >= LARGE_DE_NOVO_COUNT:
+            self.thisptr.prepare_logs()
+        self._busy += 1
+        return self.thisptr
+    
+    cdef void _release(self):
+        self._busy -= 1
+    
+    @property
+    def alias(self):
+        ''' whether sites are drawn via an alias table or binary search
+        '''
+        return self.thisptr.uses_alias()
+    
+    @alias.setter
+    def alias(self, value):
+        self._check_unlocked()
+        self._make_unique()
+        self.thisptr.use_alias(value)
+    
     def get_summed_rate(self):
         """ return the cumulative probability for the object
         """
         return self.thisptr.get_summed_rate()
 
 cdef extern from "simulate.h":
+    cdef struct AnalysisResult:
+        double p_value
+        double std_error
+        string method
+        string stopping
+        long long iterations
+        long long count
+    
+    cdef struct Estimate:
+        double p_value
+        double std_error
+    
     vector[int] _get_distances(vector[int])
     bool _has_zero(vector[int])
     double _geomean(vector[int])
+    double _geomean_of_sites(vector[int])
+    double _geomean_of_sites(vector[int], vector[double])
+    vector[double] _distance_logs(int, int)
+    int LARGE_DE_NOVO_COUNT
     bool _halt_permutation(double, int, double, double)
-    vector[double] _simulate_distribution(Chooser, int, int)
-    double _analyse_de_novos(Chooser, int, int, double)
+    vector[double] _simulate_distribution(Chooser, int, int, int, CounterRng, long long) except + nogil
+    int _count_simulations(Chooser, int, int, double, int, CounterRng, long long) except + nogil
+    void _collapse_sites(Chooser, vector[int], vector[double])
+    double _count_multisets(int, int, double)
+    Estimate _importance_sample(vector[int], vector[double], int, int, double, int, CounterRng, const vector[double] &) except + nogil
+    AnalysisResult _analyse_de_novos(Chooser, int, int, double, int, int, CounterRng, long long, bool) except + nogil
+    vector[AnalysisResult] _analyse_many(Chooser, int, int, vector[double], int, int, CounterRng, long long, bool) except + nogil
+
+cdef CounterRng _get_rng(seed, stream):
+    ''' get the random number generator for a seed and stream
+    
+    Without a seed, the generator starts from fresh entropy.
+    '''
+    if seed is None:
+        return CounterRng()
+    return CounterRng(seed, stream)
 
 def get_distances(vector[int] positions):
     """ gets the distances between two or more CDS positions
@@ -144,14 +430,315 @@ def geomean(vector[int] distances):
     
     return _geomean(distances)
 
-def simulate_distribution(WeightedChoice choices, int iterations, int de_novos_count):
+def geomean_of_sites(vector[int] positions, tabulate=False):
+    """ gets the geometric mean distance between all pairs of CDS positions
+    
+    This gives the same value as geomean(get_distances(positions)), but without
+    constructing the list of distances.
+    
+    Args:
+        positions: list of CDS positions as ints
+        tabulate: whether to look up the logs of the distances in a table, as
+            the simulations do for large numbers of de novos. The value is the
+            same either way.
+    
+    Returns:
+        provides the mean distance of the pairwise distances
     """
+    
+    cdef vector[double] logs
+    if tabulate and positions.size() > 0:
+        span = max(positions) - min(positions)
+        logs = _distance_logs(span, max(positions.size(), LARGE_DE_NOVO_COUNT))
+    
+    return _geomean_of_sites(positions, logs)
+
+cdef class _DoubleBuffer:
+    ''' expose a C++ vector of doubles through the buffer protocol
+    
+    numpy.asarray() on this gives an array backed by the vector, which stays
+    alive for as long as the array references this object.
+    '''
+    cdef vector[double] data
+    cdef Py_ssize_t shape[1]
+    cdef Py_ssize_t strides[1]
+    
+    def __getbuffer__(self, Py_buffer * buffer, int flags):
+        self.shape[0] = self.data.size()
+        self.strides[0] = sizeof(double)
+        buffer.buf = <char *>self.data.data()
+        buffer.format = 'd'
+        buffer.internal = NULL
+        buffer.itemsize = sizeof(double)
+        buffer.len = self.shape[0] * sizeof(double)
+        buffer.ndim = 1
+        buffer.obj = self
+        buffer.readonly = 0
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+    
+    def __releasebuffer__(self, Py_buffer * buffer):
+        pass
+
+def simulate_distribution(WeightedChoice choices, int iterations, int de_novos_count,
+        int threads=1, as_array=False, seed=None, stream=0, long long start=0):
+    """ simulate the null distribution of mean distances between de novos
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: number of simulations to run
+        de_novos_count: number of de novos to sample per simulation
+        threads: number of threads to split the simulations across
+        as_array: whether to return a numpy array which wraps the simulated
+            values directly, rather than copying them into a list.
+        seed: integer seed, so the simulations can be repeated. Fresh entropy
+            is used if this is None.
+        stream: number of an independent random number stream for the seed.
+        start: number of the first simulation within the stream. Every
+            simulation draws from its own block of the stream, so runs
+            starting at consecutive offsets give the same simulations as one
+            longer run.
+    
+    Returns:
+        sorted list (or numpy array) of geometric mean distances, one per
+        simulation
     """
     
-    return _simulate_distribution(deref(choices.thisptr), iterations, de_novos_count)
+    cdef CounterRng rng = _get_rng(seed, stream)
+    cdef Chooser * chooser = choices._acquire(de_novos_count)
+    cdef vector[double] dist
+    try:
+        with nogil:
+            dist = _simulate_distribution(deref(chooser), iterations,
+                de_novos_count, threads, rng, start)
+    finally:
+        choices._release()
+    
+    cdef _DoubleBuffer buffer
+    if as_array:
+        buffer = _DoubleBuffer()
+        buffer.data.swap(dist)
+        return numpy.asarray(buffer)
+    
+    return dist
 
-def analyse_de_novos(WeightedChoice choices, int iterations, int de_novos_count, double observed_value):
+def count_simulations(WeightedChoice choices, int iterations, int de_novos_count,
+        double observed_value, int threads=1, seed=None, stream=0, long long start=0):
+    """ count simulated mean distances at or below an observed mean distance
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: number of simulations to run
+        de_novos_count: number of de novos to sample per simulation
+        observed_value: geometric mean distance for the observed de novos
+        threads: number of threads to split the simulations across
+        seed: integer seed, so the simulations can be repeated. Fresh entropy
+            is used if this is None.
+        stream: number of an independent random number stream for the seed.
+        start: number of the first simulation within the stream. Every
+            simulation draws from its own block of the stream, so runs
+            starting at consecutive offsets give the same simulations as one
+            longer run, so counts from shards of the iterations can be summed.
+    
+    Returns:
+        number of simulations with mean distance <= observed_value
     """
+    
+    cdef CounterRng rng = _get_rng(seed, stream)
+    cdef Chooser * chooser = choices._acquire(de_novos_count)
+    cdef int count
+    try:
+        with nogil:
+            count = _count_simulations(deref(chooser), iterations,
+                de_novos_count, observed_value, threads, rng, start)
+    finally:
+        choices._release()
+    
+    return count
+
+def importance_sample(WeightedChoice choices, int iterations, int de_novos_count,
+        double observed_value, int threads=1, seed=None, stream=0):
+    """ estimate a small clustering probability by importance sampling
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: number of draws to run
+        de_novos_count: number of de novos to sample per draw
+        observed_value: geometric mean distance for the observed de novos
+        threads: number of threads to split the draws across
+        seed: integer seed, so the draws can be repeated. Fresh entropy is
+            used if this is None.
+        stream: number of an independent random number stream for the seed.
+    
+    Returns:
+        tuple of estimated probability of a mean distance <= observed_value,
+        and the standard error of the estimate.
     """
     
-    return _analyse_de_novos(deref(choices.thisptr), iterations, de_novos_count, observed_value)
+    cdef vector[int] positions
+    cdef vector[double] weights
+    _collapse_sites(deref(choices.thisptr), positions, weights)
+    
+    cdef CounterRng rng = _get_rng(seed, stream)
+    cdef Estimate estimate
+    cdef Chooser * chooser = choices._acquire(de_novos_count)
+    try:
+        with nogil:
+            estimate = _importance_sample(positions, weights, iterations,
+                de_novos_count, observed_value, threads, rng,
+                deref(chooser).distance_logs())
+    finally:
+        choices._release()
+    
+    return (estimate.p_value, estimate.std_error)
+
+def can_enumerate(WeightedChoice choices, int iterations, int de_novos_count):
+    """ check if analyse_de_novos() gives the exact probability by enumerating
+    
+    Enumerating is used when there are no more ways to place the de novos on
+    the distinct sites than the iterations to simulate.
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: number of simulations which would be run instead
+        de_novos_count: number of de novos to place
+    
+    Returns:
+        True if the de novo placements would be enumerated.
+    """
+    
+    cdef vector[int] positions
+    cdef vector[double] weights
+    _collapse_sites(deref(choices.thisptr), positions, weights)
+    
+    if positions.empty():
+        return False
+    
+    return _count_multisets(positions.size(), de_novos_count, iterations) <= iterations
+
+def analyse_de_novos(WeightedChoice choices, int iterations, int de_novos_count,
+        double observed_value, int threads=1, details=False, int exceedances=1000,
+        seed=None, stream=0, start=None):
+    """ estimate the probability of de novos clustering as tightly as observed
+    
+    When the sites are few enough that enumerating every placement of the de
+    novos is cheaper than running the requested iterations, this gives the
+    exact probability, rather than simulating. Otherwise simulations stop once
+    enough are as clustered as observed (Besag-Clifford sequential stopping),
+    which is checked after every small batch. If none of the simulations are as
+    clustered as observed by halfway through the iterations, the rest of the
+    iterations are spent on importance sampling instead.
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: maximum number of simulations and importance sampling
+            draws to run
+        de_novos_count: number of de novos to sample per simulation
+        observed_value: geometric mean distance for the observed de novos
+        threads: number of threads to split the simulations across
+        details: whether to return a SimulationResult, with the p-value, its
+            standard error, the method used ("simulation", "enumeration" or
+            "importance_sampling"), the reason for stopping ("besag_clifford",
+            "max_iterations", or "exhaustive"), the number of draws, and the
+            counts needed to merge simulations with other runs.
+        exceedances: number of simulations at or below the observed value
+            after which to stop simulating. Zero runs all the iterations.
+        seed: integer seed, so the analysis can be repeated. Fresh entropy is
+            used if this is None. A seeded analysis gives the same result for
+            any number of threads.
+        stream: number of an independent random number stream for the seed,
+            e.g. one per gene.
+        start: number of the first simulation within the stream, for
+            splitting runs across jobs. Runs with a start, or with
+            exceedances=0, only simulate, so shards cover consecutive ranges
+            of the stream, and can be merged. Without a start, simulations
+            begin at the start of the stream.
+    
+    Returns:
+        proportion of simulations with mean distance <= observed_value, or a
+        SimulationResult if details are requested.
+    """
+    
+    cdef bool shard = start is not None or exceedances == 0
+    cdef long long first = 0 if start is None else start
+    cdef CounterRng rng = _get_rng(seed, stream)
+    cdef Chooser * chooser = choices._acquire(de_novos_count)
+    cdef AnalysisResult result
+    try:
+        with nogil:
+            result = _analyse_de_novos(deref(chooser), iterations,
+                de_novos_count, observed_value, threads, exceedances, rng,
+                first, shard)
+    finally:
+        choices._release()
+    
+    if details:
+        return _to_record(result, observed_value, de_novos_count, seed, stream, first)
+    
+    return result.p_value
+
+def analyse_de_novos_many(WeightedChoice choices, int iterations, int de_novos_count,
+        observed_values, int threads=1, details=False, int exceedances=1000,
+        seed=None, stream=0, start=None):
+    """ estimate clustering probabilities for many observed values at once
+    
+    This shares one stream of simulations between the observed values, e.g.
+    for the de novos from several phenotype subsets of a cohort. Each value
+    gets the same result as analysing it alone with analyse_de_novos(), but
+    simulations only run until the last of the values stops.
+    
+    Args:
+        choices: WeightedChoice object, to sample sites from
+        iterations: maximum number of simulations and importance sampling
+            draws to run
+        de_novos_count: number of de novos to sample per simulation
+        observed_values: list of geometric mean distances for sets of observed
+            de novos, each with de_novos_count de novos.
+        threads: number of threads to split the simulations across
+        details: whether to return SimulationResult objects, as for
+            analyse_de_novos().
+        exceedances: number of simulations at or below an observed value
+            after which to stop simulating for that value.
+        seed: integer seed, so the analysis can be repeated, or None.
+        stream: number of an independent random number stream for the seed.
+        start: number of the first simulation within the stream, as for
+            analyse_de_novos().
+    
+    Returns:
+        list of probabilities (or SimulationResult objects if details are
+        requested), one per observed value.
+    """
+    
+    cdef vector[double] observed = observed_values
+    cdef bool shard = start is not None or exceedances == 0
+    cdef long long first = 0 if start is None else start
+    cdef CounterRng rng = _get_rng(seed, stream)
+    cdef Chooser * chooser = choices._acquire(de_novos_count)
+    cdef vector[AnalysisResult] results
+    try:
+        with nogil:
+            results = _analyse_many(deref(chooser), iterations,
+                de_novos_count, observed, threads, exceedances, rng, first,
+                shard)
+    finally:
+        choices._release()
+    
+    if details:
+        return [ _to_record(x, y, de_novos_count, seed, stream, first)
+            for x, y in zip(results, observed) ]
+    
+    return [ x.p_value for x in results ]
+
+cdef _to_record(AnalysisResult result, double observed_value, int de_novos_count,
+        seed, stream, long long start):
+    ''' convert an AnalysisResult to a SimulationResult
+    '''
+    method = result.method.decode('utf8')
+    p_value, std_error = None, None
+    if method != 'simulation':
+        p_value, std_error = result.p_value, result.std_error
+    
+    return SimulationResult(result.count, result.iterations, observed_value,
+        de_novos_count, method, result.stopping.decode('utf8'), seed, stream,
+        start, p_value, std_error)
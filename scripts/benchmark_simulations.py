@@ -0,0 +1,87 @@
+""" microbenchmark for the de novo clustering simulations.
+
+Reports the number of simulated iterations per second for a range of de novo
+counts, sampling from a uniformly weighted 10 kb coding sequence.
+
+The script only relies on simulate_distribution(choices, iterations, count),
+which every version of denovonear has, so the same script times older code.
+For a before and after comparison, build an older commit in a separate
+worktree, and run the script with that worktree first on the PYTHONPATH, e.g.
+
+    git worktree add /tmp/before 799ff31
+    (cd /tmp/before && python setup.py build_ext --inplace)
+    PYTHONPATH=/tmp/before python scripts/benchmark_simulations.py
+    python scripts/benchmark_simulations.py
+
+Versions which can count simulations without keeping the distribution also
+report the rate for count_simulations().
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from denovonear.weights import WeightedChoice, simulate_distribution
+
+try:
+    from denovonear.weights import count_simulations
+except ImportError:
+    count_simulations = None
+
+def get_options():
+    """ get the command line options
+    """
+    
+    parser = argparse.ArgumentParser(description="Time the simulations used "
+        "to test de novo clustering.")
+    parser.add_argument("--counts", type=int, nargs="+", default=[2, 5, 20, 100],
+        help="de novo counts to simulate per iteration.")
+    parser.add_argument("--length", type=int, default=10000,
+        help="number of sites to sample from.")
+    parser.add_argument("--seconds", type=float, default=2.0,
+        help="minimum time to spend on each de novo count.")
+    
+    return parser.parse_args()
+
+def iterations_per_second(simulate, seconds):
+    """ time simulations, doubling the iterations until a run takes long enough
+    
+    Args:
+        simulate: function to run a given number of iterations
+        seconds: minimum time to spend on the timed run
+    
+    Returns:
+        number of iterations run per second
+    """
+    
+    iterations = 1000
+    while True:
+        start = time.time()
+        simulate(iterations)
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return iterations / elapsed
+        iterations *= 2
+
+def main():
+    args = get_options()
+    
+    choices = WeightedChoice()
+    for pos in range(args.length):
+        choices.add_choice(pos, 1e-8)
+    
+    print("de_novos\tdistribution_per_second\tcounting_per_second")
+    for count in args.counts:
+        distribution = iterations_per_second(
+            lambda n: simulate_distribution(choices, n, count), args.seconds)
+        
+        counting = 'NA'
+        if count_simulations is not None:
+            counting = '{:.0f}'.format(iterations_per_second(
+                lambda n: count_simulations(choices, n, count, 0.0), args.seconds))
+        
+        print("{}\t{:.0f}\t{}".format(count, distribution, counting))
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@ from setuptools import setup
 from distutils.core import Extension
 from Cython.Build import cythonize
 
-EXTRA_COMPILE_ARGS = ["-std=c++11"]
+EXTRA_COMPILE_ARGS = ["-std=c++11", "-pthread"]
+EXTRA_LINK_ARGS = ["-pthread"]
 
 if sys.platform == "darwin":
     EXTRA_COMPILE_ARGS += ["-stdlib=libc++"]
@@ -14,6 +15,7 @@ if sys.platform == "darwin":
 weights = cythonize([
     Extension("denovonear.weights",
         extra_compile_args=EXTRA_COMPILE_ARGS,
+        extra_link_args=EXTRA_LINK_ARGS,
         sources=["denovonear/weights.pyx",
             "src/weighted_choice.cpp",
             "src/simulate.cpp"],
@@ -32,6 +34,7 @@ weights = cythonize([
             "denovonear/site_specific_rates.pyx",
             "src/weighted_choice.cpp",
             "src/tx.cpp",
+            "src/mutation_rates.cpp",
             "src/site_rates.cpp"],
         include_dirs=["src/"],
         language="c++"),
@@ -47,6 +50,7 @@ setup (name="denovonear",
         url='https://github.com/jeremymcrae/denovonear',
         packages=["denovonear", "denovonear.gene_plot"],
         install_requires=['scipy >= 0.9.0',
+                          'numpy',
                           'cairocffi >= 0.7.2',
                           'webcolors >= 1.5',
                           'cython >= 0.19.0'
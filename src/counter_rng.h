@@ -0,0 +1,61 @@
+#ifndef DENOVONEAR_COUNTER_RNG_H_
+#define DENOVONEAR_COUNTER_RNG_H_
+
+#include <cstdint>
+#include <limits>
+#include <random>
+
+inline std::uint64_t splitmix64(std::uint64_t x) {
+    /**
+        the SplitMix64 finaliser, a bijective mix of the bits of a value
+    */
+
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    return x ^ (x >> 31);
+}
+
+class CounterRng {
+    /**
+        counter-based random number generator
+
+        The nth number from a key is the SplitMix64 output at position n, i.e.
+        splitmix64(key + n * gamma), so any position can be jumped to directly.
+        Streams are split into blocks of 2^32 numbers, and each simulation
+        iteration draws from the block matching its iteration number. The draws
+        for an iteration then depend only on the seed, stream and iteration
+        number, and not on how the iterations are split across threads or jobs.
+    */
+
+    static const std::uint64_t gamma = 0x9e3779b97f4a7c15ULL;
+    std::uint64_t key;
+    std::uint64_t counter = 0;
+
+ public:
+    typedef std::uint64_t result_type;
+
+    CounterRng() {
+        // without a seed, draw the key from fresh entropy
+        std::random_device rd;
+        key = splitmix64((static_cast<std::uint64_t>(rd()) << 32) ^ rd());
+    };
+    CounterRng(std::uint64_t seed, std::uint64_t stream=0) {
+        key = splitmix64(splitmix64(seed) + stream * gamma);
+    };
+
+    static constexpr result_type min() { return 0; };
+    static constexpr result_type max() {
+        return std::numeric_limits<result_type>::max();
+    };
+    result_type operator()() { return splitmix64(key + (++counter) * gamma); };
+
+    // move to the start of a block of numbers, one block per iteration
+    void seek(std::uint64_t block) { counter = block << 32; };
+
+    // get an independent generator, for draws separate from the iterations
+    CounterRng substream(std::uint64_t id) const {
+        return CounterRng(key, id + 1);
+    };
+};
+
+#endif  // DENOVONEAR_COUNTER_RNG_H_
@@ -0,0 +1,92 @@
+#include <string>
+#include <vector>
+#include <stdexcept>
+
+#include "weighted_choice.h"
+#include "mutation_rates.h"
+
+// longest k-mer to allow, since the table holds 4^(k+1) rates
+const int MAX_KMER_LENGTH = 11;
+
+std::int64_t encode_kmer(const std::string & seq) {
+    /**
+        encode a sequence with two bits per base, with the first base highest
+        
+        @seq DNA sequence
+        @return encoded sequence, or -1 if the sequence has any other bases
+    */
+    
+    std::int64_t code = 0;
+    for (auto base : seq) {
+        std::uint8_t value = encode_base(base);
+        if (value > 3) { return -1; }
+        code = (code << 2) | value;
+    }
+    
+    return code;
+}
+
+MutationRates::MutationRates(std::vector<std::vector<std::string>> mut) {
+    /**
+        parse a table of [initial, changed, rate] rows into the dense array
+        
+        Sequence contexts without a rate in the table have a rate of zero.
+    */
+    
+    if (mut.empty()) {
+        throw std::invalid_argument("no mutation rates supplied");
+    }
+    
+    kmer_length = mut[0][0].length();
+    mid_pos = kmer_length / 2;
+    if (kmer_length % 2 == 0 || kmer_length > MAX_KMER_LENGTH) {
+        throw std::invalid_argument("mutation rate sequences must have an odd "
+            "length, up to " + std::to_string(MAX_KMER_LENGTH) + " bases");
+    }
+    
+    rates.resize(static_cast<std::size_t>(4) << (2 * kmer_length), 0.0);
+    
+    for (auto & line : mut) {
+        if (line.size() < 3) {
+            throw std::invalid_argument("mutation rates need initial, changed "
+                "and rate fields");
+        }
+        
+        std::string & initial = line[0];
+        std::string & changed = line[1];
+        if (static_cast<int>(initial.length()) != kmer_length ||
+                changed.length() != initial.length()) {
+            throw std::invalid_argument("mutation rate sequences differ in length: "
+                + initial + ", " + changed);
+        }
+        
+        std::int64_t code = encode_kmer(initial);
+        std::uint8_t alt = encode_base(changed[mid_pos]);
+        if (code < 0 || alt > 3) {
+            throw std::invalid_argument("unknown base in mutation rate "
+                "sequences: " + initial + ", " + changed);
+        }
+        
+        rates[code * 4 + alt] = std::stod(line[2]);
+    }
+}
+
+double MutationRates::get_rate(const std::string & seq, const std::string & alt) const {
+    /**
+        get the rate for mutating the middle base of a sequence
+        
+        @seq sequence context, centered on the mutated base
+        @alt alternate base
+        @return mutation rate, or zero if the sequence isn't in the table
+    */
+    
+    if (static_cast<int>(seq.length()) != kmer_length || alt.length() != 1) {
+        return 0.0;
+    }
+    
+    std::int64_t code = encode_kmer(seq);
+    std::uint8_t base = encode_base(alt[0]);
+    if (code < 0 || base > 3) { return 0.0; }
+    
+    return get_rate(code, base);
+}
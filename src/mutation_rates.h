@@ -0,0 +1,31 @@
+#ifndef DENOVONEAR_MUTATION_RATES_H_
+#define DENOVONEAR_MUTATION_RATES_H_
+
+#include <cstdint>
+#include <string>
+#include <vector>
+
+class MutationRates {
+    /**
+        table of sequence context mutation rates, for sharing between SiteRates
+        
+        The table is parsed once into a dense array of rates, indexed by the
+        k-mer encoded with two bits per base, and by the alternate base at the
+        middle of the k-mer. Looking up a rate is then an array index, rather
+        than hashing strings in nested maps.
+    */
+    
+    std::vector<double> rates;
+    int kmer_length = 0;
+    int mid_pos = 0;
+
+ public:
+    MutationRates(std::vector<std::vector<std::string>> mut);
+    int get_kmer_length() const { return kmer_length; };
+    double get_rate(std::uint64_t code, int alt) const { return rates[code * 4 + alt]; };
+    double get_rate(const std::string & seq, const std::string & alt) const;
+};
+
+std::int64_t encode_kmer(const std::string & seq);
+
+#endif  // DENOVONEAR_MUTATION_RATES_H_
@@ -2,8 +2,14 @@
 #include <algorithm>
 #include <cmath>
 #include <vector>
+#include <random>
+#include <thread>
+#include <functional>
+#include <map>
+#include <string>
 
 #include "weighted_choice.h"
+#include "simulate.h"
 
 std::vector<int> _get_distances(std::vector<int> sites) {
     /**
@@ -67,34 +73,188 @@ double _geomean(std::vector<int> distances) {
     return mean;
 }
 
+double _geomean_of_sites(const std::vector<int> & sites) {
+    /**
+        gets the geometric mean distance between all pairs of sites
+        
+        This fuses _get_distances() and _geomean() into one pass over the pairs
+        of sites, without allocating a vector of distances. The logs are summed
+        in the same order as _geomean(), so the results are identical. If a
+        zero distance turns up, the sum restarts with the distances adjusted
+        upwards, which happens at most once per call.
+        
+        @sites vector of positions
+        @return geometric mean of the pairwise distances
+    */
+    
+    int len = sites.size();
+    bool zero_val = false;
+    double total = 0;
+    
+    for (int i=0; i < len; i++) {
+        for (int j=i+1; j < len; j++) {
+            int distance = abs(sites[i] - sites[j]);
+            if (zero_val) {
+                total += log10(distance + 1);
+            } else if (distance == 0) {
+                // rescan the earlier pairs with the upwards adjustment
+                zero_val = true;
+                total = 0;
+                i = 0;
+                j = 0;
+            } else {
+                total += log10(distance);
+            }
+        }
+    }
+    
+    // calculate the mean value
+    double pairs = (static_cast<double>(len) * (len - 1)) / 2;
+    double mean = std::pow(10, total/pairs);
+    
+    // adjust mean back to where it should be if we had a zero value
+    if (zero_val) { mean -= 1; }
+    
+    return mean;
+}
+
+std::vector<double> _distance_logs(int span, int de_novo_count) {
+    /**
+        tabulate log10 of every distance possible between a set of sites
+        
+        For large numbers of de novos, looking up the log of each pairwise
+        distance is several times quicker than computing it.
+        
+        @span distance between the furthest apart sites
+        @de_novo_count number of de novos per iteration
+        @return log10(d) at index d, for d up to span + 1 (to allow for the
+            adjustment for zero distances), or an empty vector if there are
+            too few de novos for the table to pay off, or the span is huge.
+    */
+    
+    std::vector<double> logs;
+    if (de_novo_count < LARGE_DE_NOVO_COUNT || span < 0 || span > MAX_LOG_SPAN) {
+        return logs;
+    }
+    
+    logs.resize(span + 2);
+    for (int d=0; d < span + 2; d++) { logs[d] = log10(d); }
+    
+    return logs;
+}
+
+const std::vector<double> & _distance_logs(Chooser & choices, int de_novo_count) {
+    /**
+        get the table of log10 distances between sites in a Chooser
+        
+        The table is kept by the Chooser, so it is only built once for a set
+        of sites, however many runs of simulations use it. Simulations called
+        from python build it beforehand, while holding the GIL.
+        
+        @choices Chooser object, to sample sites
+        @de_novo_count number of de novos per iteration
+        @return log10(d) at index d, or an empty vector if there are too few de
+            novos for the table to pay off, or the span is too wide.
+    */
+    
+    static const std::vector<double> none;
+    if (de_novo_count < LARGE_DE_NOVO_COUNT) { return none; }
+    
+    choices.prepare_logs();
+    return choices.distance_logs();
+}
+
+double _geomean_of_sites(const std::vector<int> & sites,
+        const std::vector<double> & logs) {
+    /**
+        gets the geometric mean distance between all pairs of sites, looking up
+        the logs of the distances in a table from _distance_logs()
+        
+        The sums with and without the adjustment for zero distances are built
+        together, in the same pair order as _geomean_of_sites(), so the result
+        is identical, but without restarting when a zero distance turns up.
+        
+        @sites vector of positions
+        @logs table of log10 values, or an empty vector to compute the logs
+        @return geometric mean of the pairwise distances
+    */
+    
+    if (logs.empty()) { return _geomean_of_sites(sites); }
+    
+    int len = sites.size();
+    bool zero_val = false;
+    double total = 0;
+    double adjusted = 0;
+    
+    for (int i=0; i < len; i++) {
+        for (int j=i+1; j < len; j++) {
+            int distance = abs(sites[i] - sites[j]);
+            zero_val = zero_val || distance == 0;
+            total += logs[distance];
+            adjusted += logs[distance + 1];
+        }
+    }
+    
+    if (zero_val) { total = adjusted; }
+    
+    // calculate the mean value
+    double pairs = (static_cast<double>(len) * (len - 1)) / 2;
+    double mean = std::pow(10, total/pairs);
+    
+    // adjust mean back to where it should be if we had a zero value
+    if (zero_val) { mean -= 1; }
+    
+    return mean;
+}
+
+void _run_workers(int iterations, int threads,
+        std::function<void(int, int, int)> task) {
+    /**
+        split a run of iterations across worker threads
+        
+        Workers draw random numbers for each iteration from the iteration's own
+        block of a CounterRng stream, so the results do not depend on how the
+        iterations are split.
+        
+        @iterations total number of iterations to run
+        @threads number of worker threads to use
+        @task function taking the worker index, and the first and last
+            (exclusive) iterations for the worker
+    */
+    
+    threads = std::max(1, std::min(threads, iterations));
+    
+    if (threads == 1) {
+        task(0, 0, iterations);
+        return;
+    }
+    
+    std::vector<std::thread> workers;
+    for (int i=0; i < threads; i++) {
+        int first = static_cast<long long>(iterations) * i / threads;
+        int last = static_cast<long long>(iterations) * (i + 1) / threads;
+        workers.push_back(std::thread(task, i, first, last));
+    }
+    
+    for (auto & worker : workers) { worker.join(); }
+}
+
 std::vector<double> _simulate_distribution(Chooser & choices, int iterations,
-    int de_novo_count) {
+    int de_novo_count, int threads, CounterRng rng, long long start) {
     /**
         simulates de novos weighted by mutation rate
         
         @choices Chooser object, to sample sites
         @iteration number of iterations to run
         @de_novo_count number of de novos to simulate per iteration
+        @threads number of worker threads to split the iterations across
+        @rng random number generator for the stream to draw from
+        @start number of the first iteration within the stream
         @return a list of mean distances for each iteration
     */
     
-    // use a vector to return the mean distances, easier to call from python
-    std::vector<double> mean_distances;
-    
-    // run through the required iterations
-    for (int n=0; n < iterations; n++) {
-        // randomly select de novo sites for the iteration
-        std::vector<int> positions;
-        for (int i=0; i < de_novo_count; i++) {
-            positions.push_back(choices.choice().pos);
-        }
-        
-        // convert the positions into distances between all pairs, and get the
-        // geometric mean distance of all the distances
-        std::vector<int> distances = _get_distances(positions);
-        
-        mean_distances.push_back(_geomean(distances));
-    }
+    std::vector<double> mean_distances = _simulate_values(choices, iterations,
+        de_novo_count, threads, rng, start, _distance_logs(choices, de_novo_count));
     
     // make sure the mean distances are sorted, so we can quickly merge with
     // previous distances
@@ -103,6 +263,46 @@ std::vector<double> _simulate_distribution(Chooser & choices, int iterations,
     return mean_distances;
 }
 
+std::vector<double> _simulate_values(Chooser & choices, int iterations,
+    int de_novo_count, int threads, CounterRng rng, long long start,
+    const std::vector<double> & logs) {
+    /**
+        simulates de novos weighted by mutation rate, keeping the mean
+        distances in the order of the iterations
+        
+        @choices Chooser object, to sample sites
+        @iteration number of iterations to run
+        @de_novo_count number of de novos to simulate per iteration
+        @threads number of worker threads to split the iterations across
+        @rng random number generator for the stream to draw from
+        @start number of the first iteration within the stream
+        @logs table of log10 distances from _distance_logs()
+        @return a list of mean distances for each iteration
+    */
+    
+    // use a vector to return the mean distances, easier to call from python
+    std::vector<double> mean_distances(std::max(iterations, 0));
+    choices.prepare();
+    
+    auto task = [&](int worker, int first, int last) {
+        CounterRng local = rng;
+        std::vector<int> positions(de_novo_count);
+        for (int n=first; n < last; n++) {
+            local.seek(start + n);
+            // randomly select de novo sites for the iteration
+            for (int i=0; i < de_novo_count; i++) {
+                positions[i] = choices.choice_pos(local);
+            }
+            
+            // get the geometric mean distance between all pairs of positions
+            mean_distances[n] = _geomean_of_sites(positions, logs);
+        }
+    };
+    _run_workers(iterations, threads, task);
+    
+    return mean_distances;
+}
+
 bool _halt_permutation(double p_val, int iterations, double z, double alpha) {
     /**
         halt permutations if the P value could never be significant
@@ -110,9 +310,8 @@ bool _halt_permutation(double p_val, int iterations, double z, double alpha) {
         assess whether the P-value could never fall below 0.1, and cut
         out after a smaller number of iterations, in order to minimise
         run time. Figure out the lower bound of the confidence interval
-        for the current simulated P value.
-        TODO: figure out whether this is legit, perhaps a Sequential
-        TODO: Probability Ratio Test (SPRT) would be more appropriate.
+        for the current simulated P value. _analyse_de_novos now uses
+        Besag-Clifford sequential stopping instead.
         
         @p_val current simulated P value
         @iterations iterations run in order to obtain the simulated P value
@@ -128,52 +327,492 @@ bool _halt_permutation(double p_val, int iterations, double z, double alpha) {
     return lower_bound > alpha;
 }
 
-double _analyse_de_novos(Chooser & choices, int iterations, int de_novo_count,
-    double observed_value) {
+int _count_simulations(Chooser & choices, int iterations, int de_novo_count,
+    double observed_value, int threads, CounterRng rng, long long start) {
     /**
-        simulates de novos weighted by mutation rate
+        counts simulations with a mean distance at or below an observed value
+        
+        This streams through the simulations, rather than storing every mean
+        distance, so memory use is constant regardless of the iteration count.
         
         @choices Chooser object, to sample sites
         @iteration number of iterations to run
         @de_novo_count number of de novos to simulate per iteration
         @observed_value mean distance observed in the real de novo events
-        @return a list of mean distances for each iteration
+        @threads number of worker threads to split the iterations across
+        @rng random number generator for the stream to draw from
+        @start number of the first iteration within the stream
+        @return number of simulations with mean distance <= observed_value
+    */
+    
+    std::vector<int> counts(std::max(threads, 1), 0);
+    const std::vector<double> & logs = _distance_logs(choices, de_novo_count);
+    choices.prepare();
+    
+    auto task = [&](int worker, int first, int last) {
+        CounterRng local = rng;
+        int count = 0;
+        std::vector<int> positions(de_novo_count);
+        for (int n=first; n < last; n++) {
+            local.seek(start + n);
+            for (int i=0; i < de_novo_count; i++) {
+                positions[i] = choices.choice_pos(local);
+            }
+            
+            if (_geomean_of_sites(positions, logs) <= observed_value) {
+                count += 1;
+            }
+        }
+        counts[worker] = count;
+    };
+    _run_workers(iterations, threads, task);
+    
+    int count = 0;
+    for (auto x : counts) { count += x; }
+    
+    return count;
+}
+
+void _collapse_sites(Chooser & choices, std::vector<int> & positions,
+        std::vector<double> & weights) {
+    /**
+        sum the rates for all sites sharing a position, normalised to sum to one
+        
+        @choices Chooser object, with sites to collapse
+        @positions vector to fill with the distinct positions
+        @weights vector to fill with the probability of each position
     */
     
-    double minimum_prob = 1.0/(1.0 + static_cast<double>(iterations));
-    double sim_prob = minimum_prob;
-    std::vector<double> dist;
+    std::map<int, double> summed;
+    for (int i=0; i < choices.len(); i++) {
+        if (choices.get_prob(i) > 0) { summed[choices.get_pos(i)] += choices.get_prob(i); }
+    }
     
-    while (iterations < 100000000 && sim_prob == minimum_prob) {
-        int iters_to_run = iterations - dist.size();
+    double total = choices.get_summed_rate();
+    positions.clear();
+    weights.clear();
+    for (auto & site : summed) {
+        positions.push_back(site.first);
+        weights.push_back(site.second / total);
+    }
+}
+
+double _count_multisets(int sites, int de_novo_count, double limit) {
+    /**
+        count the ways to place de novos on sites, ignoring order
         
-        minimum_prob = 1.0/(1.0 + static_cast<double>(iterations));
+        The count is the binomial coefficient C(sites + count - 1, count). We
+        stop counting once the count exceeds a limit, to avoid overflow.
+        
+        @sites number of distinct positions
+        @de_novo_count number of de novos to place
+        @limit value above which to stop counting
+        @return number of multisets, or a value above the limit
+    */
+    
+    double total = 1.0;
+    for (int i=1; i <= de_novo_count; i++) {
+        total *= static_cast<double>(sites + i - 1) / i;
+        if (total > limit) { break; }
+    }
+    
+    return total;
+}
+
+void _enumerate(const std::vector<int> & positions,
+        const std::vector<double> & weights, std::vector<int> & sites,
+        int depth, int first, int run, double prob, double observed_value,
+        double & total) {
+    /**
+        recursively sum probabilities for multisets of sites not exceeding the
+        observed mean distance
         
-        // simulate mean distances between de novos
-        std::vector<double> new_dist = _simulate_distribution(choices,
-            iters_to_run, de_novo_count);
+        Sites are chosen in nondecreasing index order, so each multiset is
+        visited once. The probability of a multiset is the multinomial
+        coefficient times the product of the site weights, which we build up
+        one site at a time.
         
-        // merge the two sorted lists into a sorted vector
-        std::vector<double> v(iterations);
-        std::merge(dist.begin(), dist.end(), new_dist.begin(), new_dist.end(),
-            v.begin());
-        dist = v;
+        @positions distinct positions
+        @weights probability for each position
+        @sites vector of chosen positions, one per de novo
+        @depth number of sites chosen so far
+        @first lowest index allowed for the next site
+        @run number of times the site at index first-1 has been chosen
+        @prob probability of the sites chosen so far, over all orderings
+        @observed_value mean distance observed in the real de novo events
+        @total running sum of probabilities
+    */
+    
+    if (depth == static_cast<int>(sites.size())) {
+        if (_geomean_of_sites(sites) <= observed_value) { total += prob; }
+        return;
+    }
+    
+    for (int i=std::max(first - 1, 0); i < static_cast<int>(positions.size()); i++) {
+        // track how often the current site has been picked, to correct the
+        // number of orderings for repeated sites
+        int count = (i == first - 1) ? run + 1 : 1;
+        sites[depth] = positions[i];
+        _enumerate(positions, weights, sites, depth + 1, i + 1, count,
+            prob * weights[i] * (depth + 1) / count, observed_value, total);
+    }
+}
+
+double _enumerate_de_novos(const std::vector<int> & positions,
+        const std::vector<double> & weights, int de_novo_count,
+        double observed_value) {
+    /**
+        exact probability of de novos being at least as close as observed
         
-        // figure out where in the list a random probability would fall
-        std::vector<double>::iterator pos;
-        pos = std::upper_bound(dist.begin(), dist.end(), observed_value);
-        double position = pos - dist.begin();
+        @positions distinct positions
+        @weights probability for each position
+        @de_novo_count number of de novos to place
+        @observed_value mean distance observed in the real de novo events
+        @return probability of a mean distance <= observed_value
+    */
+    
+    std::vector<int> sites(de_novo_count);
+    double total = 0.0;
+    _enumerate(positions, weights, sites, 0, 0, 0, 1.0, observed_value, total);
+    
+    return std::min(total, 1.0);
+}
+
+Estimate _importance_sample(const std::vector<int> & positions,
+        const std::vector<double> & weights, int iterations, int de_novo_count,
+        double observed_value, int threads, CounterRng rng,
+        const std::vector<double> & logs) {
+    /**
+        estimate a small clustering probability by importance sampling
         
-        // estimate the probability from the position
-        sim_prob = (1.0 + position)/(1.0 + dist.size());
+        Most draws come from a proposal which picks an anchor site by rate,
+        then picks the other de novos by rate from within a window around the
+        anchor, so tight clusters turn up often. A small fraction of draws come
+        from the null distribution, so every placement can be proposed. Each
+        draw is weighted by the likelihood ratio of the null to the mixture.
         
-        // halt permutations if the P value could never be significant
-        double z = 10.0;
-        double alpha = 0.1;
-        if (_halt_permutation(sim_prob, iterations, z, alpha)) { break; }
+        With the anchor placed at any of the k slots, the proposal density
+        relative to the null is (1/k) * sum_j [all sites within the window of
+        site j] / Z_j^(k-1), where Z_j is the summed weight of the window.
         
-        iterations += 1000000;  // for if we need to run more iterations
+        @positions distinct positions, sorted
+        @weights probability for each position
+        @iterations number of draws
+        @de_novo_count number of de novos per draw
+        @observed_value mean distance observed in the real de novo events
+        @threads number of worker threads to split the draws across
+        @rng random number generator for the stream to draw from
+        @logs table of log10 distances from _distance_logs(), covering the span
+            of the positions, or an empty vector to compute the logs
+        @return Estimate of the probability and its standard error
+    */
+    
+    int n_sites = positions.size();
+    double defensive = 0.1;  // proportion of draws from the null
+    
+    // size the window to fit the widest cluster at or below the observed mean
+    // distance. For sorted sites x_1..x_k spanning D, each inner site j gives
+    // (d_1j + 1) * (d_jk + 1) >= D + 1, so the 2k - 3 pairs through the end
+    // sites bound the log distances below by (k - 1) * log(D + 1), while all
+    // C(k, 2) pairs sum to at most C(k, 2) * log(observed + 1). Sets without
+    // shared sites skip the +1 adjustment, and d * (D - d) >= D - 1 instead.
+    double pairs = de_novo_count * (de_novo_count - 1) / 2.0;
+    double power = pairs / std::max(de_novo_count - 1, 1);
+    double widest = std::max(std::pow(observed_value + 1, power) - 1,
+        std::pow(observed_value, power) + 1);
+    int span = (n_sites > 0) ? positions.back() - positions.front() : -1;
+    int width = static_cast<int>(std::ceil(std::min(widest,
+        static_cast<double>(std::max(span, 1)))));
+    
+    std::vector<double> cumulative(n_sites + 1, 0.0);
+    for (int i=0; i < n_sites; i++) { cumulative[i + 1] = cumulative[i] + weights[i]; }
+    
+    // find the range of sites in the window around each site
+    std::vector<int> lower(n_sites);
+    std::vector<int> upper(n_sites);
+    std::vector<double> window(n_sites);
+    int lo = 0;
+    int hi = 0;
+    for (int i=0; i < n_sites; i++) {
+        while (positions[i] - positions[lo] > width) { lo++; }
+        while (hi < n_sites && positions[hi] - positions[i] <= width) { hi++; }
+        lower[i] = lo;
+        upper[i] = hi;
+        window[i] = cumulative[hi] - cumulative[lo];
+    }
+    
+    // sum the weights within fixed size chunks of draws, then add up the
+    // chunks in order, so the estimate doesn't depend on the thread count
+    int chunk_size = 1024;
+    int chunks = (iterations + chunk_size - 1) / chunk_size;
+    std::vector<double> sums(chunks, 0.0);
+    std::vector<double> squares(chunks, 0.0);
+    
+    auto task = [&](int worker, int first_chunk, int last_chunk) {
+        CounterRng local = rng;
+        std::uniform_real_distribution<double> unit(0.0, 1.0);
+        std::vector<int> idx(de_novo_count);
+        std::vector<int> sites(de_novo_count);
+        
+        // pick a site by rate, from the sites between two indices
+        auto pick = [&](int start, int end) {
+            double number = cumulative[start] +
+                unit(local) * (cumulative[end] - cumulative[start]);
+            auto pos = std::upper_bound(cumulative.begin() + start + 1,
+                cumulative.begin() + end, number);
+            return static_cast<int>(pos - cumulative.begin()) - 1;
+        };
+        
+        for (int chunk=first_chunk; chunk < last_chunk; chunk++) {
+            double sum = 0.0;
+            double square = 0.0;
+            int last = std::min(iterations, (chunk + 1) * chunk_size);
+            for (int n=chunk * chunk_size; n < last; n++) {
+                local.seek(n);
+                if (unit(local) < defensive) {
+                    for (int i=0; i < de_novo_count; i++) { idx[i] = pick(0, n_sites); }
+                } else {
+                    idx[0] = pick(0, n_sites);
+                    for (int i=1; i < de_novo_count; i++) {
+                        idx[i] = pick(lower[idx[0]], upper[idx[0]]);
+                    }
+                }
+                
+                for (int i=0; i < de_novo_count; i++) { sites[i] = positions[idx[i]]; }
+                if (_geomean_of_sites(sites, logs) > observed_value) { continue; }
+                
+                // get the proposal density relative to the null density
+                double ratio = 0.0;
+                for (int j=0; j < de_novo_count; j++) {
+                    bool inside = true;
+                    for (int i=0; i < de_novo_count; i++) {
+                        inside = inside && std::abs(sites[i] - sites[j]) <= width;
+                    }
+                    if (inside) {
+                        ratio += std::pow(window[idx[j]], -(de_novo_count - 1));
+                    }
+                }
+                ratio /= de_novo_count;
+                
+                double weight = 1.0 / (defensive + (1.0 - defensive) * ratio);
+                sum += weight;
+                square += weight * weight;
+            }
+            sums[chunk] = sum;
+            squares[chunk] = square;
+        }
+    };
+    _run_workers(chunks, threads, task);
+    
+    double sum = 0.0;
+    double square = 0.0;
+    for (auto x : sums) { sum += x; }
+    for (auto x : squares) { square += x; }
+    
+    double mean = sum / iterations;
+    double variance = std::max(square / iterations - mean * mean, 0.0);
+    
+    return Estimate {mean, std::sqrt(variance / iterations)};
+}
+
+AnalysisResult _analyse_de_novos(Chooser & choices, int iterations,
+    int de_novo_count, double observed_value, int threads, int exceedances,
+    CounterRng rng, long long start, bool shard) {
+    /**
+        estimate the probability of de novos clustering as tightly as observed
+        
+        This is _analyse_many() for a single observed value.
+        
+        @choices Chooser object, to sample sites
+        @iteration number of iterations to run
+        @de_novo_count number of de novos to simulate per iteration
+        @observed_value mean distance observed in the real de novo events
+        @threads number of worker threads to split the iterations across
+        @exceedances number of simulations at or below the observed value at
+            which to stop simulating. Zero runs all the iterations.
+        @rng random number generator for the stream to draw from
+        @start number of the first simulation within the stream
+        @shard whether the run is one of several covering consecutive
+            simulations of the stream, so only simulations are used
+        @return AnalysisResult with the probability, its standard error, the
+            method used, why it stopped, the number of draws, and the number
+            of simulations at or below the observed value
+    */
+    
+    std::vector<double> observed = {observed_value};
+    return _analyse_many(choices, iterations, de_novo_count, observed, threads,
+        exceedances, rng, start, shard)[0];
+}
+
+std::vector<AnalysisResult> _analyse_many(Chooser & choices, int iterations,
+    int de_novo_count, const std::vector<double> & observed, int threads,
+    int exceedances, CounterRng rng, long long start, bool shard) {
+    /**
+        estimate the probability of de novos clustering as tightly as observed,
+        for many observed values from one stream of simulations
+        
+        If the sites are few enough that enumerating every placement of the de
+        novos costs less than the requested iterations, we get the exact
+        probability that way, otherwise we simulate de novos weighted by
+        mutation rate, until enough simulations are as clustered as observed
+        (Besag & Clifford 1991, Biometrika 78:301-304), or the iterations run
+        out. Clearly non-significant genes thus stop after a few thousand
+        simulations. If none of the first half of the simulations are as
+        clustered as the observed de novos, we spend the other half of the
+        iterations on importance sampling instead. The iterations are a hard
+        cap on the draws for each observed value.
+        
+        Each observed value stops at its own exceedance, so its result is the
+        same as analysing it alone, but the simulations are shared, and only
+        run until the last observed value stops.
+        
+        Simulations are numbered from the start iteration, and each draws from
+        its own block of the random number stream, so a seeded analysis gives
+        the same result for any number of threads. Runs can also be split into
+        shards covering consecutive iterations, whose summed counts match a
+        single run. Shards only simulate, without enumerating or importance
+        sampling, so each covers exactly its own range of the stream.
+        
+        @choices Chooser object, to sample sites
+        @iteration number of iterations to run
+        @de_novo_count number of de novos to simulate per iteration
+        @observed mean distances observed in sets of real de novo events
+        @threads number of worker threads to split the iterations across
+        @exceedances number of simulations at or below the observed value at
+            which to stop simulating. Zero runs all the iterations.
+        @rng random number generator for the stream to draw from
+        @start number of the first simulation within the stream
+        @shard whether the run is one of several covering consecutive
+            simulations of the stream, so only simulations are used
+        @return AnalysisResult for each observed value
+    */
+    
+    int n_observed = observed.size();
+    std::vector<AnalysisResult> results(n_observed);
+    
+    std::vector<int> positions;
+    std::vector<double> weights;
+    _collapse_sites(choices, positions, weights);
+    
+    if (!shard && !positions.empty() &&
+        _count_multisets(positions.size(), de_novo_count, iterations) <= iterations) {
+        for (int j=0; j < n_observed; j++) {
+            double prob = _enumerate_de_novos(positions, weights, de_novo_count,
+                observed[j]);
+            results[j] = AnalysisResult {prob, 0.0, "enumeration", "exhaustive", 0, 0};
+        }
+        return results;
+    }
+    
+    // only the number of simulations at or below each observed value matters,
+    // so track counts rather than the full simulated distribution
+    std::vector<long long> counts(n_observed, 0);
+    std::vector<long long> stopped_at(n_observed, 0);
+    std::vector<bool> pending(n_observed, true);
+    long long simulated = 0;
+    
+    // check the stopping rule after each batch of simulations. Batches start
+    // small, so clearly non-significant genes stop quickly, then double up to
+    // 100000 simulations per thread, so longer runs don't spend their time
+    // starting threads. The stopping point is found per simulation, so the
+    // batch sizes don't change the results.
+    long long batch = 1000 * std::max(threads, 1);
+    long long largest = 100000 * static_cast<long long>(std::max(threads, 1));
+    const std::vector<double> & logs = _distance_logs(choices, de_novo_count);
+    
+    // the iterations cap the draws for each observed value. Values without
+    // any simulations as clustered as observed by halfway get the other half
+    // as importance sampling draws instead, unless this is a shard.
+    long long halfway = shard ? iterations : iterations / 2;
+    
+    // estimate the probability from the count, for values which ran out of
+    // simulations before stopping
+    auto from_count = [&](int j) {
+        pending[j] = false;
+        double p_value = (1.0 + counts[j])/(1.0 + simulated);
+        results[j] = AnalysisResult {p_value,
+            std::sqrt(p_value * (1 - p_value) / std::max(simulated, 1LL)),
+            "simulation", "max_iterations", simulated, counts[j]};
+    };
+    
+    for (long long limit : {halfway, static_cast<long long>(iterations)}) {
+        while (simulated < limit &&
+                std::find(pending.begin(), pending.end(), true) != pending.end()) {
+            int iters_to_run = std::min(batch, limit - simulated);
+            std::vector<double> values = _simulate_values(choices, iters_to_run,
+                de_novo_count, threads, rng, start + simulated, logs);
+            
+            // count the hits for each observed value in one pass over the
+            // batch, unless there are enough values that sorting the batch
+            // once, then searching it for each value, is cheaper
+            long long n_pending = std::count(pending.begin(), pending.end(), true);
+            std::vector<double> ordered;
+            if (n_pending > std::log2(iters_to_run)) {
+                ordered = values;
+                std::sort(ordered.begin(), ordered.end());
+            }
+            
+            for (int j=0; j < n_observed; j++) {
+                if (!pending[j]) { continue; }
+                long long hits;
+                if (ordered.empty()) {
+                    hits = std::count_if(values.begin(), values.end(),
+                        [&](double x) { return x <= observed[j]; });
+                } else {
+                    hits = std::upper_bound(ordered.begin(), ordered.end(),
+                        observed[j]) - ordered.begin();
+                }
+                
+                // Besag-Clifford sequential stopping: once enough simulations
+                // are as clustered as observed, the p-value is known precisely
+                // enough. Stop at the simulation giving the final exceedance,
+                // so the batch size doesn't change the result.
+                if (exceedances > 0 && counts[j] + hits >= exceedances) {
+                    int n = 0;
+                    for (; n < iters_to_run; n++) {
+                        if (values[n] <= observed[j]) { counts[j] += 1; }
+                        if (counts[j] == exceedances) { break; }
+                    }
+                    stopped_at[j] = simulated + n + 1;
+                    pending[j] = false;
+                    double p_value = static_cast<double>(counts[j]) / stopped_at[j];
+                    results[j] = AnalysisResult {p_value,
+                        std::sqrt(p_value * (1 - p_value) / stopped_at[j]),
+                        "simulation", "besag_clifford", stopped_at[j], counts[j]};
+                } else {
+                    counts[j] += hits;
+                }
+            }
+            simulated += iters_to_run;
+            batch = std::min(2 * batch, largest);
+        }
+        
+        if (limit == iterations) { break; }
+        
+        // if none of the simulations so far were as clustered as observed, the
+        // probability is tiny, so estimate it by importance sampling, rather
+        // than spending the remaining iterations on simulations.
+        int draws = iterations - simulated;
+        for (int j=0; j < n_observed; j++) {
+            if (!pending[j] || counts[j] > 0 || positions.empty() || draws == 0) {
+                continue;
+            }
+            Estimate tail = _importance_sample(positions, weights, draws,
+                de_novo_count, observed[j], threads, rng.substream(0), logs);
+            if (tail.p_value > 0) {
+                pending[j] = false;
+                results[j] = AnalysisResult {tail.p_value, tail.std_error,
+                    "importance_sampling", "max_iterations", simulated + draws, 0};
+            } else {
+                // the draws are spent, so fall back to the simulations so far
+                from_count(j);
+            }
+        }
+    }
+    
+    for (int j=0; j < n_observed; j++) {
+        if (pending[j]) { from_count(j); }
     }
     
-    return sim_prob;
+    return results;
 }
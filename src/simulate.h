@@ -2,15 +2,65 @@
 #define DENOVONEAR_SIMULATE_H_
 
 #include <vector>
+#include <string>
+
+#include "counter_rng.h"
+#include "weighted_choice.h"
+
+struct AnalysisResult {
+    double p_value;
+    double std_error;
+    std::string method;  // "simulation", "enumeration" or "importance_sampling"
+    std::string stopping;  // "besag_clifford", "max_iterations" or "exhaustive"
+    long long iterations;  // number of draws run
+    long long count;  // simulations at or below the observed value
+};
+
+struct Estimate {
+    double p_value;
+    double std_error;
+};
+
+// number of de novos from which to look up the logs of pairwise distances in
+// a table, rather than compute them
+const int LARGE_DE_NOVO_COUNT = 12;
 
 std::vector<int> _get_distances(std::vector<int> sites);
 bool _has_zero(std::vector<int> distances);
 double _geomean(std::vector<int> distances);
+double _geomean_of_sites(const std::vector<int> & sites);
+double _geomean_of_sites(const std::vector<int> & sites,
+    const std::vector<double> & logs);
+std::vector<double> _distance_logs(int span, int de_novo_count);
+const std::vector<double> & _distance_logs(Chooser & choices, int de_novo_count);
 bool _halt_permutation(double p_val, int iterations, double z = 10.0,
     double alpha = 0.01);
 std::vector<double> _simulate_distribution(Chooser & choices,
-    int iterations, int de_novo_count);
-double _analyse_de_novos(Chooser & choices, int iterations,
-    int de_novo_count, double observed_value);
+    int iterations, int de_novo_count, int threads = 1,
+    CounterRng rng = CounterRng(), long long start = 0);
+int _count_simulations(Chooser & choices, int iterations, int de_novo_count,
+    double observed_value, int threads = 1, CounterRng rng = CounterRng(),
+    long long start = 0);
+std::vector<double> _simulate_values(Chooser & choices, int iterations,
+    int de_novo_count, int threads, CounterRng rng, long long start,
+    const std::vector<double> & logs);
+void _collapse_sites(Chooser & choices, std::vector<int> & positions,
+    std::vector<double> & weights);
+double _count_multisets(int sites, int de_novo_count, double limit);
+double _enumerate_de_novos(const std::vector<int> & positions,
+    const std::vector<double> & weights, int de_novo_count,
+    double observed_value);
+Estimate _importance_sample(const std::vector<int> & positions,
+    const std::vector<double> & weights, int iterations, int de_novo_count,
+    double observed_value, int threads = 1, CounterRng rng = CounterRng(),
+    const std::vector<double> & logs = std::vector<double>());
+AnalysisResult _analyse_de_novos(Chooser & choices, int iterations,
+    int de_novo_count, double observed_value, int threads = 1,
+    int exceedances = 1000, CounterRng rng = CounterRng(), long long start = 0,
+    bool shard = false);
+std::vector<AnalysisResult> _analyse_many(Chooser & choices, int iterations,
+    int de_novo_count, const std::vector<double> & observed, int threads = 1,
+    int exceedances = 1000, CounterRng rng = CounterRng(), long long start = 0,
+    bool shard = false);
 
 #endif  // DENOVONEAR_SIMULATE_H_
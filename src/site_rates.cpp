@@ -20,6 +20,71 @@ Region _get_gene_range(Tx & tx) {
     return Region {start, end};
 }
 
+const CodonChange & _get_codon_change(std::int64_t codon, int intra_codon, int alt) {
+    /**
+        look up the outcome of a base change within a codon
+        
+        The outcome only depends on the codon, the position within the codon
+        and the alternate base, so every case is tabulated once, rather than
+        translating the mutated codon for each alternate at each site.
+        
+        @codon 2-bit encoded codon, from encode_kmer()
+        @intra_codon position within the codon to be altered (0-based)
+        @alt 2-bit code for the alternate base
+        @return amino acid for the mutated codon, and the consequence class
+    */
+    
+    static const std::vector<CodonChange> changes = [] {
+        // amino acids for each codon, in the order of the encoded codons
+        // i.e. AAA, AAC, AAG, AAT, ACA, ... TTT
+        const std::string amino_acids = "KNKNTTTTRSRSIIMIQHQHPPPPRRRRLLLL"
+            "EDEDAAAAGGGGVVVV*Y*YSSSS*CWCLFLF";
+        
+        std::vector<CodonChange> table(64 * 3 * 4);
+        for (int code=0; code < 64; code++) {
+            char initial = amino_acids[code];
+            for (int intra=0; intra < 3; intra++) {
+                int shift = 2 * (2 - intra);
+                for (int base=0; base < 4; base++) {
+                    int mutated_code = (code & ~(3 << shift)) | (base << shift);
+                    char mutated = amino_acids[mutated_code];
+                    
+                    std::uint8_t cq = SYNONYMOUS;
+                    if (initial != '*' && mutated == '*') {
+                        cq = NONSENSE;
+                    } else if (initial != mutated) {
+                        cq = MISSENSE;
+                    }
+                    table[(code * 3 + intra) * 4 + base] = CodonChange {mutated, cq};
+                }
+            }
+        }
+        return table;
+    }();
+    
+    return changes[(codon * 3 + intra_codon) * 4 + alt];
+}
+
+CodonChange _get_codon_change(std::string codon, int intra_codon, std::string alt) {
+    /**
+        look up the outcome of a base change within a codon sequence
+        
+        @codon DNA sequence of a single codon
+        @intra_codon position within the codon to be altered (0-based)
+        @alt alternate base (e.g. 'G') to introduce
+        @return amino acid for the mutated codon, and the consequence class
+    */
+    
+    std::int64_t code = (codon.size() == 3) ? encode_kmer(codon) : -1;
+    std::uint8_t base = (alt.size() == 1) ? encode_base(alt[0]) : 4;
+    if (code < 0 || base > 3 || intra_codon < 0 || intra_codon > 2) {
+        throw std::invalid_argument("cannot mutate codon: " + codon + " at "
+            + std::to_string(intra_codon) + " to " + alt);
+    }
+    
+    return _get_codon_change(code, intra_codon, base);
+}
+
 std::string _get_mutated_aa(Tx & tx, std::string base, std::string codon, int intra_codon) {
     /**
         find the amino acid resulting from a base change to a codon
@@ -32,41 +97,245 @@ std::string _get_mutated_aa(Tx & tx, std::string base, std::string codon, int in
         @returns single character amino acid code translated from the altered
             codon.
     */
-      
-    // figure out what the mutated codon is
-    codon.replace(intra_codon, 1, base);
     
-    return tx.translate(codon);
+    return std::string(1, _get_codon_change(codon, intra_codon, base).mutated_aa);
 }
 
-void SitesChecks::init(std::vector<std::vector<std::string>> mut) {
-    
-    // convert the rates data to a nested map
-    for (auto line : mut) {
-        mut_dict[line[0]][line[1]] = std::stod(line[2]);
-    }
+void SitesChecks::init(std::vector<std::string> wanted) {
+    /**
+        @wanted consequence categories to build site rates for. The summed
+            rates are found for every category, so an empty list only gives
+            summed rates.
+    */
     
-    // calculate the length of sequences used in the mutation rate dictionary
-    // This means we can flexibly use 3-mers, 5-mers, 7-mers etc if desired.
-    std::string str = mut_dict.begin()->first;
-    kmer_length = str.length();
+    // get the length of sequences used in the mutation rate table. This means
+    // we can flexibly use 3-mers, 5-mers, 7-mers etc if desired.
+    kmer_length = mut_rates.get_kmer_length();
     mid_pos = kmer_length/2;
     
+    for (auto & category : wanted) {
+        if (std::find(categories.begin(), categories.end(), category) == categories.end()) {
+            throw std::invalid_argument("unknown consequence category: " + category);
+        }
+        active.insert(category);
+    }
+    
     initialise_choices();
+    walk();
+    built = active;
+}
+
+std::shared_ptr<Chooser> SitesChecks::get(std::string category) {
+    /**
+        get the sites for a category, walking the transcript again to build
+        them if the category wasn't requested at construction
+    */
+    
+    bool known = std::find(categories.begin(), categories.end(), category) != categories.end();
+    if (known && built.count(category) == 0) {
+        std::set<std::string> previous = active;
+        active = {category};
+        summing = false;
+        rates[category] = std::make_shared<Chooser>();
+        walk();
+        active = previous;
+        summing = true;
+        
+        // keep adding sites for the category from later position checks
+        active.insert(category);
+        built.insert(category);
+    }
+    
+    if (rates.count(category) == 0) {
+        rates[category] = std::make_shared<Chooser>();
+    }
+    
+    return rates[category];
+}
+
+Chooser & SitesChecks::writable(const std::string & category) {
+    /**
+        get the sites for a category to add to, copying them first if they are
+        shared with a WeightedChoice, so that views never see later changes
+    */
+    
+    std::shared_ptr<Chooser> & chooser = rates[category];
+    if (!chooser) {
+        chooser = std::make_shared<Chooser>();
+    } else if (chooser.use_count() > 1) {
+        chooser = std::make_shared<Chooser>(*chooser);
+    }
+    
+    return *chooser;
+}
+
+bool _sorted_regions(const std::vector<Region> & regions) {
+    /**
+        check regions are in ascending order, without overlaps
+    */
+    
+    for (size_t i=1; i < regions.size(); i++) {
+        if (regions[i].start <= regions[i - 1].end) { return false; }
+    }
+    
+    return true;
+}
+
+void SitesChecks::walk() {
+    
+    // walk along the genomic sequence with a rolling 2-bit encoded k-mer (and
+    // its reverse complement) centered on each site, so that we never copy
+    // out the sequence around a site
+    const std::string & gdna = _tx.get_genomic_sequence();
+    int length = gdna.size();
+    std::uint64_t mask = (static_cast<std::uint64_t>(1) << (2 * kmer_length)) - 1;
+    int shift = 2 * (kmer_length - 1);
+    std::uint64_t fwd_code = 0;
+    std::uint64_t rev_code = 0;
+    int unknown = -1;  // sequence index of the most recent non-ACGT base
+    
+    auto add_base = [&](int idx) {
+        std::uint8_t base = (idx >= 0 && idx < length) ? encode_base(gdna[idx]) : 4;
+        if (base > 3) {
+            unknown = idx;
+            base = 0;
+        }
+        fwd_code = ((fwd_code << 2) | base) & mask;
+        rev_code = (rev_code >> 2) | (static_cast<std::uint64_t>(3 - base) << shift);
+    };
+    
+    // Sites further than 8 bp from every exon never have a consequence, so
+    // we skip the rest of the introns. Within the coding exons, the CDS
+    // position, codon and distance to the exon boundary follow from the
+    // position within the exon, so we track them as we walk, rather than
+    // searching the exons for every site. Other sites (e.g. near splice
+    // sites) use the lookups in check_position().
+    std::vector<Region> exons = _tx.get_exons();
+    std::vector<Region> cds = _tx.get_cds();
+    const std::string & cds_seq = _tx.get_cds_sequence();
+    int cds_length = cds_seq.size();
+    bool track = !cds.empty() && _sorted_regions(exons) && _sorted_regions(cds) &&
+        cds.front().start == std::min(_tx.get_cds_start(), _tx.get_cds_end()) &&
+        cds.back().end == std::max(_tx.get_cds_start(), _tx.get_cds_end());
+    
+    // count the coding bases before each CDS region, in genomic order
+    int coding_total = 0;
+    std::vector<int> before;
+    for (auto & region : cds) {
+        before.push_back(coding_total);
+        coding_total += region.end - region.start + 1;
+    }
+    
     // check the consequence alternates for each base in the coding sequence
     Region region = _get_gene_range(_tx);
+    int first = region.start - _tx.get_start() + _tx.get_genomic_offset() - mid_pos;
+    for (int idx=first; idx < first + kmer_length - 1; idx++) { add_base(idx); }
+    
+    bool fwd = _tx.get_strand() == '+';
+    size_t e = 0;  // first exon not entirely upstream of the current site
+    size_t c = 0;  // first CDS region not entirely upstream of the current site
     for (int i=region.start; i < region.end + 1; i++ ) {
-        check_position(i);
+        int idx = i - region.start + first;
+        add_base(idx + kmer_length - 1);
+        
+        std::int64_t code = -1;
+        if (unknown < idx) { code = fwd ? fwd_code : rev_code; }
+        
+        if (!track) {
+            check_position(i, code);
+            continue;
+        }
+        
+        while (e < exons.size() && exons[e].end + 8 < i) { e++; }
+        if (e == exons.size() || exons[e].start - 8 > i) { continue; }
+        
+        size_t k = e;  // exon which could contain the site
+        while (k < exons.size() && exons[k].end < i) { k++; }
+        while (c < cds.size() && cds[c].end < i) { c++; }
+        bool coding = c < cds.size() && cds[c].start <= i;
+        bool in_exon = k < exons.size() && exons[k].start <= i;
+        if (!coding || !in_exon) {
+            check_position(i, code);
+            continue;
+        }
+        
+        int ascending = before[c] + (i - cds[c].start);
+        int cds_pos = fwd ? ascending : coding_total - 1 - ascending;
+        int codon_start = cds_pos - cds_pos % 3;
+        if (codon_start + 3 > cds_length) {
+            check_position(i, code);
+            continue;
+        }
+        
+        std::int64_t codon_code = 0;
+        for (int j=codon_start; j < codon_start + 3; j++) {
+            std::uint8_t base = encode_base(cds_seq[j]);
+            codon_code = (base > 3) ? -1 : (codon_code << 2) | base;
+            if (codon_code < 0) { break; }
+        }
+        
+        std::uint8_t initial;
+        if (codon_code < 0 || !reference_base(i, initial)) {
+            check_position(i, code);
+            continue;
+        }
+        
+        boundary_dist = std::min(i - exons[k].start, exons[k].end - i) + 1;
+        add_alternates(i, code, initial, codon_code, cds_pos % 3, cds_pos, 0);
+    }
+}
+
+std::int64_t SitesChecks::encode_site(int bp) {
+    /**
+        encode the k-mer centered on a site, on the transcript strand
+        
+        @bp genomic position of the site
+        @return 2-bit encoded k-mer, or -1 if the k-mer extends past the
+            genomic sequence, or has bases other than A, C, G or T.
+    */
+    
+    const std::string & gdna = _tx.get_genomic_sequence();
+    int idx = bp - _tx.get_start() + _tx.get_genomic_offset() - mid_pos;
+    if (idx < 0 || idx + kmer_length > static_cast<int>(gdna.size())) {
+        return -1;
     }
+    
+    std::int64_t code = encode_kmer(gdna.substr(idx, kmer_length));
+    if (code < 0 || _tx.get_strand() == '+') { return code; }
+    
+    // reverse complement the encoded k-mer for the minus strand
+    std::int64_t rev_code = 0;
+    for (int i=0; i < kmer_length; i++) {
+        rev_code = (rev_code << 2) | (3 - (code & 3));
+        code >>= 2;
+    }
+    
+    return rev_code;
 }
 
 void SitesChecks::initialise_choices() {
     // initialise a WeightedChoice object for each consequence category
     for (auto category : categories) {
-        rates[category] = Chooser();
+        rates[category] = std::make_shared<Chooser>();
+        summed[category] = 0.0;
     }
 }
 
+void SitesChecks::clear() {
+    /**
+        empty the sites for every category, so they can be built up again by
+        checking positions one at a time
+        
+        Every category is treated as complete after this, and gets sites from
+        later position checks, since walking the transcript to build a
+        category would add sites that weren't checked.
+    */
+    
+    initialise_choices();
+    active = std::set<std::string>(categories.begin(), categories.end());
+    built = active;
+}
+
 std::string SitesChecks::check_consequence(std::string initial_aa,
         std::string mutated_aa, int position) {
     /**
@@ -99,6 +368,25 @@ std::string SitesChecks::check_consequence(std::string initial_aa,
     return cq;
 }
 
+std::string SitesChecks::check_consequence(const CodonChange & change) {
+    /**
+         get the consequence of a base change within the coding region
+         
+         This matches check_consequence(initial_aa, mutated_aa, position) for
+         sites in the coding region, but uses the precomputed codon change.
+     */
+    
+    if ( change.consequence == NONSENSE ) {
+        return "nonsense";
+    } else if ( change.consequence == MISSENSE ) {
+        return "missense";
+    } else if ( boundary_dist < 4 ) {
+        return "splice_region";
+    }
+    
+    return "synonymous";
+}
+
 void SitesChecks::check_position(int bp) {
     /**
         add the consequence specific rates for the alternates for a variant
@@ -106,26 +394,67 @@ void SitesChecks::check_position(int bp) {
         @bp genomic position of the variant
     */
     
+    check_position(bp, encode_site(bp));
+}
+
+bool SitesChecks::reference_base(int bp, std::uint8_t & initial) {
+    /**
+        get the reference base for a site, if the site needs checking
+        
+        @bp genomic position of the site
+        @initial 2-bit code for the reference base, with respect to the
+            transcript strand
+        @return false for sites which are masked, outside the CDS region or
+            have an unknown reference base.
+    */
+    
     // ignore sites within masked regions (typically masked because the
     // site has been picked up on alternative transcript)
     if ( has_mask && masked.in_coding_region(bp) ) {
-        return ;
+        return false;
     }
     
     // ignore sites outside the CDS region
     if (bp < std::min(_tx.get_cds_start(), _tx.get_cds_end()) ||
         bp > std::max(_tx.get_cds_start(), _tx.get_cds_end())) {
-        return ;
+        return false;
     }
     
-    std::string seq = _tx.get_centered_sequence(bp, kmer_length);
-    boundary_dist = _tx.get_boundary_distance(bp);
+    // get the reference base, with respect to the transcript strand
+    const std::string & gdna = _tx.get_genomic_sequence();
+    int idx = bp - _tx.get_start() + _tx.get_genomic_offset();
+    if (idx < 0 || idx >= static_cast<int>(gdna.size())) {
+        throw std::invalid_argument("sequence position not in gene range");
+    }
+    initial = encode_base(gdna[idx]);
+    if (initial > 3) {
+        return false;
+    }
     
-    char fwd = '+';
-    if (_tx.get_strand() != fwd) {
-        seq = _tx.reverse_complement(seq);
+    if (_tx.get_strand() != '+') {
+        initial = 3 - initial;
+    }
+    
+    return true;
+}
+
+void SitesChecks::check_position(int bp, std::int64_t code) {
+    /**
+        add the consequence specific rates for the alternates for a variant
+        
+        @bp genomic position of the variant
+        @code 2-bit encoded k-mer centered on the variant, on the transcript
+            strand, or -1 if the sequence context is unknown (which gives
+            rates of zero).
+    */
+    
+    std::uint8_t initial;
+    if (!reference_base(bp, initial)) {
+        return ;
     }
     
+    boundary_dist = _tx.get_boundary_distance(bp);
+    
     Codon codon;
     try {
         codon = _tx.get_codon_info(bp);
@@ -133,42 +462,78 @@ void SitesChecks::check_position(int bp) {
         return ;
     }
     
-    std::string initial_aa = codon.initial_aa;
-    int cds_pos = codon.cds_pos;
-    int offset = codon.offset;
+    // sites in the coding region get consequences from the codon change table
+    std::int64_t codon_code = -1;
+    if ( codon.initial_aa != "" ) {
+        codon_code = encode_kmer(codon.codon_seq);
+        if (codon_code < 0) {
+            throw std::invalid_argument("cannot translate codon: " + codon.codon_seq);
+        }
+    }
     
-    // drop the initial base, since we want to mutate to other bases
-    std::vector<std::string> alts(bases);
-    alts.erase(std::find(alts.begin(), alts.end(), seq.substr(mid_pos, 1)));
+    add_alternates(bp, code, initial, codon_code, codon.intra_codon,
+        codon.cds_pos, codon.offset);
+}
+
+void SitesChecks::add_alternates(int bp, std::int64_t code, std::uint8_t initial,
+        std::int64_t codon_code, int intra_codon, int cds_pos, int offset) {
+    /**
+        add the rates for each alternate base at a site to their categories
+        
+        This needs boundary_dist to be set for the site.
+        
+        @bp genomic position of the site
+        @code 2-bit encoded k-mer centered on the site, or -1 if unknown
+        @initial 2-bit code for the reference base, on the transcript strand
+        @codon_code 2-bit encoded codon containing the site, or -1 for sites
+            outside the coding region
+        @intra_codon position of the site within the codon (0-based)
+        @cds_pos position of the site within the CDS
+        @offset distance from the site to the closest exon boundary, for
+            sites outside the coding region
+    */
     
-    for (auto &alt : alts) {
-        std::string mutated_aa = initial_aa;
-        std::string alt_seq = seq.substr(0, mid_pos) + alt +
-            seq.substr(mid_pos + 1, kmer_length - mid_pos);
+    char fwd = '+';
+    bool coding = codon_code >= 0;
+    for (int base=0; base < 4; base++) {
+        // skip the initial base, since we want to mutate to other bases
+        if (base == initial) { continue; }
         
-        double rate = mut_dict[seq][alt_seq];
-        if ( initial_aa != "" ) {
-            mutated_aa = _get_mutated_aa(_tx, alt, codon.codon_seq, codon.intra_codon);
-        }
+        std::string alt = bases[base];
+        double rate = (code < 0) ? 0.0 : mut_rates.get_rate(code, base);
         
-        std::string category = check_consequence(initial_aa, mutated_aa, bp);
+        std::string category;
+        if ( coding ) {
+            category = check_consequence(_get_codon_change(codon_code,
+                intra_codon, base));
+        } else {
+            category = check_consequence("", "", bp);
+        }
         
         // figure out what the ref and alt alleles are, with respect to
-        // the + strand.
-        std::string ref = seq.substr(mid_pos, 1);
+        // the + strand. Complementing a 2-bit code is 3 - code.
+        std::string ref = bases[initial];
         if (_tx.get_strand() != fwd) {
-            ref = transdict[ref];
-            alt = transdict[alt];
+            ref = bases[3 - initial];
+            alt = bases[3 - base];
         }
         
-        if (use_cds_coords) {
-            rates[category].add_choice(cds_pos, rate, ref, alt, offset);
-        } else {
-            rates[category].add_choice(bp, rate, ref, alt, 0);
+        bool lof = category == "nonsense" || category == "splice_lof";
+        if (summing) {
+            summed[category] += rate;
+            if (lof) { summed["loss_of_function"] += rate; }
+        }
+        
+        if (active.count(category) > 0) {
+            if (use_cds_coords) {
+                writable(category).add_choice(cds_pos, rate, ref, alt, offset);
+            } else {
+                writable(category).add_choice(bp, rate, ref, alt, 0);
+            }
         }
         
-        if (category == "nonsense" || category == "splice_lof") {
-            rates["loss_of_function"].add_choice(cds_pos, rate, ref, alt, offset);
+        if (lof && active.count("loss_of_function") > 0) {
+            writable("loss_of_function").add_choice(cds_pos, rate, ref, alt, offset);
         }
     }
 }
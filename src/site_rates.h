@@ -1,13 +1,25 @@
 #ifndef DENOVONEAR_SITESCHECKS_H_
 #define DENOVONEAR_SITESCHECKS_H_
 
+#include <cstdint>
+#include <memory>
 #include <string>
 #include <vector>
 #include <map>
+#include <set>
 
 #include "tx.h"
+#include "mutation_rates.h"
 #include "weighted_choice.h"
 
+// consequence classes for a base change within a codon
+enum CodonConsequence { SYNONYMOUS, MISSENSE, NONSENSE };
+
+struct CodonChange {
+    char mutated_aa;
+    std::uint8_t consequence;  // a CodonConsequence
+};
+
 class SitesChecks {
     /**
     class to build weighted choice random samplers for nonsense, missense,
@@ -18,39 +30,67 @@ class SitesChecks {
     defined at: http://www.ensembl.org/info/genome/variation/predicted_data.html
     */
     
-    std::unordered_map<std::string, std::unordered_map<std::string, double>> mut_dict;
-    std::unordered_map<std::string, Chooser> rates;
+    const MutationRates & mut_rates;
+    // the sites for each category are shared with any WeightedChoice views
+    // of them, and copied before they are changed while shared
+    std::unordered_map<std::string, std::shared_ptr<Chooser>> rates;
+    std::unordered_map<std::string, double> summed;
+    
+    // categories to add sites to, and categories whose sites are complete.
+    // Others are only built if they are requested later.
+    std::set<std::string> active;
+    std::set<std::string> built;
+    bool summing = true;
     int boundary_dist;
     int kmer_length;
     int mid_pos;
     
-    std::unordered_map<std::string, std::string> transdict = {
-        {"A", "T"}, {"T", "A"}, {"G", "C"}, {"C", "G"}};
-    
+    // bases in the order of their 2-bit codes from encode_base()
     std::vector<std::string> bases = {"A", "C", "G", "T"};
     std::vector<std::string> categories = {"missense", "nonsense", "synonymous",
         "splice_lof", "splice_region", "loss_of_function"};
 
  public:
-    SitesChecks(Tx tx, std::vector<std::vector<std::string>> mut, bool cds_coords) :
-         _tx { tx }, use_cds_coords { cds_coords } { init(mut); };
-    SitesChecks(Tx tx, std::vector<std::vector<std::string>> mut, bool cds_coords, Tx mask) :
-         _tx { tx }, masked { mask }, use_cds_coords { cds_coords } { has_mask = true; init(mut); };
-    Chooser * __getitem__(std::string category) { return &rates[category]; };
+    SitesChecks(Tx tx, const MutationRates & mut, bool cds_coords) :
+         mut_rates { mut }, _tx { tx }, use_cds_coords { cds_coords } { init(categories); };
+    SitesChecks(Tx tx, const MutationRates & mut, bool cds_coords, Tx mask) :
+         mut_rates { mut }, _tx { tx }, masked { mask }, use_cds_coords { cds_coords } { has_mask = true; init(categories); };
+    SitesChecks(Tx tx, const MutationRates & mut, bool cds_coords,
+        std::vector<std::string> wanted) :
+         mut_rates { mut }, _tx { tx }, use_cds_coords { cds_coords } { init(wanted); };
+    SitesChecks(Tx tx, const MutationRates & mut, bool cds_coords, Tx mask,
+        std::vector<std::string> wanted) :
+         mut_rates { mut }, _tx { tx }, masked { mask }, use_cds_coords { cds_coords } { has_mask = true; init(wanted); };
+    std::shared_ptr<Chooser> __getitem__(std::string category) { return get(category); };
+    Chooser collapsed(std::string category) { return get(category)->collapsed(); };
+    double get_summed_rate(std::string category) { return summed[category]; };
     void initialise_choices();
+    void clear();
     
     void check_position(int bp);
+    void check_position(int bp, std::int64_t code);
     std::string check_consequence(std::string initial_aa, std::string mutated_aa, int position);
+    std::string check_consequence(const CodonChange & change);
     
  private:
     Tx _tx;
     Tx masked = Tx("zz", "z", -100, -100, '+');
-    void init(std::vector<std::vector<std::string>> mut);
+    void init(std::vector<std::string> wanted);
+    void walk();
+    std::shared_ptr<Chooser> get(std::string category);
+    Chooser & writable(const std::string & category);
+    std::int64_t encode_site(int bp);
+    bool reference_base(int bp, std::uint8_t & initial);
+    void add_alternates(int bp, std::int64_t code, std::uint8_t initial,
+        std::int64_t codon_code, int intra_codon, int cds_pos, int offset);
     bool has_mask = false;
     bool use_cds_coords = true;
 };
 
 Region _get_gene_range(Tx & tx);
+bool _sorted_regions(const std::vector<Region> & regions);
 std::string _get_mutated_aa(Tx & tx, std::string base, std::string codon, int intra_codon);
+const CodonChange & _get_codon_change(std::int64_t codon, int intra_codon, int alt);
+CodonChange _get_codon_change(std::string codon, int intra_codon, std::string alt);
 
 #endif  // DENOVONEAR_SITESCHECKS_H_
@@ -98,7 +98,7 @@ class Tx {
     void add_cds_sequence(std::string cds_dna);
     void add_genomic_sequence(std::string gdna, int offset);
     std::string get_cds_sequence() { return cds_sequence; }
-    std::string get_genomic_sequence() { return genomic_sequence; }
+    const std::string & get_genomic_sequence() { return genomic_sequence; }
     int get_genomic_offset() { return gdna_offset; }
     
     void _fix_transcript_off_by_one_bp();
@@ -1,18 +1,61 @@
+#include <cmath>
 #include <random>
 #include <vector>
 #include <chrono>
 #include <algorithm>
+#include <limits>
+#include <map>
+#include <stdexcept>
 
 #include "weighted_choice.h"
 
+std::uint8_t encode_base(char base) {
+    /**
+        convert a single base character to a 2-bit code, or 4 for anything else
+    */
+    
+    switch (base) {
+        case 'A': case 'a': return 0;
+        case 'C': case 'c': return 1;
+        case 'G': case 'g': return 2;
+        case 'T': case 't': return 3;
+        default: return 4;
+    }
+}
+
+std::uint8_t encode_base(const std::string & base) {
+    /**
+        convert a single base to a 2-bit code, or 4 for anything else e.g. 'N'
+    */
+    
+    if (base.size() != 1) { return 4; }
+    return encode_base(base[0]);
+}
+
+std::uint8_t encode_alleles(const std::string & ref, const std::string & alt) {
+    /**
+        pack the ref and alt alleles into a single byte, with the ref code in
+        the high four bits, and the alt code in the low four bits
+    */
+    
+    return (encode_base(ref) << 4) | encode_base(alt);
+}
+
+std::string decode_allele(std::uint8_t code) {
+    /**
+        convert a code from encode_base() back to the base
+    */
+    
+    static const std::string bases[5] = {"A", "C", "G", "T", "N"};
+    return bases[std::min(code, static_cast<std::uint8_t>(4))];
+}
+
 Chooser::Chooser() {
     /**
         Constructor for Chooser class
+        
+        The random sampler starts from fresh entropy, unless seed() is called.
     */
-    
-    // start the random sampler
-    std::random_device rd;
-    generator.seed(rd());
 }
 
 void Chooser::reset_sampler() {
@@ -20,6 +63,109 @@ void Chooser::reset_sampler() {
     // from all the possible entries.
     std::uniform_real_distribution<double> temp(0.0, get_summed_rate());
     dist = temp;
+    alias_stale = true;
+    logs_stale = true;
+    std::vector<double>().swap(logs);
+}
+
+void Chooser::build_alias() {
+    /**
+        construct a Walker/Vose alias table from the current sites
+        
+        Each slot holds the probability of keeping the slot, and the index of
+        the alternative site to return otherwise, so that a draw needs only a
+        uniform slot index and a uniform float, regardless of the site count.
+    */
+    
+    int len = positions.size();
+    double total = get_summed_rate();
+    
+    alias_prob.assign(len, 1.0);
+    alias_idx.resize(len);
+    for (int i=0; i < len; i++) { alias_idx[i] = i; }
+    
+    std::uniform_int_distribution<int> temp_index(0, std::max(len - 1, 0));
+    index = temp_index;
+    alias_stale = false;
+    
+    if (len == 0 || total <= 0.0) { return; }
+    
+    // scale the probabilities so the mean slot probability is one, then split
+    // the slots into those under and over the mean
+    std::vector<double> scaled(len);
+    std::vector<int> small;
+    std::vector<int> large;
+    for (int i=0; i < len; i++) {
+        scaled[i] = probs[i] * len / total;
+        if (scaled[i] < 1.0) {
+            small.push_back(i);
+        } else {
+            large.push_back(i);
+        }
+    }
+    
+    // pair each underfull slot with an overfull site, which donates the
+    // remaining probability for the slot
+    while (!small.empty() && !large.empty()) {
+        int less = small.back();
+        small.pop_back();
+        int more = large.back();
+        
+        alias_prob[less] = scaled[less];
+        alias_idx[less] = more;
+        
+        scaled[more] = (scaled[more] + scaled[less]) - 1.0;
+        if (scaled[more] < 1.0) {
+            large.pop_back();
+            small.push_back(more);
+        }
+    }
+    
+    // any remaining slots are full, barring floating point error
+    for (auto i : small) { alias_prob[i] = 1.0; }
+    for (auto i : large) { alias_prob[i] = 1.0; }
+}
+
+void Chooser::prepare_logs() {
+    /**
+        tabulate log10(d) at index d, for every distance d up to the span of
+        the sites, plus one for the adjustment for zero distances
+        
+        The table is left empty if the span is too wide to tabulate.
+    */
+    
+    if (!logs_stale) { return; }
+    logs_stale = false;
+    
+    if (positions.empty()) { return; }
+    
+    auto range = std::minmax_element(positions.begin(), positions.end());
+    int span = *range.second - *range.first;
+    if (span > MAX_LOG_SPAN) { return; }
+    
+    logs.resize(span + 2);
+    for (int d=0; d < span + 2; d++) { logs[d] = std::log10(d); }
+}
+
+int Chooser::sample_index() {
+    /**
+        pick the index of a site, either from the alias table, or by a binary
+        search of the cumulative probabilities
+    */
+    
+    if (alias) {
+        if (alias_stale) { build_alias(); }
+        
+        int slot = index(generator);
+        return (unit(generator) < alias_prob[slot]) ? slot : alias_idx[slot];
+    }
+    
+    // get a random float between 0 and the cumulative sum
+    double number = dist(generator);
+    
+    // figure out where in the list a random probability would fall
+    auto pos = std::lower_bound(cumulative.begin(), cumulative.end(), number);
+    return pos - cumulative.begin();
 }
 
 void Chooser::add_choice(int site, double prob, std::string ref, std::string alt, int offset) {
@@ -35,14 +181,93 @@ void Chooser::add_choice(int site, double prob, std::string ref, std::string alt
             regions.
     */
     
+    if (offset < std::numeric_limits<std::int8_t>::min() ||
+            offset > std::numeric_limits<std::int8_t>::max()) {
+        throw std::invalid_argument("offset outside the range of -128 to 127");
+    }
+    
     // keep track of the cumulative sum for each added site
     double cumulative_sum = get_summed_rate() + prob;
     cumulative.push_back(cumulative_sum);
     
-    sites.push_back(AlleleChoice {site, ref, alt, prob, offset});
+    positions.push_back(site);
+    alleles.push_back(encode_alleles(ref, alt));
+    offsets.push_back(offset);
+    probs.push_back(prob);
+    reset_sampler();
+}
+
+void Chooser::add_choices(int count, const int * sites, const double * weights,
+        const char * refs, const char * alts, const int * site_offsets) {
+    /**
+        adds many choices at once, from arrays
+        
+        This reserves space once, and builds the cumulative sums in a single
+        pass, rather than resetting the sampler after every site.
+        
+        @count number of sites to add
+        @sites array of site positions
+        @weights array of site mutation rates
+        @refs array of single character reference alleles, or NULL for 'N'
+        @alts array of single character alternate alleles, or NULL for 'N'
+        @site_offsets array of offsets from the true site, or NULL for zero
+    */
+    
+    if (site_offsets != NULL) {
+        for (int i=0; i < count; i++) {
+            if (site_offsets[i] < std::numeric_limits<std::int8_t>::min() ||
+                    site_offsets[i] > std::numeric_limits<std::int8_t>::max()) {
+                throw std::invalid_argument("offset outside the range of -128 to 127");
+            }
+        }
+    }
+    
+    int total = len() + count;
+    positions.reserve(total);
+    alleles.reserve(total);
+    offsets.reserve(total);
+    probs.reserve(total);
+    cumulative.reserve(total);
+    
+    double cumulative_sum = get_summed_rate();
+    for (int i=0; i < count; i++) {
+        cumulative_sum += weights[i];
+        cumulative.push_back(cumulative_sum);
+        positions.push_back(sites[i]);
+        std::uint8_t ref = (refs == NULL) ? 4 : encode_base(refs[i]);
+        std::uint8_t alt = (alts == NULL) ? 4 : encode_base(alts[i]);
+        alleles.push_back((ref << 4) | alt);
+        offsets.push_back((site_offsets == NULL) ? 0 : site_offsets[i]);
+        probs.push_back(weights[i]);
+    }
+    
     reset_sampler();
 }
 
+void Chooser::copy_sites(int * sites, double * weights, char * refs,
+        char * alts, int * site_offsets) const {
+    /**
+        copies the sites into arrays, the inverse of add_choices()
+        
+        Each array must have space for len() entries.
+        
+        @sites array for site positions
+        @weights array for site mutation rates
+        @refs array for single character reference alleles
+        @alts array for single character alternate alleles
+        @site_offsets array for offsets from the true site
+    */
+    
+    static const char bases[5] = {'A', 'C', 'G', 'T', 'N'};
+    for (int i=0; i < len(); i++) {
+        sites[i] = positions[i];
+        weights[i] = probs[i];
+        refs[i] = bases[std::min(alleles[i] >> 4, 4)];
+        alts[i] = bases[std::min(alleles[i] & 0x0F, 4)];
+        site_offsets[i] = offsets[i];
+    }
+}
+
 AlleleChoice Chooser::choice() {
     /**
         chooses a random element using a set of probability weights
@@ -54,32 +279,182 @@ AlleleChoice Chooser::choice() {
         return AlleleChoice {-1, "N", "N", 0.0, 0};
     }
     
-    // get a random float between 0 and the cumulative sum
-    double number = dist(generator);
+    return iter(sample_index());
+}
+
+int Chooser::choice_pos() {
+    /**
+        chooses a random site, but only returns the position
+        
+        This avoids constructing the allele strings, for callers which only
+        need the site position, such as the clustering simulations.
+        
+        @returns position of the chosen site, or -1 if there are no sites
+    */
     
-    // figure out where in the list a random probability would fall
+    if (cumulative.empty()) { return -1; }
+    
+    return positions[sample_index()];
+}
+
+int Chooser::sample_index(CounterRng & rng) const {
+    /**
+        pick the index of a site using an external random number generator
+        
+        This leaves the Chooser unchanged, so multiple threads can sample from
+        one Chooser at once, provided each has its own generator. The alias
+        table is only used if it has already been built by prepare().
+    */
+    
+    if (alias && !alias_stale) {
+        std::uniform_int_distribution<int> slots(0, alias_prob.size() - 1);
+        std::uniform_real_distribution<double> keep(0.0, 1.0);
+        int slot = slots(rng);
+        return (keep(rng) < alias_prob[slot]) ? slot : alias_idx[slot];
+    }
+    
+    std::uniform_real_distribution<double> weights(0.0, cumulative.back());
+    double number = weights(rng);
     auto pos = std::lower_bound(cumulative.begin(), cumulative.end(), number);
-    int offset = pos - cumulative.begin();
+    return pos - cumulative.begin();
+}
+
+AlleleChoice Chooser::choice(CounterRng & rng) const {
+    /**
+        chooses a random element, using an external random number generator
+        
+        @rng random number generator, one per thread
+        @returns AlleleChoice struct containing the pos, ref and alt
+    */
+    
+    if (cumulative.empty()) {
+        return AlleleChoice {-1, "N", "N", 0.0, 0};
+    }
+    
+    return iter(sample_index(rng));
+}
+
+int Chooser::choice_pos(CounterRng & rng) const {
+    /**
+        chooses a random site position, using an external random number
+        generator, so multiple threads can sample at once
+        
+        @rng random number generator, one per thread
+        @returns position of the chosen site, or -1 if there are no sites
+    */
     
-    return sites[offset];
+    if (cumulative.empty()) { return -1; }
+    
+    return positions[sample_index(rng)];
 }
 
-double Chooser::get_summed_rate() {
+void Chooser::choice_many(int count, std::uint64_t seed, int * sites,
+        char * refs, char * alts, int * site_offsets) const {
+    /**
+        chooses many random sites in one loop, writing them to arrays
+        
+        The sampler must be prepared beforehand (see prepare()).
+        
+        @count number of sites to draw
+        @seed seed for the random number generator, so draws can be repeated
+        @sites array for the chosen positions, or -1 if there are no sites
+        @refs array for reference alleles, or NULL to skip the alleles
+        @alts array for alternate alleles, or NULL to skip the alleles
+        @site_offsets array for site offsets, or NULL to skip the offsets
+    */
+    
+    static const char bases[5] = {'A', 'C', 'G', 'T', 'N'};
+    CounterRng rng(seed);
+    for (int i=0; i < count; i++) {
+        if (cumulative.empty()) {
+            sites[i] = -1;
+            if (refs != NULL) { refs[i] = 'N'; }
+            if (alts != NULL) { alts[i] = 'N'; }
+            if (site_offsets != NULL) { site_offsets[i] = 0; }
+            continue;
+        }
+        
+        int idx = sample_index(rng);
+        sites[i] = positions[idx];
+        if (refs != NULL) { refs[i] = bases[std::min(alleles[idx] >> 4, 4)]; }
+        if (alts != NULL) { alts[i] = bases[std::min(alleles[idx] & 0x0F, 4)]; }
+        if (site_offsets != NULL) { site_offsets[i] = offsets[idx]; }
+    }
+}
+
+AlleleChoice Chooser::iter(int pos) const {
+    /**
+        get the details for a site
+        
+        @pos index of the site
+        @returns AlleleChoice struct containing the pos, ref and alt
+    */
+    
+    std::uint8_t code = alleles[pos];
+    return AlleleChoice {positions[pos], decode_allele(code >> 4),
+        decode_allele(code & 0x0f), probs[pos], offsets[pos]};
+}
+
+double Chooser::get_summed_rate() const {
     /**
         gets the cumulative sum for all the current choices.
     */
     
-    return (sites.empty()) ? 0.0 : cumulative.back() ;
+    return (cumulative.empty()) ? 0.0 : cumulative.back() ;
 }
 
-void Chooser::append(Chooser other) {
+void Chooser::append(const Chooser & other) {
     
     double current = get_summed_rate();
-    int len = other.sites.size();
+    int len = other.len();
     for (int i=0; i < len; i++) {
         cumulative.push_back(other.cumulative[i] + current);
-        sites.push_back(other.sites[i]);
     }
+    positions.insert(positions.end(), other.positions.begin(), other.positions.end());
+    alleles.insert(alleles.end(), other.alleles.begin(), other.alleles.end());
+    offsets.insert(offsets.end(), other.offsets.begin(), other.offsets.end());
+    probs.insert(probs.end(), other.probs.begin(), other.probs.end());
     
     reset_sampler();
 }
+
+Chooser Chooser::collapsed() const {
+    /**
+        make a position level sampler, by summing the rates for all the sites
+        which share a position and offset
+        
+        Sites keep the order in which their position first appears. The ref
+        allele is kept, but the alt allele becomes 'N', since the merged site
+        covers several alternates.
+        
+        @returns Chooser with one site per position and offset
+    */
+    
+    Chooser merged;
+    merged.alias = alias;
+    
+    std::map<std::pair<int, int>, int> seen;
+    for (int i=0; i < len(); i++) {
+        auto key = std::make_pair(positions[i], static_cast<int>(offsets[i]));
+        auto found = seen.find(key);
+        if (found == seen.end()) {
+            seen[key] = merged.len();
+            merged.positions.push_back(positions[i]);
+            merged.alleles.push_back((alleles[i] & 0xf0) | 4);
+            merged.offsets.push_back(offsets[i]);
+            merged.probs.push_back(probs[i]);
+        } else {
+            merged.probs[found->second] += probs[i];
+        }
+    }
+    
+    // build the cumulative sums once all the sites are merged
+    double total = 0.0;
+    for (auto prob : merged.probs) {
+        total += prob;
+        merged.cumulative.push_back(total);
+    }
+    merged.reset_sampler();
+    
+    return merged;
+}
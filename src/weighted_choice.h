@@ -1,10 +1,13 @@
 #ifndef DENOVONEAR_WEIGHTED_CHOICE_H_
 #define DENOVONEAR_WEIGHTED_CHOICE_H_
 
+#include <cstdint>
 #include <random>
 #include <vector>
 #include <string>
 
+#include "counter_rng.h"
+
 struct AlleleChoice {
     int pos;
     std::string ref;
@@ -16,20 +19,69 @@ struct AlleleChoice {
 };
 
 class Chooser {
-    std::vector<AlleleChoice> sites;
+    // sites are stored as parallel arrays, with the ref and alt alleles packed
+    // into one byte per site
+    std::vector<std::int32_t> positions;
+    std::vector<std::uint8_t> alleles;
+    std::vector<std::int8_t> offsets;
+    std::vector<double> probs;
     std::vector<double> cumulative;
     std::uniform_real_distribution<double> dist;
-    std::mt19937_64 generator;
+    CounterRng generator;
     void reset_sampler();
+    
+    // alias table for O(1) sampling, rebuilt whenever the sites change
+    bool alias = true;
+    bool alias_stale = true;
+    std::vector<double> alias_prob;
+    std::vector<int> alias_idx;
+    std::uniform_real_distribution<double> unit;
+    std::uniform_int_distribution<int> index;
+    void build_alias();
+    
+    // log10 of every distance between the sites, for looking up the logs of
+    // pairwise distances when simulating many de novos. Built once, and
+    // rebuilt whenever the sites change.
+    bool logs_stale = true;
+    std::vector<double> logs;
+    int sample_index();
+    int sample_index(CounterRng & rng) const;
 
  public:
     Chooser();
     void add_choice(int site, double prob, std::string ref="N", std::string alt="N", int offset=0);
+    void add_choices(int count, const int * sites, const double * weights,
+        const char * refs, const char * alts, const int * site_offsets);
+    void copy_sites(int * sites, double * weights, char * refs, char * alts,
+        int * site_offsets) const;
     AlleleChoice choice();
-    double get_summed_rate();
-    int len() { return sites.size() ;};
-    AlleleChoice iter(int pos) { return sites[pos]; };
-    void append(Chooser other);
+    AlleleChoice choice(CounterRng & rng) const;
+    int choice_pos();
+    int choice_pos(CounterRng & rng) const;
+    void choice_many(int count, std::uint64_t seed, int * sites, char * refs,
+        char * alts, int * site_offsets) const;
+    void seed(std::uint64_t seed, std::uint64_t stream=0) { generator = CounterRng(seed, stream); };
+    std::uint64_t next_seed() { return generator(); };
+    void prepare() { if (alias && alias_stale) { build_alias(); } };
+    void prepare_logs();
+    const std::vector<double> & distance_logs() const { return logs; };
+    double get_summed_rate() const;
+    int len() const { return positions.size() ;};
+    AlleleChoice iter(int pos) const;
+    int get_pos(int i) const { return positions[i]; };
+    double get_prob(int i) const { return probs[i]; };
+    void append(const Chooser & other);
+    Chooser collapsed() const;
+    void use_alias(bool use) { alias = use; };
+    bool uses_alias() { return alias; };
 };
 
+// widest span of sites to tabulate the logs of distances for, which keeps
+// the table under 32 MB
+const int MAX_LOG_SPAN = 4000000;
+
+std::uint8_t encode_base(char base);
+std::uint8_t encode_alleles(const std::string & ref, const std::string & alt);
+std::string decode_allele(std::uint8_t code);
+
 #endif  // DENOVONEAR_WEIGHTED_CHOICE_H_
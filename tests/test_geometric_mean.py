@@ -20,9 +20,10 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import math
+import random
 import unittest
 
-from denovonear.weights import get_distances, geomean
+from denovonear.weights import get_distances, geomean, geomean_of_sites
 
 class TestGeomeanPy(unittest.TestCase):
     """ unit test the geomean function
@@ -69,3 +70,35 @@ class TestGeomeanPy(unittest.TestCase):
             get_distances([0, 1, "e"])
         
     
+    
+    def test_geomean_of_sites(self):
+        """ test geomean_of_sites() matches geomean() of the pairwise distances
+        """
+        
+        self.assertEqual(geomean_of_sites([0, 1]), 1)
+        self.assertEqual(geomean_of_sites([0, 0]), 0)
+        self.assertTrue(math.isnan(geomean_of_sites([0])))
+        
+        # the results are identical, not merely close, including when some
+        # sites share a position
+        for length in [2, 3, 5, 20, 100]:
+            for x in range(200):
+                sites = [ random.randint(0, 100) for x in range(length) ]
+                expected = geomean(get_distances(sites))
+                self.assertEqual(geomean_of_sites(sites), expected)
+    
+    def test_geomean_of_sites_tabulated(self):
+        """ test geomean_of_sites() gives identical values from a log table
+        """
+        
+        self.assertEqual(geomean_of_sites([0, 1], tabulate=True), 1)
+        self.assertEqual(geomean_of_sites([0, 0], tabulate=True), 0)
+        self.assertTrue(math.isnan(geomean_of_sites([0], tabulate=True)))
+        
+        for length in [2, 5, 20, 100]:
+            for x in range(200):
+                sites = [ random.randint(0, 5000) for x in range(length) ]
+                if x % 2 == 0:
+                    sites[0] = sites[-1]
+                expected = geomean_of_sites(sites)
+                self.assertEqual(geomean_of_sites(sites, tabulate=True), expected)
@@ -0,0 +1,119 @@
+"""
+Copyright (c) 2015 Genome Research Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from denovonear.weights import WeightedChoice
+from denovonear.null_cache import NullDistribution, NullCache
+
+class TestNullCachePy(unittest.TestCase):
+    """ unit test the NullDistribution and NullCache classes
+    """
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.values = numpy.random.RandomState(1).exponential(size=50000)
+        self.sorted = numpy.sort(self.values)
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+    
+    def true_count(self, observed):
+        return numpy.searchsorted(self.sorted, observed, side='right')
+    
+    def test_counts(self):
+        """ check counts are exact in the tail, and close beyond it
+        """
+        
+        null = NullDistribution.from_simulations(self.values)
+        self.assertEqual(null.total, 50000)
+        self.assertEqual(len(null.tail), NullDistribution.TAIL)
+        
+        for observed in [-1, 0.0001, 0.01, 0.1, self.sorted[9998]]:
+            self.assertEqual(null.count(observed), self.true_count(observed))
+        
+        for observed in [0.5, 1, 2]:
+            expected = self.true_count(observed)
+            self.assertTrue(abs(null.count(observed) - expected) < 0.01 * expected)
+        self.assertEqual(null.count(100), 50000)
+        
+        # small runs are kept in full, so every count is exact
+        null = NullDistribution.from_simulations(self.values[:1000])
+        self.assertEqual(null.count(1),
+            numpy.searchsorted(numpy.sort(self.values[:1000]), 1, side='right'))
+    
+    def test_merge(self):
+        """ check merged summaries match a summary of all the simulations
+        """
+        
+        first = NullDistribution.from_simulations(self.values[:20000])
+        second = NullDistribution.from_simulations(self.values[20000:])
+        merged = first + second
+        
+        self.assertEqual(merged.total, 50000)
+        self.assertEqual(merged.tail.tolist(), self.sorted[:10000].tolist())
+        for observed in [0.5, 1, 2]:
+            expected = self.true_count(observed)
+            self.assertTrue(abs(merged.count(observed) - expected) < 0.01 * expected)
+        
+        # merging small runs keeps every value
+        merged = NullDistribution.from_simulations(self.values[:300]) + \
+            NullDistribution.from_simulations(self.values[300:500])
+        self.assertEqual(merged.tail.tolist(), sorted(self.values[:500]))
+    
+    def test_blob(self):
+        """ check summaries survive packing into bytes
+        """
+        
+        null = NullDistribution.from_simulations(self.values)
+        unpacked = NullDistribution.from_blob(null.to_blob())
+        self.assertEqual(unpacked.total, null.total)
+        self.assertEqual(unpacked.tail.tolist(), null.tail.tolist())
+        self.assertEqual(unpacked.ranks.tolist(), null.ranks.tolist())
+        self.assertEqual(unpacked.values.tolist(), null.values.tolist())
+    
+    def test_cache(self):
+        """ check the cache stores summaries by the sites and de novo count
+        """
+        
+        cache = NullCache(os.path.join(self.temp_dir, 'nulls.db'))
+        choices = WeightedChoice.from_arrays([1, 2, 3], [0.1, 0.2, 0.3])
+        key = cache.get_key(choices, 3)
+        
+        self.assertIsNone(cache.get(key))
+        cache.put(key, NullDistribution.from_simulations(self.values[:100]))
+        self.assertEqual(cache.get(key).total, 100)
+        
+        # keys differ for different sites, rates or de novo counts
+        self.assertNotEqual(key, cache.get_key(choices, 4))
+        self.assertNotEqual(key, cache.get_key(
+            WeightedChoice.from_arrays([1, 2, 4], [0.1, 0.2, 0.3]), 3))
+        self.assertNotEqual(key, cache.get_key(
+            WeightedChoice.from_arrays([1, 2, 3], [0.1, 0.2, 0.4]), 3))
+        
+        # a fresh connection to the same file finds the stored summary
+        cache = NullCache(os.path.join(self.temp_dir, 'nulls.db'))
+        self.assertEqual(cache.get(key).total, 100)
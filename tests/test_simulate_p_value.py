@@ -3,14 +3,18 @@
 from __future__ import division
 
 import os
+import shutil
+import tempfile
 import unittest
 import math
 
-from denovonear.weights import WeightedChoice
+from denovonear.weights import WeightedChoice, geomean, get_distances
 from denovonear.transcript import Transcript
 from denovonear.site_specific_rates import SiteRates
 from denovonear.load_mutation_rates import load_mutation_rates
-from denovonear.simulate import get_p_value
+from denovonear.null_cache import NullCache
+from denovonear.simulate import get_p_value, get_p_values, two_de_novo_p_value, \
+    get_exceedances
 
 class TestGetPValuePy(unittest.TestCase):
     """ unit test the simulation of p-values
@@ -111,3 +115,111 @@ class TestGetPValuePy(unittest.TestCase):
         (obs_2, p_2) = get_p_value(tx2, rates2, iterations, cq, de_novos)
         self.assertEqual(obs_1, obs_2)
         self.assertTrue(abs(p_1 - p_2) < 0.017)
+    
+    def test_two_de_novo_p_value(self):
+        """ check the exact p-value for two de novos against a direct sum
+        """
+        
+        choices = WeightedChoice()
+        sites = [(3, 1e-8), (4, 2e-8), (4, 1e-8), (10, 5e-9), (25, 3e-8), (26, 1e-9)]
+        for pos, rate in sites:
+            choices.add_choice(pos, rate)
+        
+        total = sum(rate for _, rate in sites)
+        for distance in [0, 1, 6, 21, 22, 23, 100]:
+            expected = sum(a[1] * b[1] for a in sites for b in sites
+                if abs(a[0] - b[0]) <= distance) / total ** 2
+            p_value = two_de_novo_p_value(choices, distance)
+            self.assertAlmostEqual(p_value, expected, places=12)
+        
+        # sites without any weight can't give a p-value
+        self.assertIsNone(two_de_novo_p_value(WeightedChoice(), 5))
+    
+    def test_get_p_value_two_de_novos_exact(self):
+        """ check that two de novos give the same p-value every time
+        """
+        
+        cq = 'missense'
+        de_novos = [5, 12]
+        p_values = set( get_p_value(self.transcript, self.rates, 10, cq, de_novos)[1]
+            for x in range(5) )
+        self.assertEqual(len(p_values), 1)
+    
+    def test_get_exceedances(self):
+        """ check the stopping count for a target relative standard error
+        """
+        
+        self.assertEqual(get_exceedances(0.1), 100)
+        self.assertEqual(get_exceedances(0.5), 4)
+        self.assertEqual(get_exceedances(0.03), 1112)
+        
+        with self.assertRaises(ValueError):
+            get_exceedances(0)
+    
+    def test_get_p_value_target_rse(self):
+        """ check that a target precision still gives a sensible p-value
+        """
+        
+        cq = 'missense'
+        de_novos = [5, 6, 58]
+        (obs, p_value) = get_p_value(self.transcript, self.rates, 100000, cq,
+            de_novos, target_rse=0.1)
+        self.assertTrue(0 < p_value <= 1)
+    
+    def test_get_p_value_cached(self):
+        """ check p-values from a cached null distribution
+        """
+        
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = NullCache(os.path.join(temp_dir, 'nulls.db'))
+            
+            cq = 'missense'
+            de_novos = [5, 6, 58]
+            (obs, first) = get_p_value(self.transcript, self.rates, 2000, cq,
+                de_novos, seed=1, target_rse=0.01, cache=cache)
+            
+            # the first run fills the cache, which the next run reuses
+            weights = self.rates.collapsed(cq)
+            null = cache.get(cache.get_key(weights, len(de_novos)))
+            self.assertEqual(null.total, 2000)
+            
+            (obs, second) = get_p_value(self.transcript, self.rates, 2000, cq,
+                de_novos, target_rse=0.01, cache=cache)
+            self.assertEqual(first, second)
+            
+            # the cached p-value matches simulating without a cache
+            (obs, direct) = get_p_value(self.transcript, self.rates, 2000, cq,
+                de_novos, seed=1, target_rse=0.01)
+            self.assertEqual(first, direct)
+            
+            # the cache doesn't know when the Besag-Clifford rule would have
+            # stopped, so even with enough simulations as clustered as
+            # observed, the cached p-value counts the observed set too
+            cache = NullCache(os.path.join(temp_dir, 'stopped.db'))
+            (obs, p_value) = get_p_value(self.transcript, self.rates, 2000, cq,
+                de_novos, seed=1, target_rse=0.1, cache=cache)
+            null = cache.get(cache.get_key(weights, len(de_novos)))
+            positions = [ self.transcript.chrom_pos_to_cds(x)['pos'] for x in de_novos ]
+            count = null.count(geomean(get_distances(positions)))
+            self.assertTrue(count >= 100)
+            self.assertEqual(p_value, (1 + count) / (1 + null.total))
+        finally:
+            shutil.rmtree(temp_dir)
+    
+    def test_get_p_values(self):
+        """ check several de novo sets match analysing each set alone
+        """
+        
+        cq = 'missense'
+        de_novo_sets = [[5, 6, 58], [5], [5, 5], [5, 30, 58], [5, 6, 7, 58]]
+        results = get_p_values(self.transcript, self.rates, 2000, cq,
+            de_novo_sets, seed=1)
+        
+        self.assertEqual(len(results), 5)
+        self.assertTrue(math.isnan(results[1][1]))
+        for de_novos, result in zip(de_novo_sets, results):
+            if len(de_novos) < 2:
+                continue
+            self.assertEqual(result, get_p_value(self.transcript, self.rates,
+                2000, cq, de_novos, seed=1))
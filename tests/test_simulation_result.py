@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2015 Genome Research Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import unittest
+
+from denovonear.weights import WeightedChoice, analyse_de_novos, \
+    count_simulations, geomean, get_distances
+from denovonear.simulation_result import SimulationResult
+
+class TestSimulationResultPy(unittest.TestCase):
+    """ unit test the SimulationResult class
+    """
+    
+    def setUp(self):
+        """ set up uniformly weighted sites
+        """
+        
+        self.choices = WeightedChoice()
+        for x in range(1000):
+            self.choices.add_choice(x, 0.0001)
+    
+    def analyse(self, iterations, **kwargs):
+        return analyse_de_novos(self.choices, iterations, 3, 150, details=True,
+            exceedances=0, **kwargs)
+    
+    def test_p_value(self):
+        """ check the p-value is estimated from the counts
+        """
+        
+        result = SimulationResult(9, 99, 150, 3)
+        self.assertEqual(result.p_value, 0.1)
+        self.assertAlmostEqual(result.std_error, (0.1 * 0.9 / 99) ** 0.5)
+        
+        result = SimulationResult(10, 100, 150, 3, stopping='besag_clifford')
+        self.assertEqual(result.p_value, 0.1)
+        
+        # other methods keep the probability they were given
+        result = SimulationResult(0, 0, 150, 3, 'enumeration', 'exhaustive',
+            p_value=0.02, std_error=0.0)
+        self.assertEqual(result.p_value, 0.02)
+        self.assertEqual(result.std_error, 0.0)
+    
+    def test_analyse_de_novos_details(self):
+        """ check analyse_de_novos gives a record matching the p-value
+        """
+        
+        result = self.analyse(10000, seed=5, stream=2, start=100)
+        self.assertEqual(result.method, 'simulation')
+        self.assertEqual(result.iterations, 10000)
+        self.assertEqual((result.seed, result.stream, result.start), (5, 2, 100))
+        self.assertEqual(result.next_start, 10100)
+        self.assertEqual(result.p_value, analyse_de_novos(self.choices, 10000,
+            3, 150, exceedances=0, seed=5, stream=2, start=100))
+    
+    def test_merge_shards(self):
+        """ check merged shards match a single run over the same simulations
+        """
+        
+        single = self.analyse(20000, seed=1)
+        shards = [ self.analyse(5000, seed=1, start=5000 * i) for i in range(4) ]
+        
+        # the shards can be merged in any order
+        merged = shards[2] + shards[0] + shards[3] + shards[1]
+        self.assertEqual(merged.count, single.count)
+        self.assertEqual(merged.iterations, single.iterations)
+        self.assertEqual(merged.p_value, single.p_value)
+        self.assertEqual(merged.ranges, [[0, 20000]])
+        self.assertEqual(merged.stopping, 'merged')
+        self.assertEqual((shards[2] + shards[0]).ranges, [[0, 5000], [10000, 15000]])
+        
+        # top up a run, by continuing from where it stopped
+        first = self.analyse(5000, seed=1)
+        topped = first + self.analyse(15000, seed=1, start=first.next_start)
+        self.assertEqual(topped.count, single.count)
+    
+    def test_merge_shards_without_hits(self):
+        """ check shards without simulations as clustered as observed still
+        only simulate their own range, so they can be merged
+        """
+        
+        # hardly any simulations are as clustered as this
+        observed = geomean(get_distances([100, 100, 101]))
+        shards = [ analyse_de_novos(self.choices, 5000, 3, observed,
+            details=True, seed=1, start=5000 * i) for i in range(2) ]
+        for i, shard in enumerate(shards):
+            self.assertEqual(shard.method, 'simulation')
+            self.assertEqual(shard.count, 0)
+            self.assertEqual(shard.ranges, [[5000 * i, 5000 * (i + 1)]])
+        
+        merged = shards[0] + shards[1]
+        self.assertEqual(merged.count, count_simulations(self.choices, 10000, 3,
+            observed, seed=1))
+        self.assertEqual(merged.ranges, [[0, 10000]])
+        
+        # without a start, the run switches to importance sampling instead
+        result = analyse_de_novos(self.choices, 5000, 3, observed, details=True,
+            seed=1)
+        self.assertEqual(result.method, 'importance_sampling')
+    
+    def test_merge_checks(self):
+        """ check results are only merged if they are compatible
+        """
+        
+        first = self.analyse(1000, seed=1)
+        
+        # runs sharing simulations from the same stream can't be merged
+        with self.assertRaises(ValueError):
+            first + self.analyse(1000, seed=1, start=500)
+        
+        # runs from different streams are independent
+        merged = first + self.analyse(1000, seed=1, stream=1)
+        self.assertEqual(merged.iterations, 2000)
+        self.assertEqual(merged.seed, 1)
+        self.assertIsNone(merged.stream)
+        self.assertIsNone(merged.start)
+        self.assertEqual(merged.streams, {0: [[0, 1000]], 1: [[0, 1000]]})
+        
+        # the simulations covered in each stream are still checked after
+        # merging runs from different streams
+        with self.assertRaises(ValueError):
+            merged + self.analyse(1000, seed=1, stream=1, start=500)
+        topped = merged + self.analyse(1000, seed=1, stream=1, start=1000)
+        self.assertEqual(topped.streams, {0: [[0, 1000]], 1: [[0, 2000]]})
+        
+        # runs need the same seed, and the same de novos
+        with self.assertRaises(ValueError):
+            first + self.analyse(1000, seed=2, start=1000)
+        with self.assertRaises(ValueError):
+            first + SimulationResult(1, 100, 151, 3, seed=1)
+        with self.assertRaises(ValueError):
+            first + SimulationResult(1, 100, 150, 4, seed=1)
+        
+        # runs stopped by the Besag-Clifford rule can't be merged
+        stopped = analyse_de_novos(self.choices, 100000, 3, 150, details=True,
+            seed=1, exceedances=10)
+        self.assertEqual(stopped.stopping, 'besag_clifford')
+        with self.assertRaises(ValueError):
+            first + stopped
+        with self.assertRaises(ValueError):
+            stopped + first
+        with self.assertRaises(ValueError):
+            first + SimulationResult(0, 0, 150, 3, 'enumeration', 'exhaustive',
+                p_value=0.02, std_error=0.0)
+    
+    def test_serialise(self):
+        """ check records survive conversion to JSON and back
+        """
+        
+        for result in [self.analyse(1000, seed=1),
+                self.analyse(1000, seed=1) + self.analyse(1000, seed=1, stream=3),
+                SimulationResult(0, 0, 150, 3, 'enumeration', 'exhaustive',
+                    p_value=0.02, std_error=0.0)]:
+            data = json.loads(json.dumps(result.to_dict()))
+            self.assertEqual(SimulationResult.from_dict(data), result)
@@ -19,11 +19,14 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import itertools
 import math
+import threading
 import unittest
 
 from denovonear.weights import get_distances, geomean, WeightedChoice, \
-    analyse_de_novos, simulate_distribution
+    analyse_de_novos, analyse_de_novos_many, simulate_distribution, \
+    count_simulations, importance_sample, can_enumerate
 
 class TestSimulationsPy(unittest.TestCase):
     """ unit test the simulation functions
@@ -50,9 +53,25 @@ class TestSimulationsPy(unittest.TestCase):
         distances = get_distances(positions)
         observed = geomean(distances)
         
-        p_val = analyse_de_novos(self.choices, self.iterations, len(positions), observed)
+        # run all the iterations, without sequential stopping
+        p_val = analyse_de_novos(self.choices, self.iterations, len(positions),
+            observed, exceedances=0)
         
         self.assertAlmostEqual(p_val, 0.635, places=2)
+        
+        # by default, the simulations stop once enough are as clustered as the
+        # observed de novos, which for a dispersed gene happens quickly
+        result = analyse_de_novos(self.choices, self.iterations, len(positions),
+            observed, details=True)
+        self.assertEqual(result.stopping, 'besag_clifford')
+        self.assertTrue(result.iterations <= 3000)
+        self.assertTrue(abs(result.p_value - 0.635) < 5 * result.std_error)
+        
+        # if the iterations run out first, we say so
+        result = analyse_de_novos(self.choices, 1000, len(positions), observed,
+            details=True)
+        self.assertEqual(result.stopping, 'max_iterations')
+        self.assertEqual(result.iterations, 1000)
     
     def test_analyse_de_novos_clustered(self):
         """ test analyse_de_novos() works correctly for clustered de novos
@@ -77,3 +96,220 @@ class TestSimulationsPy(unittest.TestCase):
         
         self.assertNotEqual(first, second)
         
+        # the distribution can be returned as a sorted numpy array instead
+        dist = simulate_distribution(self.choices, 1000, 3, as_array=True)
+        self.assertEqual(dist.dtype, 'float64')
+        self.assertEqual(len(dist), 1000)
+        self.assertTrue((dist[:-1] <= dist[1:]).all())
+        
+        dist = simulate_distribution(self.choices, 0, 3, as_array=True)
+        self.assertEqual(len(dist), 0)
+    
+    def test_count_simulations(self):
+        ''' check that count_simulations counts means at or below a threshold
+        '''
+        
+        # every simulated mean distance lies within the bounds of the sites
+        self.assertEqual(count_simulations(self.choices, 1000, 3, 1000), 1000)
+        self.assertEqual(count_simulations(self.choices, 1000, 3, -1), 0)
+        
+        # with the same seed, the count matches the full distribution exactly
+        dist = simulate_distribution(self.choices, 100000, 3, seed=1)
+        expected = sum(x <= 200 for x in dist)
+        count = count_simulations(self.choices, 100000, 3, 200, seed=1)
+        self.assertEqual(count, expected)
+    
+    def test_threaded_simulations(self):
+        ''' check that splitting simulations across threads works correctly
+        '''
+        
+        dist = simulate_distribution(self.choices, 1001, 3, threads=4)
+        self.assertEqual(len(dist), 1001)
+        self.assertEqual(dist, sorted(dist))
+        
+        # more threads than iterations still runs every iteration
+        self.assertEqual(len(simulate_distribution(self.choices, 2, 3, threads=8)), 2)
+        self.assertEqual(count_simulations(self.choices, 1000, 3, 1000, threads=3), 1000)
+        
+        positions = [100, 300, 600]
+        observed = geomean(get_distances(positions))
+        p_val = analyse_de_novos(self.choices, self.iterations, len(positions),
+            observed, threads=4, exceedances=0)
+        self.assertAlmostEqual(p_val, 0.635, places=2)
+    
+    def test_simulations_in_python_threads(self):
+        ''' check simulations on one WeightedChoice from many python threads
+        '''
+        
+        positions = [100, 300, 600]
+        observed = geomean(get_distances(positions))
+        
+        p_values = []
+        def analyse():
+            p_values.append(analyse_de_novos(self.choices, self.iterations,
+                len(positions), observed, exceedances=0))
+        
+        workers = [ threading.Thread(target=analyse) for x in range(4) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        self.assertEqual(len(p_values), 4)
+        for p_val in p_values:
+            self.assertAlmostEqual(p_val, 0.635, places=2)
+        
+        # the sites can still be modified once the simulations have finished
+        self.choices.add_choice(1000, 0.0001)
+        self.assertEqual(len(self.choices), 1001)
+    
+    def test_analyse_de_novos_enumeration(self):
+        ''' check that small site sets are enumerated exactly
+        '''
+        
+        # include alternates sharing positions, which collapse together
+        sites = [(0, 1.0), (3, 2.0), (3, 1.0), (4, 0.5), (10, 3.0), (25, 1.5)]
+        choices = WeightedChoice()
+        for pos, rate in sites:
+            choices.add_choice(pos, rate)
+        total = sum(rate for _, rate in sites)
+        
+        for observed in [0.0, 1.0, 2.5, 6.0, 30.0]:
+            expected = 0.0
+            for placed in itertools.product(sites, repeat=3):
+                prob = 1.0
+                for _, rate in placed:
+                    prob *= rate / total
+                positions = [ pos for pos, _ in placed ]
+                if geomean(get_distances(positions)) <= observed:
+                    expected += prob
+            
+            result = analyse_de_novos(choices, 1000, 3, observed, details=True)
+            self.assertEqual(result.method, 'enumeration')
+            self.assertEqual(result.iterations, 0)
+            self.assertAlmostEqual(result.p_value, expected, places=12)
+        
+        # if enumerating costs more than the iterations, we simulate instead
+        result = analyse_de_novos(self.choices, 1000, 3, 300, details=True)
+        self.assertEqual(result.method, 'simulation')
+        self.assertEqual(result.iterations, 1000)
+        
+        # the same check is available before analysing, e.g. to skip caches
+        self.assertTrue(can_enumerate(choices, 1000, 3))
+        self.assertFalse(can_enumerate(choices, 30, 3))
+        self.assertFalse(can_enumerate(self.choices, 1000, 3))
+        self.assertFalse(can_enumerate(WeightedChoice(), 1000, 3))
+    
+    def test_importance_sample(self):
+        ''' check importance sampling estimates tiny probabilities correctly
+        '''
+        
+        length = 5000
+        choices = WeightedChoice()
+        for x in range(length):
+            choices.add_choice(x, 1e-8)
+        
+        # three uniformly sampled de novos are only this clustered if they all
+        # share a site, or two share a site, and the third is adjacent
+        observed = geomean(get_distances([100, 100, 101]))
+        expected = (length + 6 * (length - 1)) / float(length ** 3)
+        
+        p_val, std_error = importance_sample(choices, 100000, 3, observed)
+        self.assertTrue(abs(p_val - expected) < 5 * std_error)
+        self.assertTrue(std_error < 0.05 * expected)
+        
+        # analyse_de_novos switches to importance sampling when none of the
+        # first half of the simulations are as clustered as the observed de
+        # novos, without running more draws than the iterations
+        result = analyse_de_novos(choices, 10000, 3, observed, details=True)
+        self.assertEqual(result.method, 'importance_sampling')
+        self.assertEqual(result.iterations, 10000)
+        self.assertTrue(abs(result.p_value - expected) < 5 * result.std_error)
+    
+    def test_importance_sample_wide_clusters(self):
+        ''' check importance sampling includes the widest qualifying clusters
+        '''
+        
+        choices = WeightedChoice()
+        for x in range(300):
+            choices.add_choice(x, 1.0)
+        
+        # de novos at 0, 0 and 7 have a mean distance of 3, so clusters up to
+        # 7 bp wide are as clustered as observed
+        observed = 3.0
+        self.assertAlmostEqual(geomean(get_distances([0, 0, 7])), observed)
+        
+        # compare to the exact probability, from enumerating the placements
+        exact = analyse_de_novos(choices, 10000000, 3, observed, details=True)
+        self.assertEqual(exact.method, 'enumeration')
+        
+        p_val, std_error = importance_sample(choices, 200000, 3, observed, seed=1)
+        self.assertTrue(abs(p_val - exact.p_value) < 5 * std_error)
+    
+    def test_seeded_simulations(self):
+        ''' check seeded simulations repeat, whichever way they are split
+        '''
+        
+        first = simulate_distribution(self.choices, 1000, 3, seed=1)
+        self.assertEqual(first, simulate_distribution(self.choices, 1000, 3, seed=1))
+        self.assertEqual(first, simulate_distribution(self.choices, 1000, 3,
+            threads=3, seed=1))
+        self.assertNotEqual(first, simulate_distribution(self.choices, 1000, 3,
+            seed=2))
+        self.assertNotEqual(first, simulate_distribution(self.choices, 1000, 3,
+            seed=1, stream=1))
+        
+        # counts from shards of a stream sum to the count from a single run
+        count = count_simulations(self.choices, 10000, 3, 150, seed=1)
+        shards = [ count_simulations(self.choices, 2500, 3, 150, seed=1,
+            start=2500 * i) for i in range(4) ]
+        self.assertEqual(sum(shards), count)
+        
+        # seeded analyses give the same result for any number of threads
+        result = analyse_de_novos(self.choices, 100000, 3, 150, details=True,
+            seed=1)
+        for threads in [2, 3]:
+            self.assertEqual(result, analyse_de_novos(self.choices, 100000, 3,
+                150, threads=threads, details=True, seed=1))
+        
+        # the run stops at the simulation giving the final exceedance
+        self.assertEqual(result.stopping, 'besag_clifford')
+        self.assertEqual(result.p_value, 1000 / result.iterations)
+        self.assertEqual(count_simulations(self.choices, result.iterations,
+            3, 150, seed=1), 1000)
+        self.assertEqual(count_simulations(self.choices, result.iterations - 1,
+            3, 150, seed=1), 999)
+        
+        # seeded importance sampling is also repeatable across threads
+        observed = geomean(get_distances([100, 100, 101]))
+        self.assertEqual(importance_sample(self.choices, 5000, 3, observed, seed=1),
+            importance_sample(self.choices, 5000, 3, observed, threads=2, seed=1))
+    
+    def test_analyse_de_novos_many(self):
+        ''' check many observed values give the same results as one at a time
+        '''
+        
+        choices = WeightedChoice()
+        for x in range(5000):
+            choices.add_choice(x, 1e-8)
+        
+        # include values which stop early, run all the iterations, or need
+        # importance sampling
+        observed = [1, 30, 1000, 3000]
+        results = analyse_de_novos_many(choices, 20000, 3, observed,
+            details=True, seed=1)
+        self.assertEqual([ x.method for x in results ], ['importance_sampling',
+            'simulation', 'simulation', 'simulation'])
+        self.assertEqual([ x.stopping for x in results ], ['max_iterations',
+            'max_iterations', 'besag_clifford', 'besag_clifford'])
+        
+        for value, result in zip(observed, results):
+            self.assertEqual(result, analyse_de_novos(choices, 20000, 3, value,
+                details=True, seed=1))
+        
+        p_values = analyse_de_novos_many(choices, 20000, 3, observed, seed=1)
+        self.assertEqual(p_values, [ x.p_value for x in results ])
+        
+        # enumeration also works for many values
+        results = analyse_de_novos_many(self.choices, 200000, 2, [5, 5000])
+        self.assertEqual(results[1], 1.0)
@@ -25,7 +25,8 @@ import os
 import unittest
 import itertools
 
-from denovonear.site_specific_rates import get_gene_range, get_mutated_aa, SiteRates
+from denovonear.site_specific_rates import get_gene_range, get_mutated_aa, \
+    get_codon_change, SiteRates, MutationRates
 from denovonear.weights import WeightedChoice
 from denovonear.transcript import Transcript
 
@@ -105,6 +106,148 @@ class TestSiteRatesPy(unittest.TestCase):
         weights = SiteRates(transcript, five_mers)
         weights = SiteRates(transcript, seven_mers)
     
+    def test_mutation_rates(self):
+        """ check that MutationRates gives rates by sequence context
+        """
+        
+        rates = MutationRates([[b'AAA', b'ACA', b'1e-8'], [b'AAA', b'AGA', b'2e-8']])
+        self.assertEqual(rates.kmer_length, 3)
+        self.assertEqual(rates.get_rate('AAA', 'C'), 1e-8)
+        self.assertEqual(rates.get_rate('AAA', 'G'), 2e-8)
+        
+        # sequence contexts missing from the table have zero rates
+        self.assertEqual(rates.get_rate('AAA', 'T'), 0)
+        self.assertEqual(rates.get_rate('ANA', 'T'), 0)
+        self.assertEqual(rates.get_rate('AAAAA', 'T'), 0)
+        
+        # tables with mismatched or even length sequences raise errors
+        with self.assertRaises(ValueError):
+            MutationRates([[b'AAA', b'ACA', b'1e-8'], [b'AAAAA', b'AACAA', b'1e-8']])
+        with self.assertRaises(ValueError):
+            MutationRates([[b'AA', b'AC', b'1e-8']])
+        with self.assertRaises(ValueError):
+            MutationRates([])
+    
+    def test_site_rates_shared_mutation_rates(self):
+        """ check that SiteRates gives the same rates from a MutationRates object
+        """
+        
+        shared = MutationRates(self.rates)
+        first = SiteRates(self.transcript, shared)
+        second = SiteRates(self.transcript, shared)
+        
+        for cq in ['missense', 'nonsense', 'synonymous', 'splice_lof',
+                'splice_region', 'loss_of_function']:
+            self.assertEqual(first[cq].get_summed_rate(),
+                self.weights[cq].get_summed_rate())
+            self.assertEqual(list(second[cq]), list(self.weights[cq]))
+    
+    def test_site_rates_sequence_context(self):
+        """ check each alternate gets the rate for its own sequence context
+        """
+        
+        # give every sequence change a distinct rate
+        rates = [ [initial, changed, str((i + 1) * 1e-9).encode('utf8')]
+            for i, (initial, changed, _) in enumerate(generate_rates(5)) ]
+        lookup = dict(((x.decode('utf8'), y.decode('utf8')), float(z))
+            for x, y, z in rates)
+        complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+        
+        genomic = "CCTCCAGATTCACGGGAAGCATGTCCATAAGTAGGGAGATATTTGGTGCTCTCATTTG" \
+            "TGGAGACTCTAGCCAAAGCCTGAGTCATGCGTACCATAGATAG"
+        
+        for strand in ['+', '-']:
+            transcript = self.construct_gene(strand=strand)
+            transcript.add_genomic_sequence(genomic, offset=10)
+            gdna = transcript.get_genomic_sequence()
+            
+            weights = SiteRates(transcript, rates, cds_coords=False)
+            for cq in ['missense', 'nonsense', 'synonymous', 'splice_lof',
+                    'splice_region']:
+                for site in weights[cq]:
+                    idx = site['pos'] - transcript.get_start() + 10
+                    context = gdna[idx - 2:idx + 3]
+                    alt = site['alt']
+                    self.assertEqual(context[2], site['ref'])
+                    if strand == '-':
+                        context = ''.join(complement[x] for x in context[::-1])
+                        alt = complement[alt]
+                    
+                    changed = context[:2] + alt + context[3:]
+                    self.assertEqual(site['prob'], lookup.get((context, changed), 0))
+            
+            # checking positions one at a time gives the same sites
+            weights.clear()
+            for bp in range(100, 180):
+                weights.check_position(bp)
+            self.assertEqual(list(weights['missense']),
+                list(SiteRates(transcript, rates, cds_coords=False)['missense']))
+    
+    def test_site_rates_categories(self):
+        """ check that SiteRates only builds the requested categories up front
+        """
+        
+        all_cqs = ['missense', 'nonsense', 'synonymous', 'splice_lof',
+            'splice_region', 'loss_of_function']
+        
+        # summed rates don't need any sites to be built
+        summed = SiteRates(self.transcript, self.rates, categories=[])
+        for cq in all_cqs:
+            self.assertEqual(summed.get_summed_rate(cq),
+                self.weights[cq].get_summed_rate())
+        
+        # categories not requested are built when first accessed
+        partial = SiteRates(self.transcript, self.rates,
+            categories=['missense', 'loss_of_function'])
+        for cq in all_cqs:
+            self.assertEqual(list(partial[cq]), list(self.weights[cq]))
+            self.assertEqual(list(summed[cq]), list(self.weights[cq]))
+            self.assertEqual(list(partial.collapsed(cq)),
+                list(self.weights.collapsed(cq)))
+        
+        # building categories later doesn't change the summed rates
+        self.assertEqual(partial.get_summed_rate('missense'),
+            self.weights['missense'].get_summed_rate())
+        
+        # after clearing, checked positions add sites to every category,
+        # including ones built lazily, or never built
+        self.weights.clear()
+        self.weights.check_position(115)
+        for rates in [partial, summed]:
+            rates.clear()
+            rates.check_position(115)
+            for cq in all_cqs:
+                self.assertEqual(list(rates[cq]), list(self.weights[cq]))
+                self.assertEqual(rates.get_summed_rate(cq),
+                    self.weights.get_summed_rate(cq))
+        self.assertEqual(len(partial['synonymous']), 3)
+        
+        with self.assertRaises(ValueError):
+            SiteRates(self.transcript, self.rates, categories=['missing'])
+    
+    def test_site_rates_views(self):
+        """ check that categories are shared views, copied when changed
+        """
+        
+        first = self.weights['missense']
+        second = self.weights['missense']
+        expected = list(first)
+        
+        # changing one view doesn't change the other, or the SiteRates
+        first.add_choice(1000, 0.5, 'A', 'G')
+        self.assertEqual(len(first), len(expected) + 1)
+        self.assertEqual(list(second), expected)
+        self.assertEqual(list(self.weights['missense']), expected)
+        
+        # changing the SiteRates doesn't change views from before
+        self.weights.clear()
+        self.assertEqual(list(second), expected)
+        self.assertEqual(len(self.weights['missense']), 0)
+        
+        self.weights.check_position(111)
+        self.assertEqual(list(second), expected)
+        self.assertEqual(len(self.weights['missense']), 3)
+    
     def test_get_boundary_distance(self):
         """ check the function to get distances to the nearest intron/exon boundary
         """
@@ -183,6 +326,31 @@ class TestSiteRatesPy(unittest.TestCase):
         self.assertAlmostEqual(wts["splice_lof"].get_summed_rate(), 6e-06, places=7)
         self.assertAlmostEqual(wts["splice_region"].get_summed_rate(), 2.05e-05, places=7)
     
+    def test_site_rates_collapsed(self):
+        """ check the position-level rates, which merge alternates at each site
+        """
+        
+        for cq in ["missense", "nonsense", "synonymous", "loss_of_function",
+                "splice_lof", "splice_region"]:
+            sites = list(self.weights[cq])
+            merged = list(self.weights.collapsed(cq))
+            
+            # the summed rate is unchanged, but each site appears once
+            self.assertAlmostEqual(self.weights.collapsed(cq).get_summed_rate(),
+                self.weights[cq].get_summed_rate(), places=15)
+            keys = [ (x['pos'], x['offset']) for x in merged ]
+            self.assertEqual(len(keys), len(set(keys)))
+            self.assertEqual(set(keys), set( (x['pos'], x['offset']) for x in sites ))
+            
+            for site in merged:
+                rate = sum( x['prob'] for x in sites if x['pos'] == site['pos']
+                    and x['offset'] == site['offset'] )
+                self.assertAlmostEqual(site["prob"], rate, places=15)
+                self.assertEqual(site['alt'], 'N')
+        
+        # missense sites shrink, since most bases have several missense alternates
+        self.assertTrue(len(self.weights.collapsed("missense")) < len(self.weights["missense"]))
+    
     def test_site_rates_sampled(self):
         """ check the sites sampled for each consequence group.
         
@@ -252,6 +420,39 @@ class TestSiteRatesPy(unittest.TestCase):
         with self.assertRaises(ValueError):
             get_mutated_aa(self.transcript, "C", "RRR", 2)
     
+    def test_get_codon_change(self):
+        """ check the codon change table matches translating the mutated codons
+        """
+        
+        self.assertEqual(get_codon_change("AAA", 2, "C"), ("N", "missense"))
+        self.assertEqual(get_codon_change("TGG", 2, "A"), ("*", "nonsense"))
+        self.assertEqual(get_codon_change("AAA", 2, "G"), ("K", "synonymous"))
+        
+        for codon in itertools.product("ACGT", repeat=3):
+            codon = "".join(codon)
+            initial = self.transcript.translate(codon)
+            for intra_codon in range(3):
+                for alt in "ACGT":
+                    mutated = codon[:intra_codon] + alt + codon[intra_codon + 1:]
+                    mutated = self.transcript.translate(mutated)
+                    
+                    cq = "synonymous"
+                    if initial != "*" and mutated == "*":
+                        cq = "nonsense"
+                    elif initial != mutated:
+                        cq = "missense"
+                    
+                    self.assertEqual(get_codon_change(codon, intra_codon, alt),
+                        (mutated, cq))
+        
+        # non-DNA codons and alleles raise errors
+        with self.assertRaises(ValueError):
+            get_codon_change("RRR", 2, "C")
+        with self.assertRaises(ValueError):
+            get_codon_change("AAA", 2, "N")
+        with self.assertRaises(ValueError):
+            get_codon_change("AAA", 3, "C")
+    
     def test_splice_lof_check(self):
         """ check that splice_lof_check() works correctly
         """
@@ -4,6 +4,8 @@ from __future__ import division
 
 import unittest
 
+import numpy
+
 from denovonear.weights import WeightedChoice
 
 class TestWeightedChoicePy(unittest.TestCase):
@@ -165,3 +167,196 @@ class TestWeightedChoicePy(unittest.TestCase):
         self.assertEqual(choices.choice_with_alleles(),
             {'alt': 'T', 'ref': 'A', 'pos': 1, 'offset': 3})
         self.assertEqual(choices.choice(), 1)
+    
+    def test_choice_samplers(self):
+        """ test that the alias table and binary search samplers agree
+        """
+        
+        iterations = 1000000
+        
+        # the alias table is used by default
+        self.assertTrue(WeightedChoice().alias)
+        self.assertFalse(WeightedChoice(alias=False).alias)
+        
+        for alias in [True, False]:
+            choices = WeightedChoice(alias=alias)
+            choices.add_choice(1, 1)
+            choices.add_choice(2, 5)
+            choices.add_choice(3, 0)
+            choices.add_choice(4, 4)
+            s = [ choices.choice() for x in range(iterations) ]
+            self.assertAlmostEqual(s.count(1)/len(s), 0.100, places=2)
+            self.assertAlmostEqual(s.count(2)/len(s), 0.500, places=2)
+            self.assertAlmostEqual(s.count(4)/len(s), 0.400, places=2)
+            
+            # sites without any weight are never chosen
+            self.assertEqual(s.count(3), 0)
+        
+        # switching the sampler on an existing object still samples correctly
+        choices = WeightedChoice(alias=False)
+        choices.add_choice(1, 1)
+        choices.add_choice(2, 3)
+        choices.alias = True
+        s = [ choices.choice() for x in range(iterations) ]
+        self.assertAlmostEqual(s.count(1)/len(s), 0.250, places=2)
+    
+    def test_compact_sites(self):
+        """ test that sites are stored and returned correctly
+        """
+        
+        choices = WeightedChoice()
+        choices.add_choice(100, 1, "A", "C", -5)
+        choices.add_choice(101, 2, "g", "t", 127)
+        choices.add_choice(102, 3, "N", "-", -128)
+        
+        self.assertEqual(list(choices), [
+            {'pos': 100, 'ref': 'A', 'alt': 'C', 'prob': 1, 'offset': -5},
+            {'pos': 101, 'ref': 'G', 'alt': 'T', 'prob': 2, 'offset': 127},
+            {'pos': 102, 'ref': 'N', 'alt': 'N', 'prob': 3, 'offset': -128}])
+        
+        # offsets are stored compactly, so must be within a byte's range
+        with self.assertRaises(ValueError):
+            choices.add_choice(103, 1, "A", "C", 128)
+        with self.assertRaises(ValueError):
+            choices.add_choice(103, 1, "A", "C", -129)
+        self.assertEqual(len(choices), 3)
+    
+    def test_collapse(self):
+        """ test that collapse() merges alternates sharing a site
+        """
+        
+        choices = WeightedChoice()
+        choices.add_choice(1, 1, "A", "C")
+        choices.add_choice(1, 2, "A", "G")
+        choices.add_choice(2, 1, "C", "T")
+        choices.add_choice(1, 3, "A", "T", 2)
+        choices.add_choice(1, 0.5, "A", "T")
+        
+        merged = choices.collapse()
+        self.assertEqual(list(merged), [
+            {'pos': 1, 'ref': 'A', 'alt': 'N', 'prob': 3.5, 'offset': 0},
+            {'pos': 2, 'ref': 'C', 'alt': 'N', 'prob': 1, 'offset': 0},
+            {'pos': 1, 'ref': 'A', 'alt': 'N', 'prob': 3, 'offset': 2}])
+        self.assertEqual(merged.get_summed_rate(), 7.5)
+        
+        # the original is unchanged
+        self.assertEqual(len(choices), 5)
+    
+    def test_from_arrays(self):
+        """ test that from_arrays() matches adding sites one at a time
+        """
+        
+        positions = numpy.array([100, 101, 102, 100])
+        probs = numpy.array([0.5, 1.0, 2.0, 0.25])
+        refs = ['A', 'c', 'G', 'T']
+        alts = numpy.array([b'T', b'A', b'N', b'X'])
+        offsets = [0, 5, -128, 127]
+        
+        choices = WeightedChoice.from_arrays(positions, probs, refs, alts, offsets)
+        expected = WeightedChoice()
+        for site in zip(positions, probs, refs, alts, offsets):
+            pos, prob, ref, alt, offset = site
+            expected.add_choice(int(pos), prob, ref.upper(), alt.decode('utf8'), offset)
+        
+        self.assertEqual(list(choices), list(expected))
+        self.assertEqual(choices.get_summed_rate(), expected.get_summed_rate())
+        self.assertEqual(list(choices)[3]['alt'], 'N')
+        
+        # alleles and offsets are optional
+        choices = WeightedChoice.from_arrays(positions, probs, alias=False)
+        self.assertFalse(choices.alias)
+        self.assertEqual(list(choices)[1],
+            {'pos': 101, 'ref': 'N', 'alt': 'N', 'prob': 1.0, 'offset': 0})
+        
+        # sites can still be added afterwards, and extend the cumulative rates
+        choices.add_choice(200, 4)
+        self.assertEqual(choices.get_summed_rate(), 7.75)
+        
+        self.assertEqual(len(WeightedChoice.from_arrays([], [])), 0)
+    
+    def test_from_arrays_checks(self):
+        """ test that from_arrays() rejects mismatched or invalid arrays
+        """
+        
+        with self.assertRaises(ValueError):
+            WeightedChoice.from_arrays([1, 2], [0.5])
+        with self.assertRaises(ValueError):
+            WeightedChoice.from_arrays([1, 2], [0.5, 0.5], refs=['A'])
+        with self.assertRaises(ValueError):
+            WeightedChoice.from_arrays([1, 2], [0.5, 0.5], offsets=[0, 128])
+        with self.assertRaises(TypeError):
+            WeightedChoice.from_arrays([1, 2], [0.5, 0.5], alts=['A', 'AT'])
+    
+    def test_to_arrays(self):
+        """ test that to_arrays() exports sites which round trip
+        """
+        
+        choices = WeightedChoice()
+        choices.add_choice(100, 0.5, "A", "T")
+        choices.add_choice(101, 1.0, "C", "N", -5)
+        choices.add_choice(100, 2.0, "N", "G", 127)
+        
+        arrays = choices.to_arrays()
+        self.assertEqual(arrays['pos'].tolist(), [100, 101, 100])
+        self.assertEqual(arrays['prob'].tolist(), [0.5, 1.0, 2.0])
+        self.assertEqual(arrays['ref'].tolist(), [b'A', b'C', b'N'])
+        self.assertEqual(arrays['alt'].tolist(), [b'T', b'N', b'G'])
+        self.assertEqual(arrays['offset'].tolist(), [0, -5, 127])
+        
+        copied = WeightedChoice.from_arrays(arrays['pos'], arrays['prob'],
+            arrays['ref'], arrays['alt'], arrays['offset'])
+        self.assertEqual(list(copied), list(choices))
+        
+        arrays = WeightedChoice().to_arrays()
+        self.assertEqual(len(arrays['pos']), 0)
+    
+    def test_choice_many(self):
+        """ test that choice_many() draws arrays of sites
+        """
+        
+        choices = WeightedChoice()
+        choices.add_choice(1, 1, "A", "C")
+        choices.add_choice(2, 2, "G", "T", -2)
+        choices.add_choice(3, 7, "N", "A", 5)
+        
+        sites = choices.choice_many(100000)
+        self.assertEqual(sites.dtype, numpy.intc)
+        self.assertEqual(len(sites), 100000)
+        self.assertAlmostEqual((sites == 1).mean(), 0.1, places=2)
+        self.assertAlmostEqual((sites == 2).mean(), 0.2, places=2)
+        self.assertAlmostEqual((sites == 3).mean(), 0.7, places=2)
+        
+        # the same seed repeats the same draws
+        first = choices.choice_many(1000, seed=12345)
+        second = choices.choice_many(1000, seed=12345)
+        self.assertEqual(first.tolist(), second.tolist())
+        
+        # alleles and offsets match the chosen sites
+        chosen = choices.choice_many(1000, with_alleles=True, seed=12345)
+        self.assertEqual(chosen['pos'].tolist(), first.tolist())
+        expected = {1: (b'A', b'C', 0), 2: (b'G', b'T', -2), 3: (b'N', b'A', 5)}
+        for site in chosen:
+            self.assertEqual(expected[site['pos']],
+                (site['ref'], site['alt'], site['offset']))
+        
+        self.assertEqual(len(choices.choice_many(0, with_alleles=True)), 0)
+        self.assertEqual(WeightedChoice().choice_many(2).tolist(), [-1, -1])
+        with self.assertRaises(ValueError):
+            choices.choice_many(-1)
+    
+    def test_seeded_choice(self):
+        """ test that seeded WeightedChoice objects repeat their draws
+        """
+        
+        first = WeightedChoice(seed=10)
+        second = WeightedChoice(seed=10)
+        other = WeightedChoice(seed=10, stream=1)
+        for choices in [first, second, other]:
+            for x in range(100):
+                choices.add_choice(x, 1)
+        
+        draws = [ first.choice() for x in range(50) ]
+        self.assertEqual(draws, [ second.choice() for x in range(50) ])
+        self.assertNotEqual(draws, [ other.choice() for x in range(50) ])
+        self.assertEqual(first.choice_many(50).tolist(),
+            second.choice_many(50).tolist())